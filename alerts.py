@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import re
+from bisect import bisect_left, bisect_right, insort
+
+from assets import parse_kind
+from ratelimit import BACKGROUND, request_priority
+
+logger = logging.getLogger(__name__)
+
+ABOVE = '>'
+BELOW = '<'
+
+# "USD > 100", "AAPL < 150.5", "crypto BTC > 30000,5"
+ALERT_PATTERN = re.compile(r'^\s*(?:([^\W\d_]+)\s+)?([A-Za-z0-9.\-^=]+)\s*([<>])\s*(\d+(?:[.,]\d+)?)\s*$')
+
+
+# Активное ценовое уведомление. telegram_id - чат, куда придет сообщение
+class Alert:
+    __slots__ = ('id', 'user_id', 'telegram_id', 'kind', 'symbol', 'direction', 'threshold')
+
+    def __init__(self, id, user_id, telegram_id, kind, symbol, direction, threshold):
+        self.id = id
+        self.user_id = user_id
+        self.telegram_id = telegram_id
+        self.kind = kind
+        self.symbol = symbol
+        self.direction = direction
+        self.threshold = threshold
+
+    def __repr__(self):
+        return f"Alert({self.id}, {self.symbol} {self.direction} {self.threshold})"
+
+
+# Разбор "crypto BTC > 100": (вид актива, символ, направление, порог) или
+# None; вид None, если пользователь его не указал
+def parse_alert(text):
+    match = ALERT_PATTERN.match(text or '')
+    if match is None:
+        return None
+    kind_word, symbol, direction, threshold = match.groups()
+    kind = parse_kind(kind_word) if kind_word else None
+    if kind_word and kind is None:
+        return None
+    return kind, symbol.upper(), direction, float(threshold.replace(',', '.'))
+
+
+def insert_alert(cursor, user_id, kind, symbol, direction, threshold):
+    cursor.execute('''
+    INSERT INTO alerts (user_id, kind, symbol, direction, threshold) VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, kind, symbol, direction, threshold))
+
+    return cursor.lastrowid
+
+
+# Активные уведомления с номером больше after_id (0 - все)
+def select_active_alerts(cursor, after_id=0):
+    cursor.execute('''
+    SELECT alerts.id, alerts.user_id, users.telegram_id, alerts.kind, alerts.symbol, alerts.direction, alerts.threshold
+    FROM alerts JOIN users ON users.id = alerts.user_id
+    WHERE alerts.id > ? AND alerts.triggered_at IS NULL
+    ORDER BY alerts.id
+    ''', (after_id,))
+
+    return cursor.fetchall()
+
+
+def select_user_alerts(cursor, user_id):
+    cursor.execute('''
+    SELECT id, kind, symbol, direction, threshold FROM alerts
+    WHERE user_id = ? AND triggered_at IS NULL ORDER BY id
+    ''', (user_id,))
+
+    return cursor.fetchall()
+
+
+# Возвращает номера, которые удалось отметить: уведомление могли удалить
+# или отметить в другом процессе бота
+def mark_alerts_triggered(cursor, alert_ids):
+    marked = []
+    for alert_id in alert_ids:
+        cursor.execute('''
+        UPDATE alerts SET triggered_at = CURRENT_TIMESTAMP WHERE id = ? AND triggered_at IS NULL
+        ''', (alert_id,))
+        if cursor.rowcount:
+            marked.append(alert_id)
+    return marked
+
+
+def delete_alert(cursor, user_id, alert_id):
+    cursor.execute('''
+    DELETE FROM alerts WHERE id = ? AND user_id = ? AND triggered_at IS NULL
+    ''', (alert_id, user_id))
+
+    return cursor.rowcount
+
+
+# Индекс активных уведомлений: для каждого символа отсортированные списки
+# порогов (threshold, id) отдельно для "выше" и "ниже". Сработавшие при
+# цене price - это префикс списка "выше" (порог < price) и суффикс списка
+# "ниже" (порог > price); их границы находятся двоичным поиском, а не
+# перебором всех уведомлений. Сработавшие удаляются, поэтому каждый тик
+# стоит O(log n) плюс число сработавших
+class AlertIndex:
+    def __init__(self):
+        self._alerts = {}
+        self._above = {}
+        self._below = {}
+
+    def _side(self, direction):
+        return self._above if direction == ABOVE else self._below
+
+    def add(self, alert):
+        self._alerts[alert.id] = alert
+        side = self._side(alert.direction)
+        insort(side.setdefault((alert.kind, alert.symbol), []), (alert.threshold, alert.id))
+
+    def remove(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+        side = self._side(alert.direction)
+        key = (alert.kind, alert.symbol)
+        thresholds = side[key]
+        del thresholds[bisect_left(thresholds, (alert.threshold, alert.id))]
+        if not thresholds:
+            del side[key]
+        return alert
+
+    def pop_triggered(self, kind, symbol, price):
+        key = (kind, symbol)
+        triggered = []
+
+        above = self._above.get(key)
+        if above:
+            end = bisect_left(above, (price,))
+            triggered.extend(alert_id for _, alert_id in above[:end])
+            del above[:end]
+            if not above:
+                del self._above[key]
+
+        below = self._below.get(key)
+        if below:
+            start = bisect_right(below, (price, float('inf')))
+            triggered.extend(alert_id for _, alert_id in below[start:])
+            del below[start:]
+            if not below:
+                del self._below[key]
+
+        return [self._alerts.pop(alert_id) for alert_id in triggered]
+
+    # Символы, по которым есть активные уведомления: (kind, symbol)
+    def symbols(self):
+        return set(self._above) | set(self._below)
+
+    def __contains__(self, alert_id):
+        return alert_id in self._alerts
+
+    def __len__(self):
+        return len(self._alerts)
+
+
+# Проверка ценовых уведомлений. Активные уведомления хранятся в SQLite и
+# при запуске загружаются в индекс; раз в interval секунд цены символов с
+# уведомлениями запрашиваются у тех же поставщиков, что и для ответов.
+# Уведомления, созданные другими процессами, догружаются перед каждой проверкой.
+# Индекс ведет только процесс, который проверяет уведомления (вызвал load):
+# рабочие процессы лишь пишут уведомления в базу.
+# fetchers: вид -> async функция(symbol), notify: async функция(alert, price)
+class AlertEngine:
+    def __init__(self, async_db, fetchers, notify, interval=60, concurrency=5):
+        self.async_db = async_db
+        self.fetchers = fetchers
+        self.notify = notify
+        self.interval = interval
+        self.concurrency = concurrency
+        self.index = AlertIndex()
+        self.triggered = 0
+        self.errors = 0
+        self._last_id = 0
+        self._loaded = False
+        self._task = None
+
+    async def load(self):
+        self.index = AlertIndex()
+        self._last_id = 0
+        self._loaded = True
+        await self.sync()
+        return len(self.index)
+
+    # Догружает уведомления, добавленные после последней загрузки
+    async def sync(self):
+        rows = await self.async_db.read(select_active_alerts, self._last_id)
+        for row in rows:
+            alert = Alert(*row)
+            if alert.id not in self.index:
+                self.index.add(alert)
+            self._last_id = max(self._last_id, alert.id)
+        return len(rows)
+
+    async def add(self, user_id, telegram_id, kind, symbol, direction, threshold):
+        alert_id = await self.async_db.write(insert_alert, user_id, kind, symbol, direction, threshold)
+        alert = Alert(alert_id, user_id, telegram_id, kind, symbol, direction, threshold)
+        if self._loaded:
+            self.index.add(alert)
+            self._last_id = max(self._last_id, alert_id)
+        return alert
+
+    async def user_alerts(self, user_id):
+        return await self.async_db.read(select_user_alerts, user_id)
+
+    # Возвращает True, если активное уведомление пользователя было удалено
+    async def remove(self, user_id, alert_id):
+        if await self.async_db.write(delete_alert, user_id, alert_id) == 0:
+            return False
+        self.index.remove(alert_id)
+        return True
+
+    # Новая цена символа: срабатывания отмечаются в базе до отправки
+    # сообщений, поэтому после перезапуска уведомление не повторится. Если
+    # отметить не удалось, уведомления возвращаются в индекс и сработают
+    # при следующей проверке
+    async def check(self, kind, symbol, price):
+        triggered = self.index.pop_triggered(kind, symbol, price)
+        if not triggered:
+            return triggered
+        try:
+            marked = set(await self.async_db.write(mark_alerts_triggered, [alert.id for alert in triggered]))
+        except BaseException:
+            for alert in triggered:
+                self.index.add(alert)
+            raise
+        triggered = [alert for alert in triggered if alert.id in marked]
+        self.triggered += len(triggered)
+        for alert in triggered:
+            try:
+                await self.notify(alert, price)
+            except Exception:
+                self.errors += 1
+                logger.exception("Не удалось отправить уведомление %s", alert.id)
+        return triggered
+
+    async def _check_symbol(self, semaphore, kind, symbol):
+        fetcher = self.fetchers.get(kind)
+        if fetcher is None:
+            return
+        # Проверка уведомлений пропускает вперед запросы пользователей
+        request_priority.set(BACKGROUND)
+        async with semaphore:
+            try:
+                price = await fetcher(symbol)
+                if price is not None:
+                    await self.check(kind, symbol, price)
+            except Exception:
+                self.errors += 1
+                logger.exception("Не удалось проверить уведомления %s %s", kind, symbol)
+
+    async def run_once(self):
+        await self.sync()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(
+            self._check_symbol(semaphore, kind, symbol)
+            for kind, symbol in self.index.symbols()
+        ))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
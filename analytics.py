@@ -0,0 +1,245 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+import numpy as np
+
+from assets import CRYPTO, STOCK
+from history import ALPHA_VANTAGE, YAHOO
+
+logger = logging.getLogger(__name__)
+
+# Для годовой волатильности
+TRADING_DAYS = 252
+# История позиции берется у поставщика ее вида актива, как и текущая цена:
+# у BTC-криптовалюты и BTC-фонда на бирже разные истории. У позиций без
+# вида истории нет
+HISTORY_PROVIDERS = {STOCK: YAHOO, CRYPTO: ALPHA_VANTAGE}
+PROVIDER_KINDS = {provider: kind for kind, provider in HISTORY_PROVIDERS.items()}
+
+
+def select_positions(cursor, user_id):
+    cursor.execute('''
+    SELECT user_id, stock_symbol, quantity, purchase_price, kind FROM portfolio WHERE user_id = ? AND quantity > 0
+    ''', (user_id,))
+
+    return cursor.fetchall()
+
+
+# Цены закрытия символов из портфеля пользователя с даты since
+def select_position_history(cursor, since, user_id):
+    cursor.execute('''
+    SELECT provider, symbol, day, close FROM price_history
+    WHERE day >= ? AND symbol IN (SELECT stock_symbol FROM portfolio WHERE user_id = ?)
+    ''', (since.isoformat(), user_id))
+
+    return cursor.fetchall()
+
+
+# Пропуски (выходные у акций, не загруженные дни) заполняются последним
+# известным закрытием; до первой цены символа остается NaN
+def forward_fill(values):
+    rows = np.arange(values.shape[0])[:, None]
+    last_known = np.where(np.isnan(values), 0, rows)
+    np.maximum.accumulate(last_known, axis=0, out=last_known)
+    return values[last_known, np.arange(values.shape[1])]
+
+
+# Матрица цен закрытия: строки - дни, столбцы - assets (символ, вид актива).
+# Для каждого актива берется история поставщика его вида
+def history_matrix(rows, assets):
+    asset_index = {asset: i for i, asset in enumerate(assets)}
+    rows = [
+        (asset_index[(symbol, PROVIDER_KINDS.get(provider))], day, close)
+        for provider, symbol, day, close in rows
+        if (symbol, PROVIDER_KINDS.get(provider)) in asset_index
+    ]
+    days = sorted({day for _, day, _ in rows})
+    day_index = {day: i for i, day in enumerate(days)}
+
+    closes = np.full((len(days), len(assets)), np.nan)
+    if rows:
+        closes[
+            np.fromiter((day_index[day] for _, day, _ in rows), dtype=np.intp, count=len(rows)),
+            np.fromiter((column for column, _, _ in rows), dtype=np.intp, count=len(rows)),
+        ] = np.fromiter((close for _, _, close in rows), dtype=float, count=len(rows))
+    return days, forward_fill(closes)
+
+
+# Показатели портфеля одного пользователя. Массивы идут в порядке symbols;
+# series, returns - стоимость текущего набора позиций с историей цен по
+# дням окна и ее дневные доходности; excluded - символы без истории (вид
+# актива не указан, история не загрузилась), не вошедшие в series
+class PortfolioAnalytics:
+    __slots__ = (
+        'symbols', 'kinds', 'quantities', 'prices', 'cost', 'value', 'pnl', 'pnl_percent', 'weights',
+        'total_cost', 'total_value', 'total_pnl', 'total_pnl_percent',
+        'days', 'series', 'returns', 'volatility', 'annualized_volatility', 'max_drawdown', 'excluded',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values[name])
+
+
+def _nan_if_zero(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.full(np.shape(numerator), np.nan), where=denominator != 0)
+
+
+# Расчет для всех пользователей сразу. positions - строки (user_id, символ,
+# количество, цена покупки, вид актива), history - строки (поставщик, символ,
+# день, цена закрытия), prices - текущие цены активов (символ, вид) вместо
+# последнего закрытия. Все показатели считаются операциями над матрицами
+# пользователи x активы и дни x пользователи, без циклов по позициям
+def analyze_portfolios(positions, history, prices=None):
+    users = sorted({row[0] for row in positions})
+    assets = sorted({(row[1], row[4]) for row in positions}, key=lambda asset: (asset[0], asset[1] or ''))
+    if not users:
+        return {}
+    user_index = {user_id: i for i, user_id in enumerate(users)}
+    asset_index = {asset: i for i, asset in enumerate(assets)}
+
+    count = len(positions)
+    user_rows = np.fromiter((user_index[row[0]] for row in positions), dtype=np.intp, count=count)
+    asset_columns = np.fromiter((asset_index[(row[1], row[4])] for row in positions), dtype=np.intp, count=count)
+    quantities = np.zeros((len(users), len(assets)))
+    costs = np.zeros((len(users), len(assets)))
+    np.add.at(quantities, (user_rows, asset_columns), np.fromiter((row[2] for row in positions), dtype=float, count=count))
+    np.add.at(costs, (user_rows, asset_columns), np.fromiter((row[2] * row[3] for row in positions), dtype=float, count=count))
+    held = quantities > 0
+
+    days, closes = history_matrix(history, assets)
+    last = closes[-1].copy() if days else np.full(len(assets), np.nan)
+    if prices:
+        current = np.array([np.nan if prices.get(asset) is None else prices[asset] for asset in assets])
+        last = np.where(np.isnan(current), last, current)
+
+    # Итоги, как и в оценке портфеля, только по позициям с известной ценой
+    priced = held & ~np.isnan(last)
+    values = np.where(held, quantities * last, 0.0)
+    known_values = np.where(priced, values, 0.0)
+    known_costs = np.where(priced, costs, 0.0)
+    total_value = known_values.sum(axis=1)
+    total_cost = known_costs.sum(axis=1)
+    total_pnl = total_value - total_cost
+    pnl = values - costs
+    pnl_percent = _nan_if_zero(pnl * 100, costs)
+    weights = _nan_if_zero(known_values, total_value[:, None])
+
+    # Стоимость портфелей по дням считается по позициям, у которых есть
+    # история в окне: одна позиция без истории не должна обнулять
+    # волатильность и просадку всего портфеля. День не учитывается, если у
+    # пользователя есть такая позиция без цены на этот день (до ее первого
+    # закрытия в окне)
+    missing = np.isnan(closes)
+    has_history = ~missing.all(axis=0) if days else np.zeros(len(assets), dtype=bool)
+    tracked = held & has_history
+    incomplete = (missing.astype(np.intp) @ tracked.T.astype(np.intp)) > 0
+    incomplete |= ~tracked.any(axis=1)
+    series = np.where(missing, 0.0, closes) @ np.where(tracked, quantities, 0.0).T
+    series[incomplete] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = series[1:] / series[:-1] - 1
+    observed = ~np.isnan(returns)
+    observations = observed.sum(axis=0)
+    mean = _nan_if_zero(np.where(observed, returns, 0.0).sum(axis=0), observations)
+    squares = np.where(observed, (returns - mean) ** 2, 0.0).sum(axis=0)
+    volatility = _nan_if_zero(squares, observations - 1) ** 0.5
+    volatility[observations < 2] = np.nan
+
+    peaks = np.fmax.accumulate(series, axis=0) if days else series
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdowns = series / peaks - 1
+    max_drawdown = -np.fmin.reduce(drawdowns, axis=0) if days else np.full(len(users), np.nan)
+
+    results = {}
+    for i, user_id in enumerate(users):
+        columns = held[i]
+        results[user_id] = PortfolioAnalytics(
+            symbols=[symbol for (symbol, _), is_held in zip(assets, columns) if is_held],
+            kinds=[kind for (_, kind), is_held in zip(assets, columns) if is_held],
+            quantities=quantities[i, columns],
+            prices=last[columns],
+            cost=costs[i, columns],
+            value=np.where(priced[i, columns], values[i, columns], np.nan),
+            pnl=np.where(priced[i, columns], pnl[i, columns], np.nan),
+            pnl_percent=np.where(priced[i, columns], pnl_percent[i, columns], np.nan),
+            weights=weights[i, columns],
+            total_cost=total_cost[i],
+            total_value=total_value[i],
+            total_pnl=total_pnl[i],
+            total_pnl_percent=total_pnl[i] / total_cost[i] * 100 if total_cost[i] else None,
+            days=days,
+            series=series[:, i],
+            returns=returns[:, i],
+            volatility=volatility[i],
+            annualized_volatility=volatility[i] * TRADING_DAYS ** 0.5,
+            max_drawdown=max_drawdown[i],
+            excluded=[symbol for (symbol, _), is_excluded in zip(assets, held[i] & ~tracked[i]) if is_excluded],
+        )
+    return results
+
+
+def _percent(value):
+    return "нет данных" if value is None or np.isnan(value) else f"{value * 100:.2f}%"
+
+
+def format_analytics(analytics):
+    lines = ["Аналитика портфеля:"]
+    for symbol, kind, weight, pnl, pnl_percent in zip(
+            analytics.symbols, analytics.kinds, analytics.weights, analytics.pnl, analytics.pnl_percent):
+        if kind is None:
+            lines.append(f"{symbol}: вид актива не указан")
+        elif np.isnan(pnl):
+            lines.append(f"{symbol}: цена неизвестна")
+        else:
+            lines.append(f"{symbol}: доля {weight * 100:.1f}%, P&L {pnl:+.2f} ({pnl_percent:+.2f}%)")
+
+    lines.append("")
+    lines.append(f"Стоимость: {analytics.total_value:.2f}, вложено: {analytics.total_cost:.2f}")
+    if analytics.total_pnl_percent is not None:
+        lines.append(f"Итоговый P&L: {analytics.total_pnl:+.2f} ({analytics.total_pnl_percent:+.2f}%)")
+    lines.append(f"Дневная волатильность: {_percent(analytics.volatility)}, годовая: {_percent(analytics.annualized_volatility)}")
+    lines.append(f"Максимальная просадка за {len(analytics.days)} дн.: {_percent(analytics.max_drawdown)}")
+    if analytics.excluded:
+        lines.append(f"Без истории цен, не учтены в волатильности и просадке: {', '.join(analytics.excluded)}")
+    return "\n".join(lines)
+
+
+# Аналитика портфеля пользователя по позициям и сохраненной истории цен
+# закрытия за window_days. История недостающих символов догружается через
+# PriceHistory
+class PortfolioAnalyzer:
+    def __init__(self, async_db, price_history, window_days=30):
+        self.async_db = async_db
+        self.price_history = price_history
+        self.window_days = window_days
+
+    def _since(self):
+        return self.price_history.today() - timedelta(days=self.window_days)
+
+    async def _sync(self, provider, symbols):
+        results = await asyncio.gather(
+            *(self.price_history.sync(provider, symbol) for symbol in symbols), return_exceptions=True)
+        for symbol, result in zip(symbols, results):
+            if isinstance(result, Exception):
+                logger.warning("Не удалось загрузить историю %s %s: %s", provider, symbol, result)
+
+    # Догружает историю каждой позиции у поставщика ее вида актива
+    async def _user_history(self, user_id, positions):
+        symbols = {}
+        for row in positions:
+            provider = HISTORY_PROVIDERS.get(row[4])
+            if provider is not None:
+                symbols.setdefault(provider, []).append(row[1])
+        await asyncio.gather(*(self._sync(provider, provider_symbols) for provider, provider_symbols in symbols.items()))
+        return await self.async_db.read(select_position_history, self._since(), user_id)
+
+    # Возвращает None, если портфель пуст
+    async def analyze_user(self, user_id, prices=None):
+        positions = await self.async_db.read(select_positions, user_id)
+        if not positions:
+            return None
+        history = await self._user_history(user_id, positions)
+        return analyze_portfolios(positions, history, prices)[user_id]
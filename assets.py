@@ -0,0 +1,33 @@
+# Виды активов: валюта ЦБ, криптовалюта (котировки Alpha Vantage)
+# и акция (Yahoo Finance)
+CURRENCY = 'currency'
+CRYPTO = 'crypto'
+STOCK = 'stock'
+
+# Виды позиций портфеля
+POSITION_KINDS = (STOCK, CRYPTO)
+
+KIND_NAMES = {CURRENCY: 'валюта', CRYPTO: 'криптовалюта', STOCK: 'акция'}
+KIND_ALIASES = {
+    'currency': CURRENCY, 'валюта': CURRENCY,
+    'crypto': CRYPTO, 'криптовалюта': CRYPTO, 'крипто': CRYPTO,
+    'stock': STOCK, 'акция': STOCK, 'акции': STOCK,
+}
+
+# Распространенные криптовалюты. Многие из этих кодов - еще и биржевые
+# тикеры (BTC и ETH - фонды на бирже), поэтому, когда вид не указан,
+# такие коды считаются криптовалютой, а не акцией
+KNOWN_CRYPTO = frozenset({
+    'BTC', 'ETH', 'USDT', 'USDC', 'BNB', 'SOL', 'XRP', 'ADA', 'DOGE', 'TRX', 'TON', 'DOT',
+    'LTC', 'BCH', 'LINK', 'XLM', 'AVAX', 'SHIB', 'ATOM', 'XMR', 'ETC', 'NEAR', 'UNI',
+})
+
+
+# Вид актива по слову пользователя ("crypto", "акция") или None
+def parse_kind(text):
+    return KIND_ALIASES.get((text or '').strip().lower())
+
+
+# Вид котировки кода, для которого пользователь вид не указал
+def quote_kind(symbol):
+    return CRYPTO if symbol in KNOWN_CRYPTO else STOCK
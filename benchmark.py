@@ -0,0 +1,293 @@
+# Нагрузочный тест обработчиков бота без сети: тысячи синтетических
+# пользователей проходят регистрацию, добавление актива, запросы курсов и
+# котировок и просмотр портфеля через настоящие обработчики main.py.
+# Bot API, Банк России, Alpha Vantage и Yahoo заменены локальными
+# заглушками с настраиваемой задержкой.
+#
+#   python benchmark.py --users 2000 --concurrency 200 --provider-latency-ms 50
+#
+# Итог - пропускная способность и задержки p50/p95/p99 по каждому обработчику
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone
+
+from aiohttp import web
+
+STOCKS = ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'TSLA', 'NVDA', 'META', 'NFLX']
+CRYPTO = ['BTC', 'ETH', 'SOL', 'XRP', 'DOGE']
+CURRENCIES = ['USD', 'EUR', 'CNY', 'GBP', 'JPY']
+
+# Сценарий одного пользователя: (обработчик, текст сообщения)
+SCENARIO = [
+    ('send_welcome', '/start'),
+    ('register_user', 'Регистрация'),
+    ('portfolio_menu', 'Мой портфель'),
+    ('add_stock_prompt', 'Добавить актив'),
+    ('process_stock_name', '{stock}'),
+    ('process_asset_kind', 'Акция'),
+    ('process_quantity', '10'),
+    ('process_price', '150.5'),
+    ('exchange_rate_prompt', 'Курс валют'),
+    ('process_currency_code', '{currency}'),
+    ('crypto_prompt', 'Криптовалюта'),
+    ('process_crypto_code', '{crypto}'),
+    ('stock_prompt', 'Биржа'),
+    ('process_stock_symbol', '{stock}'),
+    ('show_portfolio', 'Мои активы'),
+]
+
+
+# Детерминированная цена символа, чтобы ответы не зависели от запуска
+def stub_price(symbol, day=None):
+    base = 10 + zlib.crc32(symbol.encode()) % 990
+    if day is not None:
+        base += day.toordinal() % 7
+    return float(base)
+
+
+# Заглушки Bot API, Банка России, Alpha Vantage и Yahoo в одном приложении aiohttp
+class StubServers:
+    def __init__(self, provider_latency=0.0, telegram_latency=0.0):
+        self.provider_latency = provider_latency
+        self.telegram_latency = telegram_latency
+        self.calls = {'telegram': 0, 'cbr': 0, 'alpha_vantage': 0, 'yahoo': 0}
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.base_url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.telegram)
+        app.router.add_get('/cbr', self.cbr)
+        app.router.add_get('/av', self.alpha_vantage)
+        app.router.add_get('/yahoo/{symbol}', self.yahoo)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def telegram(self, request):
+        self.calls['telegram'] += 1
+        if self.telegram_latency:
+            await asyncio.sleep(self.telegram_latency)
+        data = await request.post()
+        chat_id = int(data.get('chat_id', 0))
+        result = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': data.get('text', ''),
+        }
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _provider_delay(self, name):
+        self.calls[name] += 1
+        if self.provider_latency:
+            await asyncio.sleep(self.provider_latency)
+
+    async def cbr(self, request):
+        await self._provider_delay('cbr')
+        day = datetime.strptime(request.query['date_req'], '%d/%m/%Y').date()
+        valutes = ''.join(
+            f'<Valute><CharCode>{code}</CharCode><Nominal>1</Nominal>'
+            f'<Value>{stub_price(code, day):.4f}</Value></Valute>'.replace('.', ',')
+            for code in CURRENCIES
+        )
+        return web.Response(text=f'<ValCurs Date="{day:%d.%m.%Y}">{valutes}</ValCurs>', content_type='application/xml')
+
+    async def alpha_vantage(self, request):
+        await self._provider_delay('alpha_vantage')
+        function = request.query.get('function')
+        if function == 'CURRENCY_EXCHANGE_RATE':
+            symbol = request.query['from_currency']
+            return web.json_response({'Realtime Currency Exchange Rate': {'5. Exchange Rate': str(stub_price(symbol))}})
+        if function == 'DIGITAL_CURRENCY_DAILY':
+            symbol = request.query['symbol']
+            today = date.today()
+            series = {
+                (today - timedelta(days=days)).isoformat(): {'4. close': str(stub_price(symbol, today - timedelta(days=days)))}
+                for days in range(60)
+            }
+            return web.json_response({'Time Series (Digital Currency Daily)': series})
+        return web.json_response({'Error Message': 'Invalid API call'})
+
+    async def yahoo(self, request):
+        await self._provider_delay('yahoo')
+        symbol = request.match_info['symbol']
+        today = datetime.now(timezone.utc).date()
+        days = [today - timedelta(days=days) for days in range(60, -1, -1)]
+        result = {
+            'meta': {'regularMarketPrice': stub_price(symbol), 'gmtoffset': 0},
+            'timestamp': [int(datetime(day.year, day.month, day.day, 14, tzinfo=timezone.utc).timestamp()) for day in days],
+            'indicators': {'quote': [{'close': [stub_price(symbol, day) for day in days]}]},
+        }
+        return web.json_response({'chart': {'result': [result], 'error': None}})
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, elapsed):
+    report = {}
+    for handler, values in latencies.items():
+        values = sorted(values)
+        report[handler] = {
+            'count': len(values),
+            'throughput': len(values) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000 if values else 0.0,
+        }
+    return report
+
+
+def format_report(report, total, elapsed, errors, calls):
+    lines = [
+        f"{'handler':<24}{'count':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    for handler, _ in SCENARIO:
+        row = report.get(handler)
+        if row is None:
+            continue
+        lines.append(
+            f"{handler:<24}{row['count']:>8}{row['throughput']:>10.1f}{row['p50_ms']:>10.2f}"
+            f"{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['max_ms']:>10.2f}"
+        )
+    lines.append(f"\nupdates: {total}, errors: {errors}, elapsed: {elapsed:.2f} s, throughput: {total / elapsed:.1f} updates/s")
+    lines.append("upstream calls: " + ", ".join(f"{name}={count}" for name, count in calls.items()))
+    return '\n'.join(lines)
+
+
+# Настройки бота для прогона задаются до импорта main, который читает их при загрузке
+def configure_environment(args, stubs, workdir):
+    os.environ.update({
+        'API_TOKEN': '123456:BENCHMARK',
+        'ALPHA_VANTAGE_API_KEY': 'benchmark',
+        'TELEGRAM_API_URL': stubs.base_url,
+        'CBR_URL': stubs.base_url + '/cbr',
+        'ALPHA_VANTAGE_URL': stubs.base_url + '/av',
+        'YAHOO_CHART_URL': stubs.base_url + '/yahoo/{symbol}',
+        'DATABASE_NAME': os.path.join(workdir, 'benchmark.db'),
+        'FSM_STORAGE': args.fsm_storage,
+        'QUOTE_CACHE_TTL': str(args.quote_ttl),
+        # Квоты внешних сервисов не относятся к измеряемой задержке обработчиков
+        'ALPHA_VANTAGE_CALLS_PER_MINUTE': '0',
+        'ALPHA_VANTAGE_CALLS_PER_DAY': '0',
+        'SEND_GLOBAL_RATE': str(args.send_rate),
+        'SEND_CHAT_RATE': str(args.send_rate),
+        'SEND_CHAT_BURST': str(args.send_rate),
+        'PREFETCH_INTERVAL': '0',
+        'ALERT_CHECK_INTERVAL': '0',
+    })
+
+
+async def run_user(main, index, latencies, errors):
+    from aiogram import types
+
+    telegram_id = 10_000_000 + index
+    values = {
+        'stock': STOCKS[index % len(STOCKS)],
+        'crypto': CRYPTO[index % len(CRYPTO)],
+        'currency': CURRENCIES[index % len(CURRENCIES)],
+    }
+    for step, (handler, text) in enumerate(SCENARIO):
+        text = text.format(**values)
+        message = {
+            'message_id': step + 1,
+            'date': int(time.time()),
+            'text': text,
+            'chat': {'id': telegram_id, 'type': 'private'},
+            'from': {'id': telegram_id, 'is_bot': False, 'first_name': f'User{index}', 'username': f'user{index}'},
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        update = types.Update.to_object({'update_id': index * len(SCENARIO) + step, 'message': message})
+
+        started = time.perf_counter()
+        try:
+            # Как и при polling, каждое обновление обрабатывается в своей задаче:
+            # фильтры aiogram кэшируют состояние FSM в контексте задачи
+            await asyncio.ensure_future(main.dp.process_update(update))
+        except Exception:
+            errors.append(handler)
+            continue
+        latencies.setdefault(handler, []).append(time.perf_counter() - started)
+
+
+async def run(args):
+    stubs = StubServers(args.provider_latency_ms / 1000, args.telegram_latency_ms / 1000)
+    await stubs.start()
+    workdir = tempfile.mkdtemp(prefix='finance-bot-benchmark-')
+    configure_environment(args, stubs, workdir)
+
+    import main
+    from aiogram import Bot, Dispatcher
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+
+    latencies = {}
+    errors = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            await run_user(main, index, latencies, errors)
+
+    try:
+        # База создается в on_startup, как и при обычном запуске бота
+        await main.on_startup(main.dp)
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(index) for index in range(args.users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await main.on_shutdown(main.dp)
+        await (await main.bot.get_session()).close()
+        await stubs.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = summarize(latencies, elapsed)
+    total = sum(len(values) for values in latencies.values()) + len(errors)
+    print(format_report(report, total, elapsed, len(errors), stubs.calls))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'elapsed': elapsed, 'errors': len(errors), 'handlers': report, 'calls': stubs.calls}, f, indent=2)
+    return 1 if errors else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков финансового бота")
+    parser.add_argument('--users', type=int, default=1000, help="число синтетических пользователей")
+    parser.add_argument('--concurrency', type=int, default=100, help="сколько пользователей работают одновременно")
+    parser.add_argument('--provider-latency-ms', type=float, default=50, help="задержка заглушек ЦБ, Alpha Vantage и Yahoo")
+    parser.add_argument('--telegram-latency-ms', type=float, default=20, help="задержка заглушки Bot API")
+    parser.add_argument('--quote-ttl', type=int, default=60, help="QUOTE_CACHE_TTL бота, 0 - без кэша котировок")
+    parser.add_argument('--send-rate', type=float, default=100000, help="лимит исходящих сообщений в секунду")
+    parser.add_argument('--fsm-storage', default='sqlite', choices=['sqlite', 'memory'])
+    parser.add_argument('--json', help="сохранить результаты в JSON для сравнения прогонов")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(run(parse_args())))
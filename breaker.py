@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Значения состояний для метрик
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Источник {name} временно недоступен, повтор через {retry_after:.0f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Предохранитель поставщика. Каждый запрос ограничен сроком deadline;
+# по последним window запросам считается доля ошибок, и при failure_rate
+# (но не раньше min_calls запросов) предохранитель размыкается: следующие
+# open_seconds секунд запросы сразу получают CircuitOpenError, не дожидаясь
+# таймаута. Затем один пробный запрос проверяет поставщика: успех замыкает
+# предохранитель, ошибка размыкает его снова.
+# is_failure(e) - считать ли исключение отказом поставщика (404 - не отказ)
+class CircuitBreaker:
+    def __init__(self, name, deadline=5.0, failure_rate=0.5, window=20, min_calls=5, open_seconds=30,
+                 is_failure=None, clock=time.monotonic):
+        self.name = name
+        self.deadline = deadline
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.is_failure = is_failure
+        self.clock = clock
+        self.state = CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = None
+        self._probing = False
+
+    def _retry_after(self):
+        return max(self._opened_at + self.open_seconds - self.clock(), 0.0)
+
+    # Можно ли выполнить запрос сейчас; в полуоткрытом состоянии - только один
+    def allow(self):
+        if self.state == OPEN:
+            if self._retry_after() > 0:
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        self._probing = False
+        self.opened += 1
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self._probing = False
+            self._outcomes.clear()
+            return
+        self._outcomes.append(False)
+
+    def record_failure(self):
+        if self.state == HALF_OPEN:
+            self._open()
+            return
+        self._outcomes.append(True)
+        if len(self._outcomes) >= self.min_calls and self.current_failure_rate >= self.failure_rate:
+            self._open()
+
+    # Запрос отменил вызывающий: о поставщике ничего не известно
+    def _release(self):
+        self._probing = False
+
+    @property
+    def current_failure_rate(self):
+        return sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0
+
+    async def call(self, fn, *args):
+        if not self.allow():
+            self.rejected += 1
+            raise CircuitOpenError(self.name, self._retry_after() if self._opened_at is not None else 0.0)
+        try:
+            result = await asyncio.wait_for(fn(*args), self.deadline)
+        except asyncio.TimeoutError:
+            self.record_failure()
+            raise asyncio.TimeoutError(f"Источник {self.name} не ответил за {self.deadline:g} с") from None
+        except asyncio.CancelledError:
+            self._release()
+            raise
+        except Exception as e:
+            if self.is_failure is None or self.is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
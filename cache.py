@@ -0,0 +1,96 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+# LRU-кэш с ограничением размера и необязательным сроком жизни записей
+class LRUCache:
+    def __init__(self, maxsize=128, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self.clock():
+            # Просроченная запись считается промахом, но остается доступной
+            # через get_stale, пока ее не вытеснят или не перезапишут
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    # ttl=None означает, что запись не устаревает и вытесняется только по LRU
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else self.clock() + ttl
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    # Значение без учета срока жизни - запасной вариант, когда обновить нельзя
+    def get_stale(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    # Сколько секунд осталось жить записи: None - записи нет, inf - бессрочная
+    def expires_in(self, key):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return None
+        expires_at = entry[1]
+        return float('inf') if expires_at is None else max(expires_at - self.clock(), 0.0)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Объединение одинаковых одновременных запросов: пока запрос по ключу
+# выполняется, остальные вызывающие ждут тот же результат или ту же ошибку
+class SingleFlight:
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = {}
+
+    async def do(self, key, fn, *args):
+        future = self._in_flight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn(*args))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            future.exception()
+
+    def __len__(self):
+        return len(self._in_flight)
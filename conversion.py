@@ -0,0 +1,114 @@
+import re
+
+RUB = 'RUB'
+USD = 'USD'
+
+# Сколько кодов можно запросить одним сообщением и сколько из них - не
+# валют ЦБ: каждый такой код - запрос к Yahoo Finance или Alpha Vantage
+MAX_CODES = 20
+MAX_QUOTE_CODES = 5
+
+# "EUR/USD", "BTC -> RUB", "100 EUR в USD", "10 AAPL to RUB"
+CONVERSION_PATTERN = re.compile(
+    r'^\s*(?:(\d+(?:[.,]\d+)?)\s+)?([A-Za-z0-9.\-^=]+)\s*(?:/|->|→|\s+(?:в|in|to)\s+)\s*([A-Za-z0-9.\-^=]+)\s*$',
+    re.IGNORECASE,
+)
+CODE_SEPARATOR = re.compile(r'[\s,;]+')
+# Код валюты, криптовалюты или тикер: латиница, начинается с буквы
+CODE_PATTERN = re.compile(r'^[A-Z][A-Z0-9.\-^=]{1,9}$')
+
+
+def is_code(code):
+    return CODE_PATTERN.match(code) is not None
+
+
+# Разбор запроса на пересчет: (сумма, из чего, во что) или None
+def parse_conversion(text):
+    match = CONVERSION_PATTERN.match(text or '')
+    if match is None:
+        return None
+    amount, source, target = match.groups()
+    source, target = source.upper(), target.upper()
+    if not (is_code(source) and is_code(target)):
+        return None
+    amount = float(amount.replace(',', '.')) if amount else 1.0
+    return amount, source, target
+
+
+# Коды из "USD EUR, CNY" без повторов, в порядке запроса, или None, если
+# хоть одно слово - не код ("Возврат в главное меню", "100", опечатки)
+def parse_codes(text):
+    codes = [code.upper() for code in CODE_SEPARATOR.split(text or '') if code]
+    if not all(is_code(code) for code in codes):
+        return None
+    return list(dict.fromkeys(codes))[:MAX_CODES]
+
+
+# Кросс-курсы по одному снимку ЦБ: валюта ЦБ оценивается в рублях по
+# снимку, криптовалюта или акция - по котировке в USD и курсу USD из того
+# же снимка. Любая пара считается через рубли без запросов к поставщикам.
+# usd_quotes: код -> цена в USD (None - котировки нет)
+class CrossRates:
+    def __init__(self, snapshot, usd_quotes=None):
+        self.snapshot = snapshot
+        self.usd_quotes = usd_quotes or {}
+
+    # Коды, для которых нужна котировка в USD
+    def quote_codes(self, codes):
+        return [code for code in codes if code != RUB and code not in self.snapshot]
+
+    def rub_price(self, code):
+        if code == RUB:
+            return 1.0
+        rate = self.snapshot.get(code)
+        if rate is not None:
+            return rate
+        quote = self.usd_quotes.get(code)
+        usd_rate = self.snapshot.get(USD)
+        if quote is None or usd_rate is None:
+            return None
+        return quote * usd_rate
+
+    # Стоимость amount единиц source в единицах target или None
+    def convert(self, amount, source, target):
+        source_price = self.rub_price(source)
+        target_price = self.rub_price(target)
+        if source_price is None or not target_price:
+            return None
+        return amount * source_price / target_price
+
+
+def _format_amount(value):
+    return f"{value:.2f}" if abs(value) >= 1 else f"{value:.6g}"
+
+
+def format_conversion(cross_rates, amount, source, target):
+    value = cross_rates.convert(amount, source, target)
+    if value is None:
+        unknown = [code for code in (source, target) if cross_rates.rub_price(code) is None]
+        return f"Не удалось получить курс для: {', '.join(unknown) or target}"
+    rate = cross_rates.convert(1, source, target)
+    return f"{_format_amount(amount)} {source} = {_format_amount(value)} {target} (1 {source} = {_format_amount(rate)} {target})"
+
+
+# Цены кодов в рублях по сегодняшнему снимку и изменение к вчерашнему
+# (для валют ЦБ); previous - CrossRates по вчерашнему снимку
+def format_rub_prices(codes, current, previous=None):
+    lines = []
+    unknown = []
+    for code in codes:
+        price = current.rub_price(code)
+        if price is None:
+            unknown.append(code)
+            continue
+        line = f"{code}: {_format_amount(price)} руб."
+        quote = current.usd_quotes.get(code)
+        if quote is not None and code not in current.snapshot:
+            line += f" ({_format_amount(quote)} USD)"
+        previous_price = previous.rub_price(code) if previous is not None and code in current.snapshot else None
+        if previous_price:
+            line += f", за день {(price - previous_price) / previous_price * 100:+.2f}%"
+        lines.append(line)
+    if unknown:
+        lines.append(f"Не удалось получить курс для: {', '.join(unknown)}")
+    return "\n".join(lines)
@@ -0,0 +1,192 @@
+import os
+import queue
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+# Долгоживущие соединения с SQLite: одно соединение на запись под блокировкой
+# и по одному соединению на чтение в каждом потоке. В режиме WAL читатели
+# не блокируют писателя, а кэш подготовленных запросов живет вместе с соединением
+class Database:
+    def __init__(self, path, synchronous='NORMAL', cache_size=-8000, busy_timeout=5000, cached_statements=256):
+        self.path = path
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._write_lock = threading.RLock()
+        self._connections_lock = threading.Lock()
+        self._connections = []
+        self._writer = None
+        self._local = threading.local()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(f'PRAGMA synchronous={self.synchronous}')
+        connection.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        connection.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+
+        with self._connections_lock:
+            self._connections.append(connection)
+        return connection
+
+    def _reader(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    # Транзакция на запись: commit при успехе, rollback при ошибке
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            connection = self._writer
+            cursor = connection.cursor()
+            try:
+                yield cursor
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def read(self):
+        cursor = self._reader().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def close(self):
+        with self._write_lock, self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._writer = None
+            # Потоковые соединения пересоздадутся при следующем обращении
+            self._local = threading.local()
+
+
+def _resolve_future(future, ok, value):
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+# Асинхронный доступ к базе: чтение выполняется в пуле потоков, запись - в
+# отдельном потоке-писателе, который объединяет накопившиеся мелкие записи
+# в одну транзакцию (каждая в своем SAVEPOINT, чтобы ошибка одной не
+# откатывала остальные)
+class AsyncDatabase:
+    def __init__(self, database, read_workers=4, max_batch=64):
+        self.database = database
+        self.read_workers = read_workers
+        self.max_batch = max_batch
+        self.transactions = 0
+        self._queue = queue.Queue()
+        self._read_pool = None
+        self._writer_thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._read_pool is None:
+                self._read_pool = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix='db-read')
+            if self._writer_thread is None:
+                self._writer_thread = threading.Thread(target=self._writer_loop, name='db-write', daemon=True)
+                self._writer_thread.start()
+
+    async def read(self, fn, *args):
+        self._start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, self._run_read, fn, args)
+
+    def _run_read(self, fn, args):
+        with self.database.read() as cursor:
+            return fn(cursor, *args)
+
+    async def write(self, fn, *args):
+        self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, args, future, loop))
+        return await future
+
+    def _writer_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            batch = [job]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _run_batch(self, batch):
+        results = []
+        try:
+            with self.database.write() as cursor:
+                # IMMEDIATE сразу берет блокировку записи: если базу пишет другой
+                # процесс бота, ожидание идет по busy_timeout, а не падает
+                # ошибкой при попытке повысить блокировку посреди транзакции
+                cursor.execute('BEGIN IMMEDIATE')
+                for fn, args, future, loop in batch:
+                    cursor.execute('SAVEPOINT job')
+                    try:
+                        result = fn(cursor, *args)
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO SAVEPOINT job')
+                        results.append((False, e))
+                    else:
+                        results.append((True, result))
+                    cursor.execute('RELEASE SAVEPOINT job')
+            self.transactions += 1
+        except Exception as e:
+            # Не удалось зафиксировать транзакцию - ошибка у всех участников
+            results = [(False, e)] * len(batch)
+
+        for (fn, args, future, loop), (ok, value) in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve_future, future, ok, value)
+
+    def close(self):
+        with self._start_lock:
+            if self._writer_thread is not None:
+                self._queue.put(None)
+                self._writer_thread.join()
+                self._writer_thread = None
+            if self._read_pool is not None:
+                self._read_pool.shutdown(wait=True)
+                self._read_pool = None
@@ -0,0 +1,343 @@
+import abc
+import asyncio
+import copy
+import json
+import logging
+import time
+import typing
+from urllib.parse import urlparse
+
+from aiogram.dispatcher.storage import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+
+def _empty_record():
+    return {'state': None, 'data': {}, 'bucket': {}}
+
+
+# Общая часть хранилищ состояний FSM. Изменения копятся в памяти и
+# записываются пачкой раз в flush_interval секунд (0 - сразу), чтение
+# сначала смотрит в еще не записанные изменения. Записи, которые не
+# обновлялись ttl секунд, считаются брошенными и удаляются. Наследник
+# реализует _read и _write, иначе его экземпляр не создать
+class BatchingStorage(BaseStorage, metaclass=abc.ABCMeta):
+    def __init__(self, ttl=86400, flush_interval=0.05):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self._pending = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    # Чтение записи из хранилища: словарь или None
+    @abc.abstractmethod
+    async def _read(self, key):
+        pass
+
+    # Запись пачки {key: запись или None для удаления}
+    @abc.abstractmethod
+    async def _write(self, records):
+        pass
+
+    async def _close_backend(self):
+        pass
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return f"{chat}:{user}"
+
+    async def _get_record(self, chat, user):
+        key = self._key(chat, user)
+        if key in self._pending:
+            record = self._pending[key]
+        elif key in self._flushing:
+            record = self._flushing[key]
+        else:
+            record = await self._read(key)
+        return key, copy.deepcopy(record) if record else _empty_record()
+
+    async def _put_record(self, key, record):
+        self._pending[key] = None if record == _empty_record() else record
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Не удалось сохранить состояния FSM")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                await self._write(self._flushing)
+            except Exception:
+                # Возвращаем несохраненное, не затирая более свежие изменения
+                for key, record in self._flushing.items():
+                    self._pending.setdefault(key, record)
+                if self._flush_task is None and self.flush_interval > 0:
+                    self._flush_task = asyncio.ensure_future(self._delayed_flush())
+                raise
+            finally:
+                self._flushing = {}
+            self.flushes += 1
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self._close_backend()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get_record(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get_record(chat, user)
+        return record['data'] or copy.deepcopy(default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._get_record(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._put_record(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get_record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        await self._put_record(key, record)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        await self._put_record(key, record)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, record = await self._get_record(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        await self._put_record(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get_record(chat, user)
+        return record['bucket'] or copy.deepcopy(default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get_record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        await self._put_record(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = await self._get_record(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        await self._put_record(key, record)
+
+
+def select_fsm_record(cursor, key, now):
+    cursor.execute('''
+    SELECT record FROM fsm_state WHERE key = ? AND expires_at > ?
+    ''', (key, now))
+
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def write_fsm_records(cursor, records, expires_at, now):
+    cursor.executemany('''
+    INSERT OR REPLACE INTO fsm_state (key, record, expires_at) VALUES (?, ?, ?)
+    ''', [(key, json.dumps(record), expires_at) for key, record in records.items() if record is not None])
+    cursor.executemany('''
+    DELETE FROM fsm_state WHERE key = ?
+    ''', [(key,) for key, record in records.items() if record is None])
+    # Заодно убираем брошенные диалоги
+    cursor.execute('''
+    DELETE FROM fsm_state WHERE expires_at <= ?
+    ''', (now,))
+
+
+# Состояния FSM в таблице fsm_state общей базы SQLite. Переживают перезапуск
+# и видны всем процессам бота, работающим с этим файлом
+class SqliteStorage(BatchingStorage):
+    def __init__(self, async_db, ttl=86400, flush_interval=0.05, clock=time.time):
+        super().__init__(ttl=ttl, flush_interval=flush_interval)
+        self.async_db = async_db
+        self.clock = clock
+
+    async def _read(self, key):
+        return await self.async_db.read(select_fsm_record, key, self.clock())
+
+    async def _write(self, records):
+        now = self.clock()
+        await self.async_db.write(write_fsm_records, dict(records), now + self.ttl, now)
+
+
+class RedisError(Exception):
+    pass
+
+
+# Минимальный клиент протокола Redis (RESP2) на asyncio: одно соединение,
+# команды пачки отправляются конвейером без ожидания ответов по одной
+class RedisClient:
+    def __init__(self, host='localhost', port=6379, db=0, password=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip('/') or 0)
+        return cls(parsed.hostname or 'localhost', parsed.port or 6379, db, parsed.password)
+
+    @staticmethod
+    def _encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            return RedisError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Неизвестный ответ Redis: {line!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            await self._send(setup)
+
+    async def _send(self, commands):
+        self._writer.write(b''.join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def pipeline(self, commands):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._send(commands)
+            except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                # Следующая команда откроет соединение заново
+                await self._disconnect()
+                raise
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._reader = self._writer = None
+
+    async def close(self):
+        async with self._lock:
+            await self._disconnect()
+
+
+# Состояния FSM в Redis: одна JSON-запись на пользователя со сроком жизни ttl.
+# Несколько процессов бота с одним Redis обслуживают одних и тех же пользователей
+class RedisStorage(BatchingStorage):
+    def __init__(self, client, prefix='fsm', ttl=86400, flush_interval=0.05):
+        super().__init__(ttl=ttl, flush_interval=flush_interval)
+        self.client = client
+        self.prefix = prefix
+
+    def _redis_key(self, key):
+        return f"{self.prefix}:{key}"
+
+    async def _read(self, key):
+        value = await self.client.execute('GET', self._redis_key(key))
+        return json.loads(value) if value else None
+
+    async def _write(self, records):
+        commands = []
+        for key, record in records.items():
+            if record is None:
+                commands.append(('DEL', self._redis_key(key)))
+            else:
+                commands.append(('SET', self._redis_key(key), json.dumps(record), 'EX', int(self.ttl)))
+        await self.client.pipeline(commands)
+
+    async def _close_backend(self):
+        await self.client.close()
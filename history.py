@@ -0,0 +1,98 @@
+import logging
+from datetime import date, timedelta
+
+from cache import LRUCache, SingleFlight
+
+# Имена поставщиков в таблице price_history
+ALPHA_VANTAGE = 'alpha_vantage'
+YAHOO = 'yahoo'
+
+logger = logging.getLogger(__name__)
+
+
+def select_last_day(cursor, provider, symbol):
+    cursor.execute('''
+    SELECT MAX(day) FROM price_history WHERE provider = ? AND symbol = ?
+    ''', (provider, symbol))
+
+    day = cursor.fetchone()[0]
+    return date.fromisoformat(day) if day else None
+
+
+def insert_closes(cursor, provider, symbol, closes):
+    cursor.executemany('''
+    INSERT OR REPLACE INTO price_history (provider, symbol, day, close) VALUES (?, ?, ?, ?)
+    ''', [(provider, symbol, day.isoformat(), close) for day, close in closes])
+
+
+# Последняя цена закрытия строго до указанного дня (в выходные это пятница):
+# (день, цена) или None
+def select_close_before(cursor, provider, symbol, day):
+    cursor.execute('''
+    SELECT day, close FROM price_history
+    WHERE provider = ? AND symbol = ? AND day < ?
+    ORDER BY day DESC LIMIT 1
+    ''', (provider, symbol, day.isoformat()))
+
+    row = cursor.fetchone()
+    return (date.fromisoformat(row[0]), row[1]) if row else None
+
+
+# Локальное хранилище дневных цен закрытия. Из сети догружаются только
+# дни после последнего сохраненного, и не чаще одного раза в сутки на символ
+class PriceHistory:
+    def __init__(self, async_db, provider, backfill_days=30, today=date.today, synced_cache_size=10000):
+        self.async_db = async_db
+        self.provider = provider
+        self.backfill_days = backfill_days
+        self.today = today
+        self._synced = LRUCache(maxsize=synced_cache_size)
+        self._flight = SingleFlight()
+
+    def _fetch(self, provider, symbol, since):
+        if provider == ALPHA_VANTAGE:
+            return self.provider.get_crypto_history(symbol, since)
+        if provider == YAHOO:
+            return self.provider.get_stock_history(symbol, since)
+        raise ValueError(f"Неизвестный поставщик истории цен: {provider}")
+
+    # Догружает недостающие закрытые дни до вчерашнего включительно
+    async def sync(self, provider, symbol):
+        today = self.today()
+        if self._synced.get((provider, symbol)) == today:
+            return
+        await self._flight.do((provider, symbol, today), self._sync, provider, symbol, today)
+
+    async def _sync(self, provider, symbol, today):
+        last_day = await self.async_db.read(select_last_day, provider, symbol)
+        if last_day is None:
+            since = today - timedelta(days=self.backfill_days)
+        else:
+            since = last_day + timedelta(days=1)
+
+        if since < today:
+            closes = await self._fetch(provider, symbol, since)
+            # Сегодняшняя цена еще не закрытие - ее не сохраняем
+            closes = [(day, close) for day, close in closes if since <= day < today]
+            if closes:
+                await self.async_db.write(insert_closes, provider, symbol, closes)
+        self._synced.set((provider, symbol), today)
+
+    # Если поставщик недоступен, ответ строится по уже сохраненной истории,
+    # а догрузка повторится при следующем запросе
+    async def _close_before(self, provider, symbol, days):
+        try:
+            await self.sync(provider, symbol)
+        except Exception as e:
+            logger.warning("История %s %s не обновлена: %s", provider, symbol, e)
+        day = self.today() - timedelta(days=days - 1)
+        return await self.async_db.read(select_close_before, provider, symbol, day)
+
+    async def close_days_ago(self, provider, symbol, days):
+        row = await self._close_before(provider, symbol, days)
+        return row[1] if row else None
+
+    # Последнее закрытие до сегодняшнего дня: (день, цена) или None. После
+    # выходных и праздников это не вчерашний день
+    async def previous_close(self, provider, symbol):
+        return await self._close_before(provider, symbol, 1)
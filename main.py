@@ -1,172 +1,392 @@
+import io
 import os
-import sqlite3
-import requests
+import asyncio
+import functools
 from dotenv import load_dotenv
-from yahoo_fin import stock_info as si
-import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.utils import executor
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InputFile
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from providers import HttpClient, MarketDataProvider, CoalescingProvider, CachingProvider, CBR_DAILY_URL, ALPHA_VANTAGE_URL, YAHOO_CHART_URL, PROVIDER_NAMES, is_upstream_failure
+from breaker import CircuitBreaker
+from rates import DailyRatesCache, parse_rate_snapshot
+from cache import LRUCache
+from portfolio import PortfolioValuator, format_portfolio
+from history import PriceHistory, ALPHA_VANTAGE, YAHOO
+from ratelimit import TokenBucket, PriorityLimiter, INTERACTIVE, BACKGROUND
+from scheduler import RequestTracker, PrefetchScheduler
+from assets import CURRENCY, CRYPTO, STOCK, KIND_NAMES, POSITION_KINDS, parse_kind, quote_kind
+from database import Database, AsyncDatabase
+from migrations import apply_migrations
+from fsm_storage import SqliteStorage, RedisStorage, RedisClient
+from repository import Repository, insert_user, select_user, upsert_position, select_portfolio, delete_position
+from webhook import reply, start_webhook
+from router import TextRouter, render_keyboard
+from outbox import SendQueue, QueuedBot
+from alerts import AlertEngine, parse_alert
+from portfolio_io import PortfolioFileError, parse_portfolio_file
+from conversion import CrossRates, RUB, USD, MAX_QUOTE_CODES, is_code, parse_conversion, parse_codes, format_conversion, format_rub_prices
+from metrics import Metrics
+from workers import WorkerPool, start_supervisor, run_worker as serve_updates
 
 load_dotenv()
 
 API_TOKEN = os.getenv('API_TOKEN')
 ALPHA_VANTAGE_API_KEY = os.getenv('ALPHA_VANTAGE_API_KEY')
 
+# Адреса Bot API и поставщиков котировок. Переопределяются для локального
+# сервера Bot API, стендов и нагрузочных тестов
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+CBR_URL = os.getenv('CBR_URL', CBR_DAILY_URL)
+ALPHA_VANTAGE_QUERY_URL = os.getenv('ALPHA_VANTAGE_URL', ALPHA_VANTAGE_URL)
+YAHOO_URL = os.getenv('YAHOO_CHART_URL', YAHOO_CHART_URL)
+
+# Настройки пула HTTP-соединений к поставщикам котировок
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '20'))
+
+# Предохранители поставщиков: срок ответа в секундах, доля ошибок среди
+# последних BREAKER_WINDOW запросов (не раньше BREAKER_MIN_CALLS), после
+# которой поставщик отключается на BREAKER_OPEN_SECONDS секунд, а ответы
+# строятся по последним известным данным
+PROVIDER_DEADLINE = float(os.getenv('PROVIDER_DEADLINE', '5'))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '5'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+
+# Кэш курсов ЦБ: сколько дней хранить и как часто обновлять курс на сегодня
+RATES_CACHE_SIZE = int(os.getenv('RATES_CACHE_SIZE', '64'))
+RATES_TODAY_TTL = int(os.getenv('RATES_TODAY_TTL', '3600'))
+
+# Квота ключа Alpha Vantage (0 - без ограничения) и сколько секунд запрос
+# пользователя и фоновый запрос готовы ждать свободный токен
+ALPHA_VANTAGE_CALLS_PER_MINUTE = float(os.getenv('ALPHA_VANTAGE_CALLS_PER_MINUTE', '5'))
+ALPHA_VANTAGE_CALLS_PER_DAY = float(os.getenv('ALPHA_VANTAGE_CALLS_PER_DAY', '0'))
+ALPHA_VANTAGE_MAX_WAIT = float(os.getenv('ALPHA_VANTAGE_MAX_WAIT', '5'))
+ALPHA_VANTAGE_BACKGROUND_MAX_WAIT = float(os.getenv('ALPHA_VANTAGE_BACKGROUND_MAX_WAIT', '60'))
+# Доля квоты, которую фоновое обновление котировок и проверка уведомлений
+# оставляют запросам пользователей
+ALPHA_VANTAGE_BACKGROUND_RESERVE = float(os.getenv('ALPHA_VANTAGE_BACKGROUND_RESERVE', '0.4'))
+
+# Срок жизни текущих котировок криптовалют и акций в кэше
+QUOTE_CACHE_TTL = int(os.getenv('QUOTE_CACHE_TTL', '60'))
+
+# Фоновое обновление популярных котировок: период (0 - выключено),
+# число одновременных запросов и размер горячего набора
+PREFETCH_INTERVAL = int(os.getenv('PREFETCH_INTERVAL', '30'))
+PREFETCH_CONCURRENCY = int(os.getenv('PREFETCH_CONCURRENCY', '5'))
+PREFETCH_HOT_SIZE = int(os.getenv('PREFETCH_HOT_SIZE', '20'))
+
+# Сколько секунд ждать котировки при оценке портфеля
+PORTFOLIO_QUOTE_DEADLINE = float(os.getenv('PORTFOLIO_QUOTE_DEADLINE', '5'))
+
+# Ограничения файла при импорте портфеля: размер в байтах и число позиций
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(1024 * 1024)))
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '5000'))
+
+# История цен закрытия: глубина первой загрузки и период сравнения в днях
+HISTORY_BACKFILL_DAYS = int(os.getenv('HISTORY_BACKFILL_DAYS', '30'))
+HISTORY_COMPARE_DAYS = int(os.getenv('HISTORY_COMPARE_DAYS', '7'))
+# Окно аналитики портфеля (волатильность, просадка) в днях
+ANALYTICS_WINDOW_DAYS = int(os.getenv('ANALYTICS_WINDOW_DAYS', '30'))
+
+# Хранилище состояний диалогов: sqlite (по умолчанию), redis или memory.
+# Брошенные диалоги удаляются через FSM_TTL секунд, изменения
+# записываются пачкой раз в FSM_FLUSH_INTERVAL секунд
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_TTL = int(os.getenv('FSM_TTL', '86400'))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.05'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# Режим получения обновлений: polling (по умолчанию) или webhook.
+# В режиме webhook Telegram присылает обновления на WEBHOOK_URL и проверяет
+# их заголовком с WEBHOOK_SECRET; сверх WEBHOOK_MAX_IN_FLIGHT одновременных
+# обновлений сервер отвечает 429, и Telegram повторяет доставку позже
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100'))
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8000'))
+
+# Число рабочих процессов в режиме polling. При BOT_WORKERS > 1 супервизор
+# получает обновления и раздает их процессам по номеру пользователя.
+# BOT_WORKER_INDEX задает супервизор при запуске рабочего процесса
+BOT_WORKERS = max(1, int(os.getenv('BOT_WORKERS', '1')))
+BOT_WORKER_INDEX = os.getenv('BOT_WORKER_INDEX')
+# Супервизор сам запросы пользователей не обрабатывает, но проверяет
+# уведомления: ему, как и каждому рабочему процессу, нужна своя доля квот
+SUPERVISED = BOT_MODE != 'webhook' and BOT_WORKERS > 1
+IS_SUPERVISOR = SUPERVISED and BOT_WORKER_INDEX is None
+QUOTA_SHARES = BOT_WORKERS + 1 if SUPERVISED else 1
+
+# Лимиты исходящих сообщений Telegram: всего в секунду, в секунду на чат
+# с запасом на короткую серию и число повторов после ответа 429
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+
+# Ценовые уведомления: как часто проверять цены символов с уведомлениями
+# (0 - выключено) и сколько символов запрашивать одновременно
+ALERT_CHECK_INTERVAL = int(os.getenv('ALERT_CHECK_INTERVAL', '60'))
+ALERT_CHECK_CONCURRENCY = int(os.getenv('ALERT_CHECK_CONCURRENCY', '5'))
+
+# Метрики в формате Prometheus на METRICS_PORT (0 - выключены, замеры не ставятся)
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Рабочие процессы отдают метрики на следующих портах: METRICS_PORT + 1 + номер
+if METRICS_PORT and BOT_WORKER_INDEX is not None:
+    METRICS_PORT += 1 + int(BOT_WORKER_INDEX)
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv('METRICS_LOOP_LAG_INTERVAL', '0.5'))
+
+metrics = Metrics() if METRICS_PORT else None
+
+# Общий асинхронный клиент для Банка России, Alpha Vantage и Yahoo Finance
+http_client = HttpClient(timeout=HTTP_TIMEOUT, limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST)
+# Ограничитель запросов к Alpha Vantage: запросы пользователей идут раньше фоновых
+# Квоты ключа общие для всех процессов бота и делятся между ними поровну
+alpha_vantage_per_minute = ALPHA_VANTAGE_CALLS_PER_MINUTE / QUOTA_SHARES
+alpha_vantage_per_day = ALPHA_VANTAGE_CALLS_PER_DAY / QUOTA_SHARES
+alpha_vantage_buckets = []
+if alpha_vantage_per_minute > 0:
+    alpha_vantage_buckets.append(TokenBucket(alpha_vantage_per_minute / 60, alpha_vantage_per_minute))
+if alpha_vantage_per_day > 0:
+    alpha_vantage_buckets.append(TokenBucket(alpha_vantage_per_day / 86400, alpha_vantage_per_day))
+alpha_vantage_limiter = PriorityLimiter(
+    alpha_vantage_buckets,
+    name='Alpha Vantage',
+    max_wait={INTERACTIVE: ALPHA_VANTAGE_MAX_WAIT, BACKGROUND: ALPHA_VANTAGE_BACKGROUND_MAX_WAIT},
+    background_reserve=ALPHA_VANTAGE_BACKGROUND_RESERVE,
+) if alpha_vantage_buckets else None
+
+# У каждого поставщика свой предохранитель: отказ Yahoo не отключает ЦБ
+breakers = {
+    name: CircuitBreaker(
+        name, deadline=PROVIDER_DEADLINE, failure_rate=BREAKER_FAILURE_RATE, window=BREAKER_WINDOW,
+        min_calls=BREAKER_MIN_CALLS, open_seconds=BREAKER_OPEN_SECONDS, is_failure=is_upstream_failure,
+    )
+    for name in PROVIDER_NAMES
+}
+market_data_source = MarketDataProvider(
+    http_client, ALPHA_VANTAGE_API_KEY,
+    cbr_url=CBR_URL, alpha_vantage_url=ALPHA_VANTAGE_QUERY_URL, yahoo_url=YAHOO_URL,
+    alpha_vantage_limiter=alpha_vantage_limiter, breakers=breakers,
+)
+if metrics:
+    metrics.instrument_provider(market_data_source)
+# Котировки кэшируются, а одинаковые одновременные промахи уходят к поставщику один раз
+market_data = CachingProvider(CoalescingProvider(market_data_source), ttl=QUOTE_CACHE_TTL)
+rates_cache = DailyRatesCache(market_data, maxsize=RATES_CACHE_SIZE, today_ttl=RATES_TODAY_TTL)
+portfolio_valuator = PortfolioValuator(market_data, deadline=PORTFOLIO_QUOTE_DEADLINE)
+
+DATABASE_NAME = os.getenv('DATABASE_NAME', os.path.join('app_data', 'finance_bot.db'))
+
+# Параметры SQLite: synchronous=NORMAL безопасен в режиме WAL,
+# отрицательный cache_size задается в килобайтах
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')
+DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', '-8000'))
+DB_BUSY_TIMEOUT = int(os.getenv('DB_BUSY_TIMEOUT', '5000'))
+# Потоки для чтения и максимальное число записей в одной общей транзакции
+DB_READ_WORKERS = int(os.getenv('DB_READ_WORKERS', '4'))
+DB_WRITE_BATCH = int(os.getenv('DB_WRITE_BATCH', '64'))
+# Кэш telegram_id -> пользователь и срок хранения отметки "не зарегистрирован"
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_NEGATIVE_TTL = int(os.getenv('USER_CACHE_NEGATIVE_TTL', '60'))
+
+db = Database(DATABASE_NAME, synchronous=DB_SYNCHRONOUS, cache_size=DB_CACHE_SIZE, busy_timeout=DB_BUSY_TIMEOUT)
+async_db = AsyncDatabase(db, read_workers=DB_READ_WORKERS, max_batch=DB_WRITE_BATCH)
+if metrics:
+    async_db = metrics.instrument_database(async_db)
+# Обработчики работают с базой только через асинхронный репозиторий
+repository = Repository(async_db, user_cache=LRUCache(maxsize=USER_CACHE_SIZE), negative_ttl=USER_CACHE_NEGATIVE_TTL)
+price_history = PriceHistory(async_db, market_data, backfill_days=HISTORY_BACKFILL_DAYS)
+
+# Аналитика считается на NumPy, поэтому модуль загружается при первом запросе
+@functools.lru_cache(maxsize=None)
+def portfolio_analyzer():
+    from analytics import PortfolioAnalyzer
+    return PortfolioAnalyzer(async_db, price_history, window_days=ANALYTICS_WINDOW_DAYS)
+
+# Выбор хранилища состояний FSM
+def create_storage():
+    if FSM_STORAGE == 'memory':
+        return MemoryStorage()
+    if FSM_STORAGE == 'redis':
+        return RedisStorage(RedisClient.from_url(REDIS_URL), ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+    return SqliteStorage(async_db, ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+
+# Все отправки бота идут через очередь с лимитами Telegram: ответы
+# пользователям впереди фоновых рассылок. Общий лимит бота делится между
+# процессами, как и квоты Alpha Vantage; лимит чата не делится, чат
+# обслуживает один рабочий процесс
+send_queue = SendQueue(
+    TokenBucket(SEND_GLOBAL_RATE / QUOTA_SHARES, SEND_GLOBAL_RATE / QUOTA_SHARES),
+    chat_rate=SEND_CHAT_RATE,
+    chat_capacity=SEND_CHAT_BURST,
+    max_retries=SEND_MAX_RETRIES,
+)
+
 # Создание объектов бота и диспетчера
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+bot = QueuedBot(
+    token=API_TOKEN,
+    send_queue=send_queue,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION,
+)
+storage = create_storage()
 dp = Dispatcher(bot, storage=storage)
+# Кнопки меню и команды выбираются по словарю одним обработчиком
+text_router = TextRouter()
+text_router.register(dp)
+
+# Обновление горячих котировок в фоне, до истечения срока в кэше
+async def prefetch_currency(currency_code, lead):
+    await rates_cache.prefetch(datetime.now(), lead)
+
+async def prefetch_crypto(symbol, lead):
+    await market_data.prefetch('crypto', symbol, lead)
+
+async def prefetch_stock(symbol, lead):
+    await market_data.prefetch('stock', symbol, lead)
+
+request_tracker = RequestTracker()
+prefetch_scheduler = PrefetchScheduler(
+    request_tracker,
+    {CURRENCY: prefetch_currency, CRYPTO: prefetch_crypto, STOCK: prefetch_stock},
+    interval=PREFETCH_INTERVAL,
+    concurrency=PREFETCH_CONCURRENCY,
+    hot_size=PREFETCH_HOT_SIZE,
+)
+
+# Цены для проверки уведомлений берутся у тех же поставщиков и из тех же кэшей
+async def alert_currency_rate(currency_code):
+    return (await rates_cache.get_rates(datetime.now())).get(currency_code)
+
+# Единицы цены в сообщениях
+def price_unit(kind):
+    return "руб." if kind == CURRENCY else "USD"
+
+async def notify_alert(alert, price):
+    await bot.send_message(
+        alert.telegram_id,
+        f"Сработало уведомление #{alert.id}: {alert.symbol} {alert.direction} {alert.threshold:g} {price_unit(alert.kind)}\n"
+        f"Текущая цена {alert.symbol}: {price:.2f} {price_unit(alert.kind)}"
+    )
 
-DATABASE_NAME = os.path.join('app_data', 'finance_bot.db')
+alert_engine = AlertEngine(
+    async_db,
+    {CURRENCY: alert_currency_rate, CRYPTO: market_data.get_crypto_price, STOCK: market_data.get_stock_price},
+    notify_alert,
+    interval=ALERT_CHECK_INTERVAL,
+    concurrency=ALERT_CHECK_CONCURRENCY,
+)
 
 # Функция для создания базы данных и таблиц
 def create_db():
     
-    if not os.path.exists('app_data'):
-        os.makedirs('app_data')
-
-    connection = sqlite3.connect(DATABASE_NAME)
-    cursor = connection.cursor()
-
-    # Создание таблицы пользователей
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER UNIQUE,
-        username TEXT,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-
-    # Создание таблицы портфеля
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS portfolio (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        stock_symbol TEXT,
-        quantity INTEGER,
-        purchase_price REAL,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )
-    ''')
+    database_dir = os.path.dirname(DATABASE_NAME)
+    if database_dir and not os.path.exists(database_dir):
+        os.makedirs(database_dir)
 
-    connection.commit()
-    connection.close()
+    # Таблицы и индексы создаются версионированными миграциями
+    with db.write() as cursor:
+        apply_migrations(cursor)
 
 # Функции для работы с базой данных
 def add_user(telegram_id, username):
-    connection = sqlite3.connect(DATABASE_NAME)
-    cursor = connection.cursor()
-    
-    cursor.execute('''
-    INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)
-    ''', (telegram_id, username))
-    
-    connection.commit()
-    connection.close()
+    with db.write() as cursor:
+        insert_user(cursor, telegram_id, username)
 
 def get_user(telegram_id):
-    connection = sqlite3.connect(DATABASE_NAME)
-    cursor = connection.cursor()
-    
-    cursor.execute('''
-    SELECT * FROM users WHERE telegram_id = ?
-    ''', (telegram_id,))
-    
-    user = cursor.fetchone()
-    
-    connection.close()
-    
-    return user
+    with db.read() as cursor:
+        return select_user(cursor, telegram_id)
 
 def add_stock_to_portfolio(user_id, stock_symbol, quantity, purchase_price):
-    connection = sqlite3.connect(DATABASE_NAME)
-    cursor = connection.cursor()
-
-    # Проверяем, существует ли уже актив с таким символом в портфеле
-    cursor.execute('''
-    SELECT quantity, purchase_price FROM portfolio WHERE user_id = ? AND stock_symbol = ?
-    ''', (user_id, stock_symbol))
-    
-    existing_stock = cursor.fetchone()
-
-    if existing_stock:
-        existing_quantity, existing_price = existing_stock
-        
-        # Обновляем количество и пересчитываем среднюю цену покупки
-        new_quantity = existing_quantity + quantity
-        
-        # Рассчитываем новую среднюю цену покупки с округлением до двух знаков после запятой
-        total_cost = (existing_price * existing_quantity) + (purchase_price * quantity)
-        new_average_price = round(total_cost / new_quantity, 2)
-        
-        cursor.execute('''
-        UPDATE portfolio SET quantity = ?, purchase_price = ? WHERE user_id = ? AND stock_symbol = ?
-        ''', (new_quantity, new_average_price, user_id, stock_symbol))
-        
-    else:
-        # Если актив не существует, добавляем его в портфель
-        cursor.execute('''
-        INSERT INTO portfolio (user_id, stock_symbol, quantity, purchase_price) VALUES (?, ?, ?, ?)
-        ''', (user_id, stock_symbol, quantity, purchase_price))
-
-    connection.commit()
-    connection.close()
+    with db.write() as cursor:
+        upsert_position(cursor, user_id, stock_symbol, quantity, purchase_price)
 
 def get_portfolio(user_id):
-    connection = sqlite3.connect(DATABASE_NAME)
-    cursor = connection.cursor()
-    
-    cursor.execute('''
-    SELECT * FROM portfolio WHERE user_id = ?
-    ''', (user_id,))
-    
-    portfolio = cursor.fetchall()
-    
-    connection.close()
-    
-    return portfolio
+    with db.read() as cursor:
+        return select_portfolio(cursor, user_id)
 
 def remove_stock_from_portfolio(user_id, stock_symbol):
-    connection = sqlite3.connect(DATABASE_NAME)
-    cursor = connection.cursor()
-    
-    cursor.execute('''
-    DELETE FROM portfolio WHERE user_id = ? AND stock_symbol = ?
-    ''', (user_id, stock_symbol))
-    
-    connection.commit()
-    connection.close()
+    with db.write() as cursor:
+        delete_position(cursor, user_id, stock_symbol)
+
+# Синхронные функции ниже бот не использует: он получает котировки через
+# асинхронный MarketDataProvider. Их библиотеки загружаются при первом
+# вызове, а не при импорте main: yahoo_fin тянет за собой pandas и requests_html
 
 # Интеграция с Банком России для получения курса валют
 def get_exchange_rates(date):
+   import requests
    url = f'http://www.cbr.ru/scripts/XML_daily.asp?date_req={date.strftime("%d/%m/%Y")}'
-   response = requests.get(url)
+   response = requests.get(url, timeout=HTTP_TIMEOUT)
    response.raise_for_status()  # Raise an error for bad responses
    return response.text
 
 def parse_exchange_rate(xml_data, currency_code):
-   root = ET.fromstring(xml_data)
-   currency_value = root.find(f'.//Valute[CharCode="{currency_code}"]/Value')
-   
-   if currency_value is not None:
-       return float(currency_value.text.replace(',', '.'))
-   else:
-       return None
+   # Курс за одну единицу валюты с учетом Nominal
+   return parse_rate_snapshot(xml_data).get(currency_code)
 
 def calculate_percentage_change(current_value, previous_value):
    if previous_value == 0:
        return None  # Avoid division by zero
    return ((current_value - previous_value) / previous_value) * 100
 
+# Сравнение с последним закрытием (после выходных - закрытием пятницы) и
+# закрытием HISTORY_COMPARE_DAYS дней назад. Без истории (квота поставщика,
+# новый тикер) сравнения нет, но текущая цена все равно показывается
+def format_previous_close(current_value, previous_close, week_ago_value):
+   if previous_close is None:
+       return "\nИстории цен пока нет, сравнение с прошлыми днями недоступно"
+   day, previous_value = previous_close
+   text = f"\nЦена закрытия {day:%d.%m.%Y}: {previous_value:.2f} USD"
+   percentage_change = calculate_percentage_change(current_value, previous_value)
+   if percentage_change is not None:
+       text += f"\nИзменение к этому закрытию: {percentage_change:.2f}%"
+   return text + format_period_change(current_value, week_ago_value)
+
+# Строка с изменением цены за HISTORY_COMPARE_DAYS дней, если есть история
+def format_period_change(current_value, previous_value):
+   if previous_value is None:
+       return ""
+   percentage_change = calculate_percentage_change(current_value, previous_value)
+   if percentage_change is None:
+       return ""
+   return f"\nИзменение за {HISTORY_COMPARE_DAYS} дн.: {percentage_change:.2f}%"
+
+# Цена в рублях по курсу USD из кэша ЦБ. Ответ о котировке не зависит
+# от ЦБ: без курса строка просто не добавляется
+async def format_rub_value(usd_price):
+   try:
+       rates = await rates_cache.get_rates(datetime.now())
+   except Exception:
+       return ""
+   rub_price = CrossRates(rates).convert(usd_price, USD, RUB)
+   return "" if rub_price is None else f"\nВ рублях по курсу ЦБ: {rub_price:.2f} руб."
+
+# Пометка об устаревших данных: ответ собран из кэша, пока источник недоступен
+def format_freshness(age):
+   if age is None:
+       return ""
+   if age < 3600:
+       ago = f"{max(int(age // 60), 1)} мин."
+   else:
+       ago = f"{int(age // 3600)} ч."
+   return f"\nИсточник недоступен, данные получены {ago} назад"
+
 # Получение стоимости криптовалюты из Alpha Vantage
 def get_crypto_price(symbol):
+   import requests
    url = f'https://www.alphavantage.co/query?function=CURRENCY_EXCHANGE_RATE&from_currency={symbol}&to_currency=USD&apikey={ALPHA_VANTAGE_API_KEY}'
-   response = requests.get(url)
+   response = requests.get(url, timeout=HTTP_TIMEOUT)
    data = response.json()
 
    if "Realtime Currency Exchange Rate" in data:
@@ -178,24 +398,22 @@ def get_crypto_price(symbol):
 
 # Получение стоимости акций из Yahoo Finance с использованием yahoo_fin
 def get_stock_price(symbol):
+   from yahoo_fin import stock_info as si
    try:
        current_price = si.get_live_price(symbol)  # Используем метод из библиотеки yahoo_fin.
        return current_price
    except Exception as e:
        raise Exception(f"Ошибка при получении стоимости акции: {str(e)}")
 
-# Создаем базу данных при запуске бота
-create_db()
-
-@dp.message_handler(commands=['start'])
+@text_router.command('start')
 async def send_welcome(message: types.Message):
    telegram_id = message.from_user.id
-   user = get_user(telegram_id)
+   user = await repository.get_user(telegram_id)
 
    if user:
-       await message.reply(f"Здравствуйте, {message.from_user.full_name}! Я ваш личный финансовый ассистент.", reply_markup=main_menu())
+       return await reply(message, f"Здравствуйте, {message.from_user.full_name}! Я ваш личный финансовый ассистент.", reply_markup=MAIN_MENU)
    else:
-       await message.reply(f"Здравствуйте, {message.from_user.full_name}! Я ваш личный финансовый ассистент. Пожалуйста, зарегистрируйтесь.", reply_markup=registration_menu())
+       return await reply(message, f"Здравствуйте, {message.from_user.full_name}! Я ваш личный финансовый ассистент. Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
 
 def main_menu():
    markup = ReplyKeyboardMarkup(resize_keyboard=True)
@@ -216,201 +434,291 @@ def registration_menu():
    
    return markup
 
-@dp.message_handler(lambda message: message.text == "Регистрация")
+@text_router.text("Регистрация")
 async def register_user(message: types.Message):
    telegram_id = message.from_user.id
    username = message.from_user.username
    
    # Добавляем пользователя в базу данных
-   add_user(telegram_id, username)
+   await repository.add_user(telegram_id, username)
 
-   await message.reply(f"Вы успешно зарегистрированы! Теперь вы можете использовать кнопки для управления своим портфелем.", reply_markup=main_menu())
+   return await reply(message, f"Вы успешно зарегистрированы! Теперь вы можете использовать кнопки для управления своим портфелем.", reply_markup=MAIN_MENU)
 
-@dp.message_handler(lambda message: message.text == "Мой портфель")
+@text_router.text("Мой портфель")
 async def portfolio_menu(message: types.Message):
-   await message.reply("Выберите действие:", reply_markup=portfolio_options())
+   # Ответ на кнопки меню уходит прямо в ответе на вебхук
+   return await reply(message, "Выберите действие:", reply_markup=PORTFOLIO_OPTIONS)
 
 def portfolio_options():
    markup = ReplyKeyboardMarkup(resize_keyboard=True)
    
    button1 = KeyboardButton("Мои активы")
+   button_analytics = KeyboardButton("Аналитика")
    button2 = KeyboardButton("Добавить актив")
    button3 = KeyboardButton("Удалить актив")
+   button_import = KeyboardButton("Импорт активов")
+   button_export = KeyboardButton("Экспорт активов")
    button_back_main_menu = KeyboardButton("Назад в главное меню")
    
-   markup.add(button1).add(button2).add(button3).add(button_back_main_menu)
+   markup.row(button1, button_analytics).add(button2).add(button3).row(button_import, button_export).add(button_back_main_menu)
    
    return markup
 
-@dp.message_handler(lambda message: message.text == "Курс валют")
+@text_router.text("Курс валют")
 async def exchange_rate_prompt(message: types.Message):
-   await message.reply("Введите код валюты (например, USD):", reply_markup=currency_back_button())
-   
    # Устанавливаем состояние для ввода кода валюты
    await dp.current_state(user=message.from_user.id).set_state("waiting_for_currency_code")
 
+   return await reply(message, "Введите код валюты (например, USD), несколько кодов (USD EUR CNY) или пару для пересчета (100 EUR в USD, BTC/RUB):", reply_markup=CURRENCY_BACK_BUTTON)
+
 @dp.message_handler(state="waiting_for_currency_code", content_types=types.ContentTypes.TEXT)
 async def process_currency_code(message: types.Message, state: FSMContext):
-   currency_code = message.text.strip().upper()  # Приводим код к верхнему регистру
+   # Кнопки меню работают и во время ввода кода
+   if text_router.match(message):
+       await state.finish()
+       return await text_router.dispatch(message)
+
+   text = message.text.strip()
+   # "100 EUR в USD" - пересчет пары, иначе один или несколько кодов: "USD EUR CNY"
+   conversion = parse_conversion(text)
+   codes = list(dict.fromkeys(conversion[1:])) if conversion else parse_codes(text)
+   if not codes:
+       return await reply(message, "Введите коды латиницей, например: USD, USD EUR CNY или 100 EUR в USD", reply_markup=CURRENCY_BACK_BUTTON)
+   for code in codes:
+       request_tracker.record(CURRENCY, code)
    
    today = datetime.now()
    yesterday_date=today - timedelta(days=1)
 
    try:
-       today_rates_xml=get_exchange_rates(today) 
-       yesterday_rates_xml=get_exchange_rates(yesterday_date) 
-
-       current_rate=parse_exchange_rate(today_rates_xml,currency_code) 
-       previous_rate=parse_exchange_rate(yesterday_rates_xml,currency_code) 
-
-       if current_rate is not None and previous_rate is not None:
-           percentage_change=calculate_percentage_change(current_rate ,previous_rate) 
-
-           await message.reply(
-               f"Текущий курс {currency_code}: {current_rate:.2f} руб.\n"
-               f"Курс {currency_code} вчера: {previous_rate:.2f} руб.\n"
-               f"Изменение курса по сравнению с вчерашним днем: {percentage_change:.2f}%"
-           )
+       # Берем разобранные курсы из кэша, недостающие дни запрашиваем параллельно
+       today_rates, yesterday_rates = await asyncio.gather(
+           rates_cache.get_rates(today),
+           rates_cache.get_rates(yesterday_date),
+       )
+       # Криптовалюты и акции пересчитываются по котировкам в USD из кэша котировок
+       current = CrossRates(today_rates)
+       quote_codes = current.quote_codes(codes)
+       if len(quote_codes) > MAX_QUOTE_CODES:
+           return await reply(message, f"Криптовалют и акций в одном запросе - не больше {MAX_QUOTE_CODES}.", reply_markup=CURRENCY_BACK_BUTTON)
+       if quote_codes:
+           quotes = await portfolio_valuator.fetch_quotes((code, quote_kind(code)) for code in quote_codes)
+           current.usd_quotes = {code: price for (code, _), price in quotes.items()}
+       freshness = format_freshness(rates_cache.stale_age(today))
+
+       if conversion:
+           response=await reply(message, format_conversion(current, *conversion) + freshness)
+       elif len(codes) == 1 and not quote_codes:
+           currency_code = codes[0]
+           current_rate=today_rates.get(currency_code) 
+           previous_rate=yesterday_rates.get(currency_code) 
+
+           if current_rate is not None and previous_rate is not None:
+               percentage_change=calculate_percentage_change(current_rate ,previous_rate) 
+
+               response=await reply(message,
+                   f"Текущий курс {currency_code}: {current_rate:.2f} руб.\n"
+                   f"Курс {currency_code} вчера: {previous_rate:.2f} руб.\n"
+                   f"Изменение курса по сравнению с вчерашним днем: {percentage_change:.2f}%"
+                   + freshness
+               )
+           else:
+               response=await reply(message, f"Не удалось получить курс для валюты: {currency_code}")
        else:
-           await message.reply(f"Не удалось получить курс для валюты: {currency_code}")
+           # Все коды считаются по одному сегодняшнему и одному вчерашнему снимку
+           response=await reply(message, format_rub_prices(codes, current, CrossRates(yesterday_rates)) + freshness)
        
        # Сбрасываем состояние после получения курса.
        await state.finish()
+       return response
 
    except Exception as e:
-       await message.reply(f"Произошла ошибка при получении курса валют: {str(e)}")
+       return await reply(message, f"Произошла ошибка при получении курса валют: {str(e)}")
 
-@dp.message_handler(lambda message: message.text == "Криптовалюта")
+@text_router.text("Криптовалюта")
 async def crypto_prompt(message: types.Message):
-  await message.reply("Введите код криптовалюты (например BTC):", reply_markup=currency_back_button())
-  
   # Устанавливаем состояние для ввода кода криптовалюты.
   await dp.current_state(user=message.from_user.id).set_state("waiting_for_crypto_code")
 
+  return await reply(message, "Введите код криптовалюты (например BTC):", reply_markup=CURRENCY_BACK_BUTTON)
+
 @dp.message_handler(state="waiting_for_crypto_code", content_types=types.ContentTypes.TEXT)
 async def process_crypto_code(message: types.Message,state:FSMContext):
+  # Кнопки меню работают и во время ввода кода
+  if text_router.match(message):
+      await state.finish()
+      return await text_router.dispatch(message)
+
   crypto_code=message.text.strip().upper() 
+  if not is_code(crypto_code):
+      return await reply(message, "Введите код криптовалюты латиницей, например BTC", reply_markup=CURRENCY_BACK_BUTTON)
 
   try:
-      current_price=get_crypto_price(crypto_code) 
+      current_price=await market_data.get_crypto_price(crypto_code) 
 
       if current_price is not None:
-          yesterday_date=datetime.now()-timedelta(days=1) 
-          previous_day_price=get_crypto_price(crypto_code) 
-
-          if previous_day_price is not None:
-              percentage_change=(current_price-previous_day_price)/previous_day_price*100 
-
-              await message.reply(
-                  f"Текущая стоимость {crypto_code}: {current_price:.2f} USD\n"
-                  f"Стоимость {crypto_code} вчера: {previous_day_price:.2f} USD\n"
-                  f"Изменение стоимости по сравнению с вчерашним днем: {percentage_change:.2f}%"
-              )
-          else:
-              await message.reply(f"Не удалось получить стоимость для криптовалюты за вчерашний день.")
+          # Горячими считаются только существующие коды: по ним планировщик тратит квоту
+          request_tracker.record(CRYPTO, crypto_code)
+          # Прошлые цены закрытия берем из локальной истории, догружая только недостающие дни
+          previous_close=await price_history.previous_close(ALPHA_VANTAGE, crypto_code) 
+          week_ago_price=await price_history.close_days_ago(ALPHA_VANTAGE, crypto_code, HISTORY_COMPARE_DAYS) 
+
+          response=await reply(message,
+              f"Текущая стоимость {crypto_code}: {current_price:.2f} USD"
+              + format_previous_close(current_price, previous_close, week_ago_price)
+              + await format_rub_value(current_price)
+              + format_freshness(market_data.stale_age('crypto', crypto_code))
+          )
       else:
-          await message.reply(f"Не удалось получить стоимость для криптовалюты: {crypto_code}")
+          response=await reply(message, f"Не удалось получить стоимость для криптовалюты: {crypto_code}")
 
       # Сбрасываем состояние после получения стоимости.
       await state.finish()
+      return response
 
   except Exception as e:
-      await message.reply(f"Произошла ошибка при получении стоимости криптовалюты: {str(e)}")
+      return await reply(message, f"Произошла ошибка при получении стоимости криптовалюты: {str(e)}")
 
-@dp.message_handler(lambda message: message.text == "Биржа")
+@text_router.text("Биржа")
 async def stock_prompt(message: types.Message):
-  await message.reply("Введите символ акции (например AAPL):", reply_markup=currency_back_button())
-  
   # Устанавливаем состояние для ввода символа акции.
   await dp.current_state(user=message.from_user.id).set_state("waiting_for_stock_symbol")
 
+  return await reply(message, "Введите символ акции (например AAPL):", reply_markup=CURRENCY_BACK_BUTTON)
+
 @dp.message_handler(state="waiting_for_stock_symbol", content_types=types.ContentTypes.TEXT)
 async def process_stock_symbol(message: types.Message,state:FSMContext):
+  # Кнопки меню работают и во время ввода символа
+  if text_router.match(message):
+      await state.finish()
+      return await text_router.dispatch(message)
+
   stock_symbol=message.text.strip().upper() 
+  if not is_code(stock_symbol):
+      return await reply(message, "Введите символ акции латиницей, например AAPL", reply_markup=CURRENCY_BACK_BUTTON)
 
   try:
-      current_stock_price=get_stock_price(stock_symbol) 
+      current_stock_price=await market_data.get_stock_price(stock_symbol) 
 
       if current_stock_price is not None:
-          yesterday_date=datetime.now()-timedelta(days=1) 
-          previous_stock_price=get_stock_price(stock_symbol) 
-
-          if previous_stock_price is not None:
-              percentage_change=(current_stock_price-previous_stock_price)/previous_stock_price*100 
-
-              await message.reply(
-                  f"Текущая стоимость акции {stock_symbol}: {current_stock_price:.2f} USD\n"
-                  f"Стоимость акции {stock_symbol} вчера: {previous_stock_price:.2f} USD\n"
-                  f"Изменение стоимости по сравнению с вчерашним днем: {percentage_change:.2f}%"
-              )
-          else:
-              await message.reply(f"Не удалось получить стоимость акции за вчерашний день.")
+          # Горячими считаются только существующие символы: по ним планировщик тратит квоту
+          request_tracker.record(STOCK, stock_symbol)
+          # Прошлые цены закрытия берем из локальной истории, догружая только недостающие дни
+          previous_close=await price_history.previous_close(YAHOO, stock_symbol) 
+          week_ago_price=await price_history.close_days_ago(YAHOO, stock_symbol, HISTORY_COMPARE_DAYS) 
+
+          response=await reply(message,
+              f"Текущая стоимость акции {stock_symbol}: {current_stock_price:.2f} USD"
+              + format_previous_close(current_stock_price, previous_close, week_ago_price)
+              + await format_rub_value(current_stock_price)
+              + format_freshness(market_data.stale_age('stock', stock_symbol))
+          )
       else:
-          await message.reply(f"Не удалось получить стоимость акции: {stock_symbol}")
+          response=await reply(message, f"Не удалось получить стоимость акции: {stock_symbol}")
 
       # Сбрасываем состояние после получения стоимости.
       await state.finish()
+      return response
 
   except Exception as e:
-      await message.reply(f"Произошла ошибка при получении стоимости акции: {str(e)}")
+      return await reply(message, f"Произошла ошибка при получении стоимости акции: {str(e)}")
 
-@dp.message_handler(lambda message: message.text == "Мои активы")
+@text_router.text("Мои активы")
 async def show_portfolio(message: types.Message):
   telegram_id=message.from_user.id 
-  user=get_user(telegram_id)
+  user=await repository.get_user(telegram_id)
 
   if user:
       user_id=user[0] 
-      portfolio_items=get_portfolio(user_id)
+      portfolio_items=await repository.get_portfolio(user_id)
 
       if portfolio_items:
-          response="Ваши активы:\n"
-          for item in portfolio_items:
-              response+=f"Акция: {item[2]}, Количество: {item[3]}, Цена покупки: {item[4]}\n"
-          await message.reply(response)
-      else:
-          await message.reply("Ваш портфель пуст.")
+          # Котировки всех позиций запрашиваются параллельно с общим сроком ожидания
+          valuation=await portfolio_valuator.value(portfolio_items)
+          return await reply(message, format_portfolio(valuation))
+      return await reply(message, "Ваш портфель пуст.")
+
+@text_router.text("Аналитика")
+async def show_analytics(message: types.Message):
+  user=await repository.get_user(message.from_user.id)
+  if not user:
+      return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+  user_id=user[0]
+  try:
+      # Текущие цены - те же, что и в "Мои активы"; история закрытий из локальной базы
+      portfolio_items=await repository.get_portfolio(user_id)
+      valuation=await portfolio_valuator.value(portfolio_items) if portfolio_items else None
+      prices={(position.symbol, position.kind): position.price for position in valuation.positions} if valuation else None
+      analytics=await portfolio_analyzer().analyze_user(user_id, prices)
+  except Exception as e:
+      return await reply(message, f"Произошла ошибка при расчете аналитики: {str(e)}")
+
+  if analytics is None:
+      return await reply(message, "Ваш портфель пуст.")
+  from analytics import format_analytics
+  return await reply(message, format_analytics(analytics))
 
-@dp.message_handler(lambda message: message.text == "Добавить актив")
+@text_router.text("Добавить актив")
 async def add_stock_prompt(message: types.Message):
-  await message.reply("Укажите название актива:", reply_markup=back_button())
-  
   # Устанавливаем состояние для добавления актива.
   await dp.current_state(user=message.from_user.id).set_state("waiting_for_stock_name")
 
+  return await reply(message, "Укажите название актива:", reply_markup=BACK_BUTTON)
+
 @dp.message_handler(state="waiting_for_stock_name", content_types=types.ContentTypes.TEXT)
 async def process_stock_name(message: types.Message,state:FSMContext):
-  stock_name=message.text.strip() 
+  # Символ храним в верхнем регистре, как при удалении и запросе котировок.
+  stock_name=message.text.strip().upper() 
   
   # Сохраняем название актива в состоянии.
   await state.update_data(stock_name=stock_name)
 
-  await message.reply("Укажите количество:")
-  
+  # Вид актива спрашиваем: один тикер бывает и акцией, и криптовалютой (BTC)
+  await dp.current_state(user=message.from_user.id).set_state("waiting_for_asset_kind")
+
+  return await reply(message, "Это акция или криптовалюта?", reply_markup=ASSET_KIND_MENU)
+
+@dp.message_handler(state="waiting_for_asset_kind", content_types=types.ContentTypes.TEXT)
+async def process_asset_kind(message: types.Message,state:FSMContext):
+  asset_kind=parse_kind(message.text)
+
+  if asset_kind not in POSITION_KINDS:
+      # Кнопки меню работают и во время выбора вида
+      if text_router.match(message):
+          await state.finish()
+          return await text_router.dispatch(message)
+      return await reply(message, "Выберите вид актива: акция или криптовалюта.", reply_markup=ASSET_KIND_MENU)
+
+  # Сохраняем вид актива в состоянии.
+  await state.update_data(asset_kind=asset_kind)
+
   # Переходим к следующему состоянию.
   await dp.current_state(user=message.from_user.id).set_state("waiting_for_quantity")
 
+  return await reply(message, "Укажите количество:", reply_markup=BACK_BUTTON)
+
 @dp.message_handler(state="waiting_for_quantity", content_types=types.ContentTypes.TEXT)
 async def process_quantity(message: types.Message,state:FSMContext):
   quantity_text=message.text.strip()
 
   if not quantity_text.isdigit():
-      await message.reply("Пожалуйста введите корректное количество.")
-      return
+      return await reply(message, "Пожалуйста введите корректное количество.")
 
   quantity=int(quantity_text)
 
   # Сохраняем количество в состоянии.
   await state.update_data(quantity=quantity)
 
-  await message.reply("Укажите цену за 1 единицу актива:")
-  
   # Переходим к следующему состоянию.
   await dp.current_state(user=message.from_user.id).set_state("waiting_for_price")
 
+  return await reply(message, "Укажите цену за 1 единицу актива:")
+
 @dp.message_handler(state="waiting_for_price", content_types=types.ContentTypes.TEXT)
 async def process_price(message: types.Message,state:FSMContext):
   price_text=message.text.strip()
+  response=None
 
   try:
       price_per_unit=float(price_text) 
@@ -419,58 +727,119 @@ async def process_price(message: types.Message,state:FSMContext):
       data=await state.get_data() 
       stock_name=data.get('stock_name')
       quantity=data.get('quantity')
+      asset_kind=data.get('asset_kind')
 
       total_price=price_per_unit*quantity 
 
       telegram_id=message.from_user.id 
-      user=get_user(telegram_id)
+      user=await repository.get_user(telegram_id)
 
       if user:
           user_id=user[0] 
-          add_stock_to_portfolio(user_id ,stock_name ,quantity ,total_price) 
-          await message.reply(f"Акция {stock_name} добавлена в ваш портфель. Общая стоимость:{total_price:.2f}.")
+          # В портфеле хранится цена за единицу: по ней усредняется цена и считается P&L
+          await repository.add_stock_to_portfolio(user_id ,stock_name ,quantity ,price_per_unit ,asset_kind) 
+          response=await reply(message, f"Актив {stock_name} ({KIND_NAMES.get(asset_kind, 'вид не указан')}) добавлен в ваш портфель. Общая стоимость:{total_price:.2f}.")
       
       # Сбрасываем состояние после добавления актива.
       await state.finish()
+      return response
 
   except ValueError:
-      await message.reply("Пожалуйста введите корректную цену.")
+      return await reply(message, "Пожалуйста введите корректную цену.")
 
-@dp.message_handler(lambda message: message.text == "Удалить актив")
+@text_router.text("Удалить актив")
 async def remove_stock_prompt(message: types.Message):
-  await message.reply("Введите символ актива для удаления:\n\nЧтобы вернуться назад в меню 'Мой портфель', нажмите 'Назад'.", reply_markup=back_button())
-  
   # Устанавливаем состояние для удаления актива.
   await dp.current_state(user=message.from_user.id).set_state("removing_stock")
 
+  return await reply(message, "Введите символ актива для удаления:\n\nЧтобы вернуться назад в меню 'Мой портфель', нажмите 'Назад'.", reply_markup=BACK_BUTTON)
+
 @dp.message_handler(state="removing_stock", content_types=types.ContentTypes.TEXT)
 async def remove_stock(message: types.Message):
   stock_symbol=message.text.strip().upper()  
 
   telegram_id=message.from_user.id 
-  user=get_user(telegram_id)
+  user=await repository.get_user(telegram_id)
 
   if user:
       user_id=user[0] 
-      portfolio_items=get_portfolio(user_id)
 
-      # Проверяем наличие актива в портфеле перед удалением.
-      if any(item[2] == stock_symbol for item in portfolio_items):
-          remove_stock_from_portfolio(user_id ,stock_symbol) 
-          await message.reply(f"Акция {stock_symbol} удалена из вашего портфеля.")
+      # Удаляем одним запросом: репозиторий сообщает, был ли актив в портфеле.
+      if await repository.remove_stock_from_portfolio(user_id ,stock_symbol):
+          response=await reply(message, f"Акция {stock_symbol} удалена из вашего портфеля.")
       else:
-          await message.reply(f"Акция {stock_symbol} не найдена в вашем портфеле.")
+          response=await reply(message, f"Акция {stock_symbol} не найдена в вашем портфеле.")
       # Сбрасываем состояние после удаления актива.
       await dp.current_state(user=message.from_user.id).reset_state(with_data=False)
+      return response
+
+@text_router.text("Импорт активов")
+async def import_prompt(message: types.Message):
+  # Ждем файл с позициями вместо ввода по шагам.
+  await dp.current_state(user=message.from_user.id).set_state("waiting_for_import_file")
+
+  return await reply(
+      message,
+      "Отправьте файл CSV или JSON с позициями.\n\n"
+      "CSV: строки symbol,quantity,purchase_price, например AAPL,10,150.5\n"
+      "JSON: [{\"symbol\": \"AAPL\", \"quantity\": 10, \"purchase_price\": 150.5}]",
+      reply_markup=BACK_BUTTON,
+  )
+
+@dp.message_handler(state="waiting_for_import_file", content_types=types.ContentTypes.DOCUMENT)
+async def process_import_file(message: types.Message, state: FSMContext):
+  document = message.document
+  if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+      return await reply(message, f"Файл слишком большой, максимум {IMPORT_MAX_BYTES // 1024} КБ.")
+
+  user = await repository.get_user(message.from_user.id)
+  if not user:
+      await state.finish()
+      return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+  try:
+      data = (await document.download(destination_file=io.BytesIO())).getvalue()
+      result = parse_portfolio_file(data, document.file_name, max_rows=IMPORT_MAX_ROWS)
+  except PortfolioFileError as e:
+      return await reply(message, f"Не удалось прочитать файл: {e}")
+  except Exception as e:
+      return await reply(message, f"Произошла ошибка при загрузке файла: {str(e)}")
+
+  # Все позиции файла записываются одной транзакцией
+  imported = await repository.import_positions(user[0], result.positions) if result.positions else 0
+  await state.finish()
 
-@dp.message_handler(lambda message: message.text == "Назад в главное меню")
+  text = f"Импортировано позиций: {imported}."
+  if result.errors:
+      text += f"\nПропущено строк: {len(result.errors)}\n" + result.format_errors()
+  return await reply(message, text, reply_markup=PORTFOLIO_OPTIONS)
+
+@dp.message_handler(state="waiting_for_import_file", content_types=types.ContentTypes.TEXT)
+async def import_file_expected(message: types.Message, state: FSMContext):
+  # Кнопки меню работают и во время ожидания файла
+  if text_router.match(message):
+      await state.finish()
+      return await text_router.dispatch(message)
+
+  return await reply(message, "Отправьте файл CSV или JSON с позициями или нажмите 'Назад'.")
+
+@text_router.text("Экспорт активов")
+async def export_portfolio(message: types.Message):
+  user = await repository.get_user(message.from_user.id)
+  if not user:
+      return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+  data = await repository.export_portfolio(user[0])
+  await message.reply_document(InputFile(io.BytesIO(data), filename='portfolio.csv'))
+
+@text_router.text("Назад в главное меню")
 async def back_to_main_menu(message: types.Message):
-  await send_welcome(message)
+  return await send_welcome(message)
 
-@dp.message_handler(lambda message: message.text == "Назад")
+@text_router.text("Назад")
 async def back_to_previous_step(message: types.Message):
      # Возвращаемся к меню портфеля.
-     await portfolio_menu(message)
+     return await portfolio_menu(message)
 
 def back_button():
      markup_back_portfolio_menu=ReplyKeyboardMarkup(resize_keyboard=True) 
@@ -479,6 +848,11 @@ def back_button():
      markup_back_portfolio_menu.add(button_back_to_portfolio_menu)  
      return markup_back_portfolio_menu
 
+def asset_kind_menu():
+     markup=ReplyKeyboardMarkup(resize_keyboard=True)
+     markup.row(KeyboardButton("Акция"), KeyboardButton("Криптовалюта")).add(KeyboardButton("Назад"))
+     return markup
+
 def currency_back_button():
      markup_currency_back_menu=ReplyKeyboardMarkup(resize_keyboard=True) 
      button_return_to_main_menu=KeyboardButton("Возврат в главное меню")  
@@ -486,11 +860,155 @@ def currency_back_button():
      markup_currency_back_menu.add(button_return_to_main_menu)  
      return markup_currency_back_menu
 
+# Клавиатуры собираются и сериализуются один раз при запуске
+MAIN_MENU = render_keyboard(main_menu())
+REGISTRATION_MENU = render_keyboard(registration_menu())
+PORTFOLIO_OPTIONS = render_keyboard(portfolio_options())
+BACK_BUTTON = render_keyboard(back_button())
+CURRENCY_BACK_BUTTON = render_keyboard(currency_back_button())
+ASSET_KIND_MENU = render_keyboard(asset_kind_menu())
+
 # Обработчик кнопки "Возврат в главное меню"
-@dp.message_handler(lambda message: message.text == "Возврат в главное меню")
+@text_router.text("Возврат в главное меню")
 async def return_to_main_menu(message: types.Message):
-     await send_welcome(message)
+     return await send_welcome(message)
+
+# Вид актива для уведомления: указанный пользователем, иначе валюта ЦБ, а
+# остальные коды - по списку известных криптовалют (BTC на бирже - фонд).
+# Возвращает None, если котировки для этого вида нет
+async def detect_alert_kind(symbol, kind=None):
+     if kind is None:
+          if await alert_currency_rate(symbol) is not None:
+               return CURRENCY
+          kind = quote_kind(symbol)
+     if kind == CURRENCY:
+          price = await alert_currency_rate(symbol)
+     elif kind == CRYPTO:
+          price = await market_data.get_crypto_price(symbol)
+     else:
+          price = await market_data.get_stock_price(symbol)
+     return kind if price is not None else None
+
+# Создание уведомления: /alert USD > 100, /alert crypto BTC > 100000
+@text_router.command('alert')
+async def create_alert(message: types.Message):
+     user = await repository.get_user(message.from_user.id)
+     if not user:
+          return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+     parsed = parse_alert(message.get_args())
+     if parsed is None:
+          return await reply(message, "Укажите условие, например: /alert USD > 100, /alert AAPL < 150 или /alert crypto BTC > 100000")
+     requested_kind, symbol, direction, threshold = parsed
+
+     try:
+          kind = await detect_alert_kind(symbol, requested_kind)
+     except Exception as e:
+          return await reply(message, f"Произошла ошибка при создании уведомления: {str(e)}")
+     if kind is None:
+          return await reply(message, f"Не удалось найти котировку для: {symbol}. Вид актива можно указать: /alert stock|crypto|currency {symbol} ...")
+
+     alert = await alert_engine.add(user[0], message.from_user.id, kind, symbol, direction, threshold)
+     return await reply(message, f"Уведомление #{alert.id} создано: {symbol} ({KIND_NAMES[kind]}) {direction} {threshold:g} {price_unit(kind)}")
+
+# Список активных уведомлений
+@text_router.command('alerts')
+async def list_alerts(message: types.Message):
+     user = await repository.get_user(message.from_user.id)
+     if not user:
+          return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+     alerts = await alert_engine.user_alerts(user[0])
+     if not alerts:
+          return await reply(message, "У вас нет активных уведомлений.")
+     lines = [f"#{alert_id}: {symbol} ({KIND_NAMES.get(kind, kind)}) {direction} {threshold:g} {price_unit(kind)}" for alert_id, kind, symbol, direction, threshold in alerts]
+     return await reply(message, "Ваши уведомления:\n" + "\n".join(lines) + "\n\nУдалить: /unalert номер")
+
+# Удаление уведомления: /unalert 5
+@text_router.command('unalert')
+async def remove_alert(message: types.Message):
+     user = await repository.get_user(message.from_user.id)
+     if not user:
+          return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+     alert_id = message.get_args().strip().lstrip('#')
+     if not alert_id.isdigit():
+          return await reply(message, "Укажите номер уведомления, например: /unalert 5")
+     if await alert_engine.remove(user[0], int(alert_id)):
+          return await reply(message, f"Уведомление #{alert_id} удалено.")
+     return await reply(message, f"Уведомление #{alert_id} не найдено.")
+
+# Вид актива позиции: /kind BTC crypto. Нужен для позиций, добавленных
+# без вида: по нему выбирается поставщик котировок
+@text_router.command('kind')
+async def set_asset_kind(message: types.Message):
+     user = await repository.get_user(message.from_user.id)
+     if not user:
+          return await reply(message, "Пожалуйста, зарегистрируйтесь.", reply_markup=REGISTRATION_MENU)
+
+     args = message.get_args().split()
+     asset_kind = parse_kind(args[1]) if len(args) == 2 else None
+     if asset_kind not in POSITION_KINDS:
+          return await reply(message, "Укажите символ и вид актива, например: /kind BTC crypto или /kind AAPL stock")
+     symbol = args[0].upper()
+     if await repository.set_asset_kind(user[0], symbol, asset_kind):
+          return await reply(message, f"{symbol}: {KIND_NAMES[asset_kind]}.")
+     return await reply(message, f"Актив {symbol} не найден в вашем портфеле.")
+
+# Замеры всех обработчиков и значения, которые читаются при запросе метрик
+if metrics:
+    metrics.instrument_dispatcher(dp, text_router)
+    metrics.track_cache('quotes', market_data.cache)
+    metrics.track_cache('cbr_rates', rates_cache)
+    metrics.track_cache('users', repository.user_cache)
+    metrics.track_breakers(breakers)
+    metrics.track_value('send_queue_pending', "Сообщения в очереди отправки", lambda: send_queue.pending)
+    metrics.track_value('messages_sent_total', "Отправленные сообщения", lambda: send_queue.sent, type='counter')
+    metrics.track_value('messages_failed_total', "Неотправленные сообщения", lambda: send_queue.failed, type='counter')
+    metrics.track_value('db_write_transactions_total', "Транзакции потока-писателя", lambda: async_db.transactions, type='counter')
+    metrics.track_value('alerts_active', "Активные ценовые уведомления", lambda: len(alert_engine.index))
+    if alpha_vantage_limiter:
+        metrics.track_value('alpha_vantage_waiting', "Запросы в очереди к Alpha Vantage", lambda: alpha_vantage_limiter.waiting)
+
+# Запускаем фоновое обновление котировок и проверку уведомлений вместе с ботом.
+# База создается и мигрирует здесь, а не при импорте модуля
+async def on_startup(dp):
+     create_db()
+     if metrics:
+          await metrics.start(METRICS_HOST, METRICS_PORT, lag_interval=METRICS_LOOP_LAG_INTERVAL)
+     # Горячие котировки обновляют процессы, которые обрабатывают запросы
+     # пользователей; у супервизора запросов нет
+     if not IS_SUPERVISOR:
+          prefetch_scheduler.start()
+     # Уведомления проверяет один процесс: супервизор или единственный процесс бота
+     if BOT_WORKER_INDEX is None:
+          await alert_engine.load()
+          alert_engine.start()
+
+# Закрываем пул HTTP-соединений и базу данных при остановке бота
+async def on_shutdown(dp):
+     await prefetch_scheduler.stop()
+     await alert_engine.stop()
+     if metrics:
+          await metrics.stop()
+     # Сохраняем накопленные состояния FSM, пока база еще открыта
+     await dp.storage.close()
+     await http_client.close()
+     async_db.close()
+     db.close()
+
+# Рабочий процесс супервизора: при запуске через spawn модуль импортируется
+# заново, и процесс работает со своими ботом, диспетчером и базой
+def run_worker(index, queue):
+     serve_updates(dp, queue, on_startup, on_shutdown)
 
 # Запуск бота
 if __name__ == '__main__':
-     executor.start_polling(dp ,skip_updates=True)
\ No newline at end of file
+     if BOT_MODE == 'webhook':
+          start_webhook(dp, WEBHOOK_URL, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT,
+                        secret_token=WEBHOOK_SECRET, max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+                        on_startup=on_startup, on_shutdown=on_shutdown)
+     elif BOT_WORKERS > 1:
+          start_supervisor(dp, WorkerPool(run_worker, BOT_WORKERS), on_startup=on_startup, on_shutdown=on_shutdown)
+     else:
+          executor.start_polling(dp ,skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
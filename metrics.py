@@ -0,0 +1,340 @@
+import asyncio
+import functools
+import logging
+import time
+
+from aiohttp import web
+
+from breaker import STATE_VALUES
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, (), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, labels, extra, value in self.samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+
+# Значения, которые считываются в момент запроса метрик: счетчики кэшей,
+# длины очередей. Горячий путь за них ничего не платит.
+# fn возвращает {кортеж значений меток: число}
+class CallbackMetric(Metric):
+    def __init__(self, name, help, type, fn, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        try:
+            values = self.fn()
+        except Exception:
+            logger.exception("Не удалось получить значение метрики %s", self.name)
+            return
+        for labels, value in values.items():
+            if value is not None:
+                yield self.name, labels, (), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            # Счетчики по корзинам, сумма и число наблюдений
+            state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels, (('le', _format_value(float(bound))),), cumulative
+            yield f'{self.name}_bucket', labels, (('le', '+Inf'),), count
+            yield f'{self.name}_sum', labels, (), total
+            yield f'{self.name}_count', labels, (), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика уже зарегистрирована: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, type, fn, labelnames=()):
+        return self.register(CallbackMetric(name, help, type, fn, labelnames))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+# Поставщики за методами MarketDataProvider
+PROVIDER_METHODS = {
+    'get_exchange_rates': 'cbr',
+    'get_crypto_price': 'alpha_vantage',
+    'get_crypto_history': 'alpha_vantage',
+    'get_stock_price': 'yahoo',
+    'get_stock_history': 'yahoo',
+}
+
+
+# Метрики бота: задержки и ошибки обработчиков, запросов к базе и поставщикам,
+# число выполняющихся запросов и задержка event loop. Замеры подключаются
+# обертками при запуске; если метрики выключены, обертки не ставятся
+# и горячий путь остается без изменений
+class Metrics:
+    def __init__(self, registry=None, prefix='finance_bot'):
+        self.registry = registry if registry is not None else Registry()
+        self.prefix = prefix
+        registry = self.registry
+
+        self.handler_duration = registry.histogram(
+            f'{prefix}_handler_duration_seconds', "Время обработки сообщения", ('handler',))
+        self.handler_errors = registry.counter(
+            f'{prefix}_handler_errors_total', "Исключения в обработчиках", ('handler',))
+        self.handler_in_flight = registry.gauge(
+            f'{prefix}_handler_in_flight', "Сообщения в обработке", ('handler',))
+
+        self.db_duration = registry.histogram(
+            f'{prefix}_db_duration_seconds', "Время запроса к базе, включая ожидание пула и писателя",
+            ('operation', 'query'))
+        self.db_errors = registry.counter(
+            f'{prefix}_db_errors_total', "Ошибки запросов к базе", ('operation', 'query'))
+        self.db_in_flight = registry.gauge(
+            f'{prefix}_db_in_flight', "Запросы к базе в ожидании и выполнении", ('operation',))
+
+        self.provider_duration = registry.histogram(
+            f'{prefix}_provider_duration_seconds', "Время запроса к поставщику котировок",
+            ('provider', 'method'))
+        self.provider_errors = registry.counter(
+            f'{prefix}_provider_errors_total', "Ошибки запросов к поставщикам", ('provider', 'method'))
+        self.provider_in_flight = registry.gauge(
+            f'{prefix}_provider_in_flight', "Запросы к поставщикам в полете", ('provider',))
+
+        self.loop_lag = registry.gauge(
+            f'{prefix}_event_loop_lag_seconds', "Последняя задержка event loop")
+        self.loop_lag_histogram = registry.histogram(
+            f'{prefix}_event_loop_lag_seconds_distribution', "Распределение задержки event loop")
+
+        self._caches = {}
+        registry.callback(f'{prefix}_cache_hits_total', "Попадания в кэш", 'counter',
+                          lambda: {(name,): cache.hits for name, cache in self._caches.items()}, ('cache',))
+        registry.callback(f'{prefix}_cache_misses_total', "Промахи кэша", 'counter',
+                          lambda: {(name,): cache.misses for name, cache in self._caches.items()}, ('cache',))
+        registry.callback(f'{prefix}_cache_hit_ratio', "Доля попаданий в кэш", 'gauge',
+                          lambda: {(name,): self._hit_ratio(cache) for name, cache in self._caches.items()},
+                          ('cache',))
+
+        self._lag_task = None
+        self._runner = None
+
+    @staticmethod
+    def _hit_ratio(cache):
+        total = cache.hits + cache.misses
+        return cache.hits / total if total else None
+
+    # Объект со счетчиками hits и misses
+    def track_cache(self, name, cache):
+        self._caches[name] = cache
+
+    # Предохранители поставщиков: имя -> CircuitBreaker
+    def track_breakers(self, breakers):
+        registry, prefix = self.registry, self.prefix
+        registry.callback(f'{prefix}_provider_circuit_state', "Состояние предохранителя: 0 - замкнут, 1 - проба, 2 - разомкнут",
+                          'gauge', lambda: {(name,): STATE_VALUES[breaker.state] for name, breaker in breakers.items()},
+                          ('provider',))
+        registry.callback(f'{prefix}_provider_circuit_opened_total', "Размыкания предохранителя", 'counter',
+                          lambda: {(name,): breaker.opened for name, breaker in breakers.items()}, ('provider',))
+        registry.callback(f'{prefix}_provider_circuit_rejected_total', "Запросы, отклоненные предохранителем",
+                          'counter', lambda: {(name,): breaker.rejected for name, breaker in breakers.items()},
+                          ('provider',))
+
+    # Значение, которое считывается при запросе метрик: fn() -> число
+    def track_value(self, name, help, fn, type='gauge'):
+        self.registry.callback(f'{self.prefix}_{name}', help, type, lambda: {(): fn()})
+
+    def _timed(self, fn, duration, errors, in_flight, labels, in_flight_labels):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            in_flight.inc(*in_flight_labels)
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                errors.inc(*labels)
+                raise
+            finally:
+                duration.observe(time.perf_counter() - started, *labels)
+                in_flight.dec(*in_flight_labels)
+        return wrapper
+
+    def instrument_handler(self, handler, name=None):
+        name = name or handler.__name__
+        return self._timed(handler, self.handler_duration, self.handler_errors,
+                           self.handler_in_flight, (name,), (name,))
+
+    # Оборачивает обработчики диспетчера и маршрутизатора текстов
+    def instrument_dispatcher(self, dp, text_router=None):
+        for handlers in (dp.message_handlers, dp.callback_query_handlers):
+            for handler_obj in handlers.handlers:
+                if text_router is not None and handler_obj.handler == text_router.dispatch:
+                    continue
+                handler_obj.handler = self.instrument_handler(handler_obj.handler)
+        if text_router is not None:
+            text_router.wrap_handlers(self.instrument_handler)
+
+    def instrument_database(self, async_db):
+        return InstrumentedDatabase(async_db, self)
+
+    def instrument_provider(self, provider):
+        for method, provider_name in PROVIDER_METHODS.items():
+            fn = getattr(provider, method, None)
+            if fn is not None:
+                setattr(provider, method, self._timed(
+                    fn, self.provider_duration, self.provider_errors, self.provider_in_flight,
+                    (provider_name, method), (provider_name,)))
+        return provider
+
+    async def _measure_loop_lag(self, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - started - interval)
+            self.loop_lag.set(lag)
+            self.loop_lag_histogram.observe(lag)
+
+    async def handle_metrics(self, request):
+        return web.Response(body=self.registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    async def start(self, host='0.0.0.0', port=9100, lag_interval=0.5):
+        if self._lag_task is None:
+            self._lag_task = asyncio.ensure_future(self._measure_loop_lag(lag_interval))
+        if self._runner is None:
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle_metrics)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            try:
+                await self._lag_task
+            except asyncio.CancelledError:
+                pass
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Асинхронная база с замерами read/write по имени SQL-функции
+class InstrumentedDatabase:
+    def __init__(self, async_db, metrics):
+        self.async_db = async_db
+        self.metrics = metrics
+
+    async def _call(self, operation, method, fn, args):
+        labels = (operation, getattr(fn, '__name__', 'unknown'))
+        metrics = self.metrics
+        metrics.db_in_flight.inc(operation)
+        started = time.perf_counter()
+        try:
+            return await method(fn, *args)
+        except Exception:
+            metrics.db_errors.inc(*labels)
+            raise
+        finally:
+            metrics.db_duration.observe(time.perf_counter() - started, *labels)
+            metrics.db_in_flight.dec(operation)
+
+    async def read(self, fn, *args):
+        return await self._call('read', self.async_db.read, fn, args)
+
+    async def write(self, fn, *args):
+        return await self._call('write', self.async_db.write, fn, args)
+
+    def __getattr__(self, name):
+        return getattr(self.async_db, name)
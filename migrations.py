@@ -0,0 +1,185 @@
+# До версии 3 бот сохранял в purchase_price стоимость всей покупки
+# (цена за единицу * количество), затем - цену за единицу. Позиции из таких
+# баз пересчитываются в цену за единицу; from_version - версия до обновления
+def convert_total_prices(cursor, from_version):
+    if from_version >= 3:
+        return
+    cursor.execute('''
+    UPDATE portfolio SET purchase_price = purchase_price / quantity WHERE quantity > 0
+    ''')
+
+
+# Версионированные миграции схемы. Текущая версия хранится в PRAGMA user_version,
+# при запуске применяются только миграции с большим номером.
+# Шаг миграции - SQL-запрос или функция(cursor, from_version) для данных.
+# Новые миграции добавляются в конец списка, старые не меняются
+MIGRATIONS = [
+    (1, [
+        # Создание таблицы пользователей
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Создание таблицы портфеля
+        '''
+        CREATE TABLE IF NOT EXISTS portfolio (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            stock_symbol TEXT,
+            quantity INTEGER,
+            purchase_price REAL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        ''',
+    ]),
+    (2, [
+        # Перед созданием уникального индекса сливаем возможные дубликаты позиций
+        '''
+        UPDATE portfolio SET
+            quantity = (
+                SELECT SUM(d.quantity) FROM portfolio d
+                WHERE d.user_id = portfolio.user_id AND d.stock_symbol = portfolio.stock_symbol
+            ),
+            purchase_price = (
+                SELECT ROUND(SUM(d.quantity * d.purchase_price) / SUM(d.quantity), 2) FROM portfolio d
+                WHERE d.user_id = portfolio.user_id AND d.stock_symbol = portfolio.stock_symbol
+            )
+        WHERE id IN (
+            SELECT MIN(id) FROM portfolio GROUP BY user_id, stock_symbol HAVING COUNT(*) > 1
+        )
+        ''',
+        '''
+        DELETE FROM portfolio WHERE id NOT IN (
+            SELECT MIN(id) FROM portfolio GROUP BY user_id, stock_symbol
+        )
+        ''',
+        # Индекс для поиска позиции и UPSERT по (user_id, stock_symbol)
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_portfolio_user_symbol
+        ON portfolio (user_id, stock_symbol)
+        ''',
+    ]),
+    (3, [
+        # Дневные цены закрытия по поставщику и символу для сравнения с прошлыми днями
+        '''
+        CREATE TABLE IF NOT EXISTS price_history (
+            provider TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            day DATE NOT NULL,
+            close REAL NOT NULL,
+            PRIMARY KEY (provider, symbol, day)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (4, [
+        # Состояния FSM: JSON-запись на пользователя и срок, после которого диалог брошен
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            record TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_fsm_state_expires_at ON fsm_state (expires_at)
+        ''',
+    ]),
+    (5, [
+        # Ценовые уведомления: сработавшие остаются в таблице с временем срабатывания
+        '''
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            threshold REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            triggered_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        ''',
+        # Активные уведомления пользователя; при запуске читаются все активные
+        '''
+        CREATE INDEX IF NOT EXISTS idx_alerts_active_user ON alerts (user_id) WHERE triggered_at IS NULL
+        ''',
+    ]),
+    (6, [
+        # Цена покупки - за единицу актива
+        convert_total_prices,
+    ]),
+    (7, [
+        # Вид актива позиции: crypto или stock. NULL - вид не указан
+        # (позиции, добавленные до версии 7), его спрашиваем у пользователя
+        '''
+        ALTER TABLE portfolio ADD COLUMN kind TEXT
+        ''',
+    ]),
+    (8, [
+        # Символы ищутся в верхнем регистре, а старые позиции могли быть
+        # сохранены как введены. Позиции, отличающиеся только регистром,
+        # сливаются в одну так же, как в версии 2; вид берется у любой из них
+        '''
+        UPDATE portfolio SET
+            quantity = (
+                SELECT SUM(d.quantity) FROM portfolio d
+                WHERE d.user_id = portfolio.user_id AND UPPER(d.stock_symbol) = UPPER(portfolio.stock_symbol)
+            ),
+            purchase_price = (
+                SELECT ROUND(SUM(d.quantity * d.purchase_price) / SUM(d.quantity), 2) FROM portfolio d
+                WHERE d.user_id = portfolio.user_id AND UPPER(d.stock_symbol) = UPPER(portfolio.stock_symbol)
+            ),
+            kind = COALESCE(kind, (
+                SELECT MAX(d.kind) FROM portfolio d
+                WHERE d.user_id = portfolio.user_id AND UPPER(d.stock_symbol) = UPPER(portfolio.stock_symbol)
+            ))
+        WHERE id IN (
+            SELECT MIN(id) FROM portfolio GROUP BY user_id, UPPER(stock_symbol) HAVING COUNT(*) > 1
+        )
+        ''',
+        '''
+        DELETE FROM portfolio WHERE id NOT IN (
+            SELECT MIN(id) FROM portfolio GROUP BY user_id, UPPER(stock_symbol)
+        )
+        ''',
+        '''
+        UPDATE portfolio SET stock_symbol = UPPER(stock_symbol) WHERE stock_symbol != UPPER(stock_symbol)
+        ''',
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(cursor):
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+# Применяет недостающие миграции в одной транзакции и возвращает итоговую версию
+def apply_migrations(cursor, migrations=MIGRATIONS):
+    current_version = get_schema_version(cursor)
+    if all(version <= current_version for version, _ in migrations):
+        return current_version
+
+    # Рабочие процессы стартуют одновременно: миграции применяет тот, кто
+    # первым взял блокировку записи, остальные перечитывают версию после него
+    cursor.execute('BEGIN IMMEDIATE')
+    current_version = get_schema_version(cursor)
+    pending = [(version, statements) for version, statements in migrations if version > current_version]
+    if not pending:
+        return current_version
+
+    from_version = current_version
+    for version, statements in pending:
+        for statement in statements:
+            if callable(statement):
+                statement(cursor, from_version)
+            else:
+                cursor.execute(statement)
+        cursor.execute(f'PRAGMA user_version = {int(version)}')
+    return pending[-1][0]
@@ -0,0 +1,236 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import Counter, deque
+
+from aiogram import Bot
+from aiogram.bot.api import Methods
+from aiogram.utils.exceptions import RetryAfter
+
+from cache import LRUCache
+from ratelimit import TokenBucket, BACKGROUND, request_priority
+
+logger = logging.getLogger(__name__)
+
+# Методы Bot API, которые отправляют сообщение в чат и попадают под лимиты Telegram
+SEND_METHODS = frozenset({
+    Methods.SEND_MESSAGE, Methods.SEND_PHOTO, Methods.SEND_DOCUMENT,
+    Methods.SEND_MEDIA_GROUP, Methods.SEND_ANIMATION, Methods.SEND_AUDIO,
+    Methods.SEND_VOICE, Methods.SEND_VIDEO, Methods.SEND_STICKER,
+    Methods.COPY_MESSAGE, Methods.FORWARD_MESSAGE, Methods.EDIT_MESSAGE_TEXT,
+})
+
+
+# Очередь исходящих сообщений. Сообщение уходит, когда есть токен в общем
+# ведре бота и в ведре чата. Ожидающие обслуживаются по приоритету
+# (ответы пользователям раньше рассылок), внутри чата - по порядку отправки.
+# Чат, упершийся в свой лимит, не задерживает сообщения в другие чаты
+class SendQueue:
+    def __init__(self, global_bucket, chat_rate=1, chat_capacity=3, max_retries=3,
+                 max_chats=10000, stats_window=60, clock=time.monotonic):
+        self.global_bucket = global_bucket
+        self.chat_rate = chat_rate
+        self.chat_capacity = chat_capacity
+        self.max_retries = max_retries
+        self.stats_window = stats_window
+        self.clock = clock
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.sent_by_priority = Counter()
+        # Давно молчавший чат и так получил бы полное ведро, поэтому
+        # вытеснение старых ведер из LRU лимиты не нарушает
+        self._buckets = LRUCache(maxsize=max_chats)
+        self._sent_times = deque()
+        # Чат -> куча ожидающих (priority, seq, future)
+        self._queues = {}
+        # Первые в очереди своего чата: готовые к отправке и ждущие токен чата
+        self._ready = []
+        self._sleeping = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_capacity, clock=self.clock)
+            self._buckets.set(chat_id, bucket)
+        return bucket
+
+    # Ставит в очередь следующего ожидающего чата, если он есть
+    def _schedule_head(self, chat_id):
+        queue = self._queues.get(chat_id)
+        while queue and queue[0][2].done():
+            heapq.heappop(queue)
+        if not queue:
+            self._queues.pop(chat_id, None)
+            return
+        priority, seq, _ = queue[0]
+        heapq.heappush(self._ready, (priority, seq, chat_id))
+
+    # Первый готовый чат без устаревших записей (ушедших или уже обслуженных)
+    def _next_ready(self):
+        while self._ready:
+            priority, seq, chat_id = self._ready[0]
+            queue = self._queues.get(chat_id)
+            if queue and queue[0][:2] == (priority, seq):
+                if not queue[0][2].done():
+                    return self._ready[0]
+                heapq.heappop(self._ready)
+                self._schedule_head(chat_id)
+                continue
+            heapq.heappop(self._ready)
+        return None
+
+    async def acquire(self, chat_id, priority=None, seq=None):
+        if priority is None:
+            priority = request_priority.get()
+        if seq is None:
+            seq = next(self._sequence)
+
+        bucket = self._bucket(chat_id)
+        if (not self._ready and chat_id not in self._queues
+                and self.global_bucket.available() >= 1 and bucket.available() >= 1):
+            self.global_bucket.take()
+            bucket.take()
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, [])
+        heapq.heappush(queue, (priority, seq, future))
+        if queue[0][2] is future:
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        self._wakeup.set()
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _wait(self, delay):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self):
+        try:
+            while self._queues:
+                now = self.clock()
+                while self._sleeping and self._sleeping[0][0] <= now:
+                    _, priority, seq, chat_id = heapq.heappop(self._sleeping)
+                    heapq.heappush(self._ready, (priority, seq, chat_id))
+
+                head = self._next_ready()
+                if head is None:
+                    if not self._queues:
+                        break
+                    await self._wait(self._sleeping[0][0] - now if self._sleeping else None)
+                    continue
+
+                priority, seq, chat_id = head
+                bucket = self._bucket(chat_id)
+                if bucket.available() < 1:
+                    heapq.heappop(self._ready)
+                    heapq.heappush(self._sleeping, (now + bucket.time_until_token(), priority, seq, chat_id))
+                    continue
+                if self.global_bucket.available() < 1:
+                    await self._wait(self.global_bucket.time_until_token())
+                    continue
+
+                heapq.heappop(self._ready)
+                future = heapq.heappop(self._queues[chat_id])[2]
+                self.global_bucket.take()
+                bucket.take()
+                future.set_result(None)
+                self._schedule_head(chat_id)
+        finally:
+            self._dispatcher = None
+
+    # Отправка через очередь. Ответ 429 с retry_after - ограничение всего
+    # бота, а не одного чата: на retry_after секунд замолкают и чат, и общее
+    # ведро, а сообщение повторяется, сохраняя свое место в очереди чата
+    async def send(self, chat_id, fn, *args, priority=None, **kwargs):
+        if priority is None:
+            priority = request_priority.get()
+        seq = next(self._sequence)
+        attempt = 0
+        while True:
+            await self.acquire(chat_id, priority, seq)
+            try:
+                result = await fn(*args, **kwargs)
+            except RetryAfter as e:
+                self._bucket(chat_id).pause(e.timeout)
+                self.global_bucket.pause(e.timeout)
+                self._wakeup.set()
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                continue
+            except Exception:
+                self.failed += 1
+                raise
+            self._record_sent(priority)
+            return result
+
+    def _record_sent(self, priority):
+        self.sent += 1
+        self.sent_by_priority[priority] += 1
+        now = self.clock()
+        self._sent_times.append(now)
+        while self._sent_times and self._sent_times[0] <= now - self.stats_window:
+            self._sent_times.popleft()
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    # Сообщений в секунду за последние stats_window секунд
+    def throughput(self):
+        now = self.clock()
+        while self._sent_times and self._sent_times[0] <= now - self.stats_window:
+            self._sent_times.popleft()
+        return len(self._sent_times) / self.stats_window
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'pending': self.pending,
+            'sent_by_priority': dict(self.sent_by_priority),
+            'throughput': self.throughput(),
+        }
+
+
+# Бот, отправляющий сообщения в чаты через очередь SendQueue
+class QueuedBot(Bot):
+    def __init__(self, token, send_queue=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.send_queue = send_queue
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = data.get('chat_id') if data else None
+        if self.send_queue is None or method not in SEND_METHODS or chat_id is None:
+            return await super().request(method, data, files, **kwargs)
+        return await self.send_queue.send(chat_id, super().request, method, data, files, **kwargs)
+
+
+# Рассылка одного текста многим чатам с приоритетом фоновых отправок.
+# Возвращает число доставленных сообщений
+async def broadcast(bot, chat_ids, text, **kwargs):
+    async def send(chat_id):
+        request_priority.set(BACKGROUND)
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return True
+        except Exception:
+            logger.exception("Не удалось отправить сообщение в чат %s", chat_id)
+            return False
+
+    results = await asyncio.gather(*(send(chat_id) for chat_id in chat_ids))
+    return sum(results)
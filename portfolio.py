@@ -0,0 +1,157 @@
+import asyncio
+
+from assets import CRYPTO, STOCK
+
+
+# Оценка одной позиции портфеля. price=None - котировка не успела прийти
+# или вид актива (kind) не указан
+class PositionValue:
+    __slots__ = ('symbol', 'quantity', 'purchase_price', 'price', 'kind')
+
+    def __init__(self, symbol, quantity, purchase_price, price, kind=None):
+        self.symbol = symbol
+        self.quantity = quantity
+        self.purchase_price = purchase_price
+        self.price = price
+        self.kind = kind
+
+    @property
+    def cost(self):
+        return self.quantity * self.purchase_price
+
+    @property
+    def value(self):
+        return None if self.price is None else self.quantity * self.price
+
+    @property
+    def pnl(self):
+        return None if self.price is None else self.value - self.cost
+
+    @property
+    def pnl_percent(self):
+        if self.price is None or not self.cost:
+            return None
+        return self.pnl / self.cost * 100
+
+
+class PortfolioValuation:
+    def __init__(self, positions):
+        self.positions = positions
+
+    @property
+    def priced(self):
+        return [position for position in self.positions if position.price is not None]
+
+    # Позиции без котировки, хотя вид актива известен
+    @property
+    def unknown(self):
+        return [position for position in self.positions if position.price is None and position.kind is not None]
+
+    # Позиции, для которых вид актива нужно спросить у пользователя
+    @property
+    def unclassified(self):
+        return [position for position in self.positions if position.kind is None]
+
+    # Итоги считаются только по позициям с известной текущей ценой
+    @property
+    def total_cost(self):
+        return sum(position.cost for position in self.priced)
+
+    @property
+    def total_value(self):
+        return sum(position.value for position in self.priced)
+
+    @property
+    def total_pnl(self):
+        return self.total_value - self.total_cost
+
+    @property
+    def total_pnl_percent(self):
+        total_cost = self.total_cost
+        return self.total_pnl / total_cost * 100 if total_cost else None
+
+
+def _consume_result(task):
+    # Результат опоздавшего запроса не нужен, но исключение нужно забрать,
+    # иначе asyncio напишет в лог "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+# Текущая оценка портфеля: котировки всех символов запрашиваются одной
+# параллельной пачкой без дубликатов и с общим сроком ожидания
+class PortfolioValuator:
+    def __init__(self, provider, deadline=5.0):
+        self.provider = provider
+        self.deadline = deadline
+
+    # Поставщик выбирается по виду актива: BTC на бирже и BTC-криптовалюта -
+    # разные активы. Без вида котировка не запрашивается
+    async def get_price(self, symbol, kind):
+        if kind == CRYPTO:
+            return await self.provider.get_crypto_price(symbol)
+        if kind == STOCK:
+            return await self.provider.get_stock_price(symbol)
+        return None
+
+    # assets - пары (символ, вид); результат: (символ, вид) -> цена или None
+    async def fetch_quotes(self, assets):
+        quotes = dict.fromkeys(assets)
+        known_assets = [asset for asset in quotes if asset[1] in (CRYPTO, STOCK)]
+        if not known_assets:
+            return quotes
+
+        tasks = {asset: asyncio.ensure_future(self.get_price(*asset)) for asset in known_assets}
+        done, pending = await asyncio.wait(tasks.values(), timeout=self.deadline)
+        # Медленные запросы не отменяем: пусть догрузятся в фоне и прогреют кэши
+        for task in pending:
+            task.add_done_callback(_consume_result)
+
+        for asset, task in tasks.items():
+            if task in done and task.exception() is None:
+                quotes[asset] = task.result()
+        return quotes
+
+    # Строки портфеля: (id, user_id, символ, количество, цена покупки, вид)
+    async def value(self, portfolio_items):
+        quotes = await self.fetch_quotes((item[2].upper(), item[5]) for item in portfolio_items)
+        positions = [
+            PositionValue(item[2], item[3], item[4], quotes.get((item[2].upper(), item[5])), item[5])
+            for item in portfolio_items
+        ]
+        return PortfolioValuation(positions)
+
+
+def _signed(value):
+    return f"{value:+.2f}"
+
+
+def format_portfolio(valuation):
+    lines = ["Ваши активы:"]
+    for position in valuation.positions:
+        line = f"{position.symbol}: {position.quantity} шт., цена покупки {position.purchase_price:.2f}"
+        if position.kind is None:
+            line += ", вид актива не указан"
+        elif position.price is None:
+            line += ", текущая цена недоступна"
+        else:
+            line += f", текущая {position.price:.2f}, стоимость {position.value:.2f}, P&L {_signed(position.pnl)}"
+            if position.pnl_percent is not None:
+                line += f" ({_signed(position.pnl_percent)}%)"
+        lines.append(line)
+
+    if valuation.priced:
+        total = (f"\nИтого: стоимость {valuation.total_value:.2f}, вложено {valuation.total_cost:.2f}, "
+                 f"P&L {_signed(valuation.total_pnl)}")
+        if valuation.total_pnl_percent is not None:
+            total += f" ({_signed(valuation.total_pnl_percent)}%)"
+        lines.append(total)
+    if valuation.unknown:
+        symbols = ", ".join(position.symbol for position in valuation.unknown)
+        lines.append(f"Нет текущей котировки для: {symbols}")
+    if valuation.unclassified:
+        symbol = valuation.unclassified[0].symbol
+        symbols = ", ".join(position.symbol for position in valuation.unclassified)
+        lines.append(f"Укажите вид актива для: {symbols}\n"
+                     f"Например: /kind {symbol} crypto или /kind {symbol} stock")
+    return "\n".join(lines)
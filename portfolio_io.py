@@ -0,0 +1,188 @@
+import csv
+import io
+import json
+
+from assets import POSITION_KINDS, parse_kind
+
+CSV = 'csv'
+JSON = 'json'
+
+# Колонки файла портфеля; цену покупки можно назвать и просто price.
+# Вид актива (stock или crypto) необязателен: без него вид спросим позже
+CSV_COLUMNS = ('symbol', 'quantity', 'purchase_price')
+KIND_COLUMN = 'kind'
+COLUMN_ALIASES = {'stock_symbol': 'symbol', 'price': 'purchase_price', 'type': 'kind'}
+
+# Сколько ошибок в строках показывать пользователю
+MAX_REPORTED_ERRORS = 10
+
+
+class PortfolioFileError(ValueError):
+    pass
+
+
+# Позиции файла, которые не удалось разобрать, не прерывают импорт:
+# errors - пары (номер строки, причина)
+class ImportResult:
+    def __init__(self):
+        self.positions = []
+        self.errors = []
+
+    def format_errors(self):
+        lines = [f"строка {line}: {reason}" for line, reason in self.errors[:MAX_REPORTED_ERRORS]]
+        if len(self.errors) > MAX_REPORTED_ERRORS:
+            lines.append(f"и еще {len(self.errors) - MAX_REPORTED_ERRORS}")
+        return "\n".join(lines)
+
+
+def detect_format(filename, head):
+    extension = (filename or '').rsplit('.', 1)[-1].lower()
+    if extension in ('json', 'jsonl', 'ndjson'):
+        return JSON
+    if extension == 'csv':
+        return CSV
+    return JSON if head.lstrip()[:1] in ('[', '{') else CSV
+
+
+# Позиция в том же виде, что и при вводе по шагам: символ в верхнем
+# регистре, целое количество, цена за единицу и вид актива или None
+def parse_position(symbol, quantity, price, kind=None):
+    symbol = str(symbol or '').strip().upper()
+    if not symbol:
+        raise ValueError("не указан символ")
+
+    quantity_text = str(quantity).strip()
+    if not quantity_text.isdigit() or int(quantity_text) == 0:
+        raise ValueError(f"некорректное количество: {quantity}")
+
+    try:
+        purchase_price = float(str(price).strip().replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"некорректная цена: {price}") from None
+    if not purchase_price >= 0 or purchase_price == float('inf'):
+        raise ValueError(f"некорректная цена: {price}")
+
+    asset_kind = None
+    if str(kind or '').strip():
+        asset_kind = parse_kind(str(kind))
+        if asset_kind not in POSITION_KINDS:
+            raise ValueError(f"неизвестный вид актива: {kind}")
+
+    return symbol, int(quantity_text), purchase_price, asset_kind
+
+
+def _add_position(result, line, symbol, quantity, price, kind, max_rows):
+    if len(result.positions) >= max_rows:
+        raise PortfolioFileError(f"В файле больше {max_rows} позиций")
+    try:
+        result.positions.append(parse_position(symbol, quantity, price, kind))
+    except ValueError as e:
+        result.errors.append((line, str(e)))
+
+
+def _column_name(name):
+    name = name.strip().lower()
+    return COLUMN_ALIASES.get(name, name)
+
+
+# CSV читается построчно. Заголовок необязателен: без него колонки идут
+# в порядке symbol, quantity, purchase_price, kind. Разделитель - запятая или ";"
+def _parse_csv(stream, result, max_rows):
+    first_line = stream.readline()
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    reader = csv.reader(_chain_line(first_line, stream), delimiter=delimiter)
+
+    columns = CSV_COLUMNS + (KIND_COLUMN,)
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        if reader.line_num == 1 and _column_name(row[0]) in CSV_COLUMNS:
+            columns = [_column_name(cell) for cell in row]
+            missing = [column for column in CSV_COLUMNS if column not in columns]
+            if missing:
+                raise PortfolioFileError(f"В заголовке нет колонок: {', '.join(missing)}")
+            continue
+
+        values = dict(zip(columns, row))
+        if len(values) < len(CSV_COLUMNS):
+            result.errors.append((reader.line_num, "не хватает колонок"))
+            continue
+        _add_position(result, reader.line_num, values['symbol'], values['quantity'], values['purchase_price'],
+                      values.get(KIND_COLUMN), max_rows)
+
+
+def _chain_line(first_line, stream):
+    yield first_line
+    yield from stream
+
+
+def _json_item(result, line, item, max_rows):
+    if not isinstance(item, dict):
+        result.errors.append((line, "ожидается объект"))
+        return
+    values = {_column_name(key): value for key, value in item.items()}
+    _add_position(result, line, values.get('symbol'), values.get('quantity', ''),
+                  values.get('purchase_price', ''), values.get(KIND_COLUMN), max_rows)
+
+
+# JSON - массив объектов или по объекту в строке (JSON Lines); строки
+# разбираются по одной, массив - целиком
+def _parse_json(stream, result, max_rows):
+    first_line = stream.readline()
+    if first_line.lstrip().startswith('['):
+        try:
+            items = json.loads(first_line + stream.read())
+        except json.JSONDecodeError as e:
+            raise PortfolioFileError(f"Некорректный JSON: {e}") from None
+        if not isinstance(items, list):
+            raise PortfolioFileError("Ожидается массив позиций")
+        for number, item in enumerate(items, 1):
+            _json_item(result, number, item, max_rows)
+        return
+
+    for line_number, line in enumerate(_chain_line(first_line, stream), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            result.errors.append((line_number, "некорректный JSON"))
+            continue
+        _json_item(result, line_number, item, max_rows)
+
+
+# Разбор файла с позициями портфеля. data - байты файла в UTF-8
+def parse_portfolio_file(data, filename=None, max_rows=5000):
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+    try:
+        head = stream.read(64)
+        stream.seek(0)
+        result = ImportResult()
+        if detect_format(filename, head) == JSON:
+            _parse_json(stream, result, max_rows)
+        else:
+            _parse_csv(stream, result, max_rows)
+    except UnicodeDecodeError:
+        raise PortfolioFileError("Файл должен быть в кодировке UTF-8") from None
+    return result
+
+
+# Выгрузка портфеля: строки читаются курсором по мере записи в файл,
+# без промежуточного списка. Результат - байты файла в UTF-8
+def export_portfolio(cursor, user_id, fmt=CSV):
+    cursor.execute('''
+    SELECT stock_symbol, quantity, purchase_price, kind FROM portfolio WHERE user_id = ? ORDER BY stock_symbol
+    ''', (user_id,))
+
+    buffer = io.BytesIO()
+    stream = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+    if fmt == JSON:
+        for symbol, quantity, purchase_price, kind in cursor:
+            stream.write(json.dumps({'symbol': symbol, 'quantity': quantity, 'purchase_price': purchase_price,
+                                     'kind': kind}) + '\n')
+    else:
+        writer = csv.writer(stream)
+        writer.writerow(CSV_COLUMNS + (KIND_COLUMN,))
+        writer.writerows(cursor)
+    stream.flush()
+    return buffer.getvalue()
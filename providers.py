@@ -0,0 +1,283 @@
+from datetime import datetime, time as dt_time, timedelta, timezone
+
+import logging
+import time
+
+import aiohttp
+
+from cache import LRUCache, SingleFlight
+from ratelimit import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+CBR_DAILY_URL = 'http://www.cbr.ru/scripts/XML_daily.asp'
+ALPHA_VANTAGE_URL = 'https://www.alphavantage.co/query'
+YAHOO_CHART_URL = 'https://query1.finance.yahoo.com/v8/finance/chart/{symbol}'
+
+# Yahoo отвечает 429 на запросы без браузерного User-Agent
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0 (compatible; finance-bot/1.0)'}
+
+# Имена поставщиков: у каждого свой предохранитель
+PROVIDER_NAMES = ('cbr', 'alpha_vantage', 'yahoo')
+
+
+# Отказ поставщика для предохранителя: ответы 4xx, кроме 429, означают
+# ошибку в запросе (например, неизвестный тикер), а не недоступность
+def is_upstream_failure(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+# Общий HTTP-клиент с пулом соединений для всех поставщиков котировок
+class HttpClient:
+    def __init__(self, timeout=10, limit=100, limit_per_host=20, keepalive_timeout=30):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    # Сессия создается лениво, уже внутри работающего event loop
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers=DEFAULT_HEADERS,
+            )
+        return self._session
+
+    async def get_text(self, url, params=None):
+        async with self.session().get(url, params=params) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def get_bytes(self, url, params=None):
+        async with self.session().get(url, params=params) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def get_json(self, url, params=None):
+        async with self.session().get(url, params=params) as response:
+            response.raise_for_status()
+            # content_type=None: Alpha Vantage иногда отдает JSON как text/plain
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Асинхронные запросы к Банку России, Alpha Vantage и Yahoo Finance.
+# breakers: имя поставщика -> CircuitBreaker; HTTP-запрос к поставщику
+# идет через его предохранитель, ожидание квоты в срок запроса не входит
+class MarketDataProvider:
+    def __init__(self, http, alpha_vantage_api_key,
+                 cbr_url=CBR_DAILY_URL, alpha_vantage_url=ALPHA_VANTAGE_URL, yahoo_url=YAHOO_CHART_URL,
+                 alpha_vantage_limiter=None, breakers=None):
+        self.http = http
+        self.alpha_vantage_api_key = alpha_vantage_api_key
+        # Квота Alpha Vantage на ключ: каждый запрос сначала получает токен
+        self.alpha_vantage_limiter = alpha_vantage_limiter
+        self.breakers = breakers or {}
+        self.cbr_url = cbr_url
+        self.alpha_vantage_url = alpha_vantage_url
+        self.yahoo_url = yahoo_url
+
+    async def _request(self, provider, fetch, url, params):
+        breaker = self.breakers.get(provider)
+        if breaker is None:
+            return await fetch(url, params=params)
+        return await breaker.call(fetch, url, params)
+
+    async def get_exchange_rates(self, date):
+        # Документ отдаем байтами: кодировку windows-1251 разбирает XML-парсер
+        params = {'date_req': date.strftime("%d/%m/%Y")}
+        return await self._request('cbr', self.http.get_bytes, self.cbr_url, params)
+
+    async def _alpha_vantage_query(self, params):
+        if self.alpha_vantage_limiter is not None:
+            await self.alpha_vantage_limiter.acquire()
+        data = await self._request('alpha_vantage', self.http.get_json, self.alpha_vantage_url,
+                                   dict(params, apikey=self.alpha_vantage_api_key))
+        # При исчерпании квоты Alpha Vantage отвечает 200 с полем Note или Information
+        if "Note" in data or "Information" in data:
+            raise RateLimitExceeded("Превышен лимит запросов к Alpha Vantage, попробуйте позже")
+        return data
+
+    async def get_crypto_price(self, symbol):
+        params = {
+            'function': 'CURRENCY_EXCHANGE_RATE',
+            'from_currency': symbol,
+            'to_currency': 'USD',
+        }
+        data = await self._alpha_vantage_query(params)
+
+        if "Realtime Currency Exchange Rate" in data:
+            price_info = data["Realtime Currency Exchange Rate"]
+            return float(price_info["5. Exchange Rate"])
+        return None
+
+    async def get_stock_price(self, symbol):
+        url = self.yahoo_url.format(symbol=symbol)
+        try:
+            data = await self._request('yahoo', self.http.get_json, url, {'range': '1d', 'interval': '1d'})
+        except aiohttp.ClientResponseError as e:
+            # Неизвестный тикер Yahoo возвращает с кодом 404
+            if e.status == 404:
+                return None
+            raise Exception(f"Ошибка при получении стоимости акции: {str(e)}")
+
+        result = (data.get('chart') or {}).get('result')
+        if not result:
+            return None
+        price = result[0].get('meta', {}).get('regularMarketPrice')
+        return float(price) if price is not None else None
+
+    # Дневные цены закрытия криптовалюты в USD начиная с даты since
+    async def get_crypto_history(self, symbol, since):
+        params = {
+            'function': 'DIGITAL_CURRENCY_DAILY',
+            'symbol': symbol,
+            'market': 'USD',
+        }
+        data = await self._alpha_vantage_query(params)
+
+        closes = []
+        for day_text, values in data.get("Time Series (Digital Currency Daily)", {}).items():
+            day = datetime.strptime(day_text, '%Y-%m-%d').date()
+            # В старом формате ответа поле называлось "4a. close (USD)"
+            close = values.get("4. close") or values.get("4a. close (USD)")
+            if day >= since and close is not None:
+                closes.append((day, float(close)))
+        return sorted(closes)
+
+    # Дневные цены закрытия акции начиная с даты since
+    async def get_stock_history(self, symbol, since):
+        url = self.yahoo_url.format(symbol=symbol)
+        period_start = datetime.combine(since, dt_time(), tzinfo=timezone.utc)
+        params = {
+            'period1': int(period_start.timestamp()),
+            'period2': int((datetime.now(timezone.utc) + timedelta(days=1)).timestamp()),
+            'interval': '1d',
+        }
+        try:
+            data = await self._request('yahoo', self.http.get_json, url, params)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return []
+            raise Exception(f"Ошибка при получении истории акции: {str(e)}")
+
+        result = (data.get('chart') or {}).get('result')
+        if not result:
+            return []
+        meta = result[0].get('meta', {})
+        timestamps = result[0].get('timestamp') or []
+        quotes = (result[0].get('indicators', {}).get('quote') or [{}])[0]
+        # Дата торгового дня считается в часовом поясе биржи
+        offset = meta.get('gmtoffset', 0)
+
+        closes = []
+        for timestamp, close in zip(timestamps, quotes.get('close') or []):
+            if close is None:
+                continue
+            day = datetime.fromtimestamp(timestamp + offset, tz=timezone.utc).date()
+            if day >= since:
+                closes.append((day, float(close)))
+        return closes
+
+
+# Обертка над поставщиком котировок, которая объединяет одинаковые запросы
+# в полете по ключу (поставщик, символ, дата)
+class CoalescingProvider:
+    def __init__(self, provider, flight=None):
+        self.provider = provider
+        self.flight = flight if flight is not None else SingleFlight()
+
+    async def get_exchange_rates(self, date):
+        return await self.flight.do(('cbr', None, date), self.provider.get_exchange_rates, date)
+
+    async def get_crypto_price(self, symbol):
+        return await self.flight.do(('alpha_vantage', symbol, None), self.provider.get_crypto_price, symbol)
+
+    async def get_stock_price(self, symbol):
+        return await self.flight.do(('yahoo', symbol, None), self.provider.get_stock_price, symbol)
+
+    async def get_crypto_history(self, symbol, since):
+        return await self.flight.do(('alpha_vantage_history', symbol, since), self.provider.get_crypto_history, symbol, since)
+
+    async def get_stock_history(self, symbol, since):
+        return await self.flight.do(('yahoo_history', symbol, since), self.provider.get_stock_history, symbol, since)
+
+
+# Кэш текущих котировок криптовалют и акций со сроком жизни ttl секунд.
+# Пустые ответы не кэшируются, курсы ЦБ и история передаются как есть.
+# Если котировку обновить не удалось (квота исчерпана, поставщик
+# не отвечает или отключен предохранителем), отдается последняя известная;
+# ее возраст сообщает stale_age
+class CachingProvider:
+    def __init__(self, provider, ttl=60, maxsize=10000, clock=time.monotonic):
+        self.provider = provider
+        self.ttl = ttl
+        self.clock = clock
+        # Записи кэша - пары (котировка, время получения)
+        self.cache = LRUCache(maxsize=maxsize, clock=clock)
+
+    def _fetcher(self, kind):
+        return self.provider.get_crypto_price if kind == 'crypto' else self.provider.get_stock_price
+
+    async def _load(self, kind, symbol):
+        price = await self._fetcher(kind)(symbol)
+        if price is not None:
+            self.cache.set((kind, symbol), (price, self.clock()), ttl=self.ttl)
+        return price
+
+    async def _cached(self, kind, symbol):
+        entry = self.cache.get((kind, symbol))
+        if entry is not None:
+            return entry[0]
+        try:
+            return await self._load(kind, symbol)
+        except Exception as e:
+            # Лучше устаревшая котировка, чем ошибка или ожидание
+            stale_entry = self.cache.get_stale((kind, symbol))
+            if stale_entry is None:
+                raise
+            if not isinstance(e, RateLimitExceeded):
+                logger.warning("Котировка %s %s не обновлена: %s", kind, symbol, e)
+            return stale_entry[0]
+
+    # Сколько секунд назад получена котировка, если в кэше она устарела
+    # (ее отдали вместо свежей), иначе None
+    def stale_age(self, kind, symbol):
+        if self.cache.expires_in((kind, symbol)) != 0:
+            return None
+        return self.clock() - self.cache.get_stale((kind, symbol))[1]
+
+    async def get_crypto_price(self, symbol):
+        return await self._cached('crypto', symbol)
+
+    async def get_stock_price(self, symbol):
+        return await self._cached('stock', symbol)
+
+    # Фоновое обновление котировки, которая истекает в ближайшие lead секунд
+    async def prefetch(self, kind, symbol, lead=0):
+        expires_in = self.cache.expires_in((kind, symbol))
+        if expires_in is None or expires_in <= lead:
+            await self._load(kind, symbol)
+
+    async def get_exchange_rates(self, date):
+        return await self.provider.get_exchange_rates(date)
+
+    async def get_crypto_history(self, symbol, since):
+        return await self.provider.get_crypto_history(symbol, since)
+
+    async def get_stock_history(self, symbol, since):
+        return await self.provider.get_stock_history(symbol, since)
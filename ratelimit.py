@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+
+# Приоритеты запросов к поставщикам: меньше - важнее
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Приоритет текущей задачи. Фоновые задачи выставляют BACKGROUND,
+# запросы пользователей остаются INTERACTIVE
+request_priority = ContextVar('request_priority', default=INTERACTIVE)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+# Ведро токенов: rate токенов в секунду, не больше capacity про запас
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    # Через сколько секунд в ведре будет count токенов
+    def time_until_token(self, count=1):
+        self._refill()
+        return 0.0 if self.tokens >= count else (count - self.tokens) / self.rate
+
+    # Следующий токен появится не раньше чем через seconds секунд
+    def pause(self, seconds):
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+# Ограничитель запросов к одному поставщику и ключу API. Токен должен быть
+# во всех ведрах (например, минутная и суточная квоты). Ожидающие
+# обслуживаются по приоритету, а внутри приоритета - по очереди.
+# background_reserve - доля емкости каждого ведра, которую фоновые запросы
+# не расходуют: порядок ожидания сам по себе токенов не бережет, и без
+# запаса фоновое обновление съедает всю квоту раньше пользователей
+class PriorityLimiter:
+    def __init__(self, buckets, name='provider', max_wait=None, background_reserve=0.0):
+        self.buckets = buckets
+        self.name = name
+        # Сколько секунд ждать токен в зависимости от приоритета (None - без ограничения)
+        self.max_wait = max_wait or {}
+        self.background_reserve = background_reserve
+        self.granted = 0
+        self.rejected = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._wakeup = asyncio.Event()
+
+    # Сколько токенов должно быть в ведре, чтобы запрос с этим приоритетом взял один
+    def _needed(self, bucket, priority):
+        if priority == INTERACTIVE:
+            return 1
+        return 1 + bucket.capacity * self.background_reserve
+
+    def _try_take(self, priority):
+        if all(bucket.available() >= self._needed(bucket, priority) for bucket in self.buckets):
+            for bucket in self.buckets:
+                bucket.take()
+            return True
+        return False
+
+    def _refund(self):
+        for bucket in self.buckets:
+            bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+
+    async def acquire(self, timeout=None, priority=None):
+        if priority is None:
+            priority = request_priority.get()
+        if timeout is None:
+            timeout = self.max_wait.get(priority)
+
+        # Без очереди берут токен, если впереди нет ожидающих того же или более
+        # важного приоритета: пользователь не ждет фоновые запросы
+        if (not self._waiters or self._waiters[0][0] > priority) and self._try_take(priority):
+            self.granted += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        else:
+            # Новый первый в очереди может ждать меньше, чем спит диспетчер
+            self._wakeup.set()
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise RateLimitExceeded(f"Превышен лимит запросов к {self.name}, попробуйте позже")
+        self.granted += 1
+
+    async def _dispatch(self):
+        try:
+            while self._waiters:
+                # Ожидающие, которые уже ушли по таймауту, пропускаем
+                if self._waiters[0][2].done():
+                    heapq.heappop(self._waiters)
+                    continue
+                priority = self._waiters[0][0]
+                if self._try_take(priority):
+                    future = heapq.heappop(self._waiters)[2]
+                    if future.done():
+                        self._refund()
+                    else:
+                        future.set_result(None)
+                    continue
+                await self._wait(max(bucket.time_until_token(self._needed(bucket, priority)) for bucket in self.buckets))
+        finally:
+            self._dispatcher = None
+
+    async def _wait(self, delay):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    @property
+    def waiting(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
@@ -0,0 +1,140 @@
+import logging
+import time
+import xml.etree.ElementTree as ET
+from datetime import date, datetime
+
+from cache import LRUCache, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+FEED_CHUNK_SIZE = 16 * 1024
+
+
+# Курсы ЦБ на одну дату: CharCode -> стоимость одной единицы валюты в рублях
+class RateSnapshot:
+    __slots__ = ('date', 'rates')
+
+    def __init__(self, rates, date=None):
+        self.rates = rates
+        self.date = date
+
+    def get(self, currency_code, default=None):
+        return self.rates.get(currency_code, default)
+
+    def __contains__(self, currency_code):
+        return currency_code in self.rates
+
+    def __len__(self):
+        return len(self.rates)
+
+
+def _parse_cbr_number(text):
+    return float(text.replace(',', '.'))
+
+
+def _parse_cbr_date(text):
+    try:
+        return datetime.strptime(text, '%d.%m.%Y').date()
+    except (TypeError, ValueError):
+        return None
+
+
+# Разбор ежедневного документа Банка России за один потоковый проход.
+# Курс делится на Nominal: JPY, KZT и т.п. котируются за 10/100 единиц
+def parse_rate_snapshot(xml_data):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    rates = {}
+    snapshot_date = None
+
+    def consume_events():
+        nonlocal snapshot_date
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if elem.tag == 'ValCurs':
+                    snapshot_date = _parse_cbr_date(elem.get('Date'))
+                continue
+            if elem.tag != 'Valute':
+                continue
+
+            char_code = elem.findtext('CharCode')
+            unit_rate = elem.findtext('VunitRate')
+            value = elem.findtext('Value')
+            if char_code and unit_rate:
+                rates[char_code] = _parse_cbr_number(unit_rate)
+            elif char_code and value:
+                nominal = int(elem.findtext('Nominal') or 1)
+                rates[char_code] = _parse_cbr_number(value) / nominal
+            # Разобранный элемент больше не нужен
+            elem.clear()
+
+    for start in range(0, len(xml_data), FEED_CHUNK_SIZE):
+        parser.feed(xml_data[start:start + FEED_CHUNK_SIZE])
+        consume_events()
+    parser.close()
+    consume_events()
+
+    return RateSnapshot(rates, snapshot_date)
+
+
+# Кэш снимков курсов ЦБ по датам: прошлые дни не устаревают,
+# запись на сегодня перезапрашивается раз в today_ttl секунд. Если ЦБ
+# недоступен, отдается устаревший снимок дня; его возраст сообщает stale_age
+class DailyRatesCache:
+    def __init__(self, provider, maxsize=64, today_ttl=3600, clock=time.monotonic, today=date.today):
+        self.provider = provider
+        self.today_ttl = today_ttl
+        self.today = today
+        self.clock = clock
+        # Записи кэша - пары (снимок, время загрузки)
+        self._cache = LRUCache(maxsize=maxsize, clock=clock)
+        self._flight = SingleFlight()
+
+    async def get_rates(self, day):
+        if isinstance(day, datetime):
+            day = day.date()
+
+        entry = self._cache.get(day)
+        if entry is not None:
+            return entry[0]
+        try:
+            # Одновременные промахи по одной дате скачивают и разбирают документ один раз
+            return await self._flight.do(day, self._load, day)
+        except Exception as e:
+            stale_entry = self._cache.get_stale(day)
+            if stale_entry is None:
+                raise
+            logger.warning("Курсы ЦБ на %s не обновлены: %s", day, e)
+            return stale_entry[0]
+
+    async def _load(self, day):
+        xml_data = await self.provider.get_exchange_rates(day)
+        snapshot = parse_rate_snapshot(xml_data)
+
+        ttl = None if day < self.today() else self.today_ttl
+        self._cache.set(day, (snapshot, self.clock()), ttl=ttl)
+        return snapshot
+
+    # Сколько секунд назад загружен снимок дня, если он устарел, иначе None
+    def stale_age(self, day):
+        if isinstance(day, datetime):
+            day = day.date()
+        if self._cache.expires_in(day) != 0:
+            return None
+        return self.clock() - self._cache.get_stale(day)[1]
+
+    # Фоновое обновление: перезагружает день, если запись истекает в ближайшие lead секунд
+    async def prefetch(self, day, lead=0):
+        if isinstance(day, datetime):
+            day = day.date()
+        expires_in = self._cache.expires_in(day)
+        if expires_in is None or expires_in <= lead:
+            await self._flight.do(day, self._load, day)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
@@ -0,0 +1,132 @@
+from cache import LRUCache
+from portfolio_io import CSV, export_portfolio
+
+# SQL-запросы к таблицам users и portfolio. Каждая функция получает курсор,
+# поэтому одни и те же запросы используются и синхронными функциями main.py,
+# и асинхронным репозиторием
+
+def insert_user(cursor, telegram_id, username):
+    cursor.execute('''
+    INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)
+    ''', (telegram_id, username))
+
+    # Возвращаем строку пользователя, чтобы сразу положить ее в кэш
+    return select_user(cursor, telegram_id)
+
+
+def select_user(cursor, telegram_id):
+    cursor.execute('''
+    SELECT * FROM users WHERE telegram_id = ?
+    ''', (telegram_id,))
+
+    return cursor.fetchone()
+
+
+# Добавление актива или пересчет средней цены покупки одним запросом
+# по уникальному индексу (user_id, stock_symbol). В SET справа используются
+# старые значения строки, поэтому цена усредняется по прежнему количеству.
+# Вид актива (kind) заменяется, только если указан
+UPSERT_POSITION = '''
+    INSERT INTO portfolio (user_id, stock_symbol, quantity, purchase_price, kind) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, stock_symbol) DO UPDATE SET
+        quantity = portfolio.quantity + excluded.quantity,
+        purchase_price = ROUND(
+            (portfolio.purchase_price * portfolio.quantity + excluded.purchase_price * excluded.quantity)
+            / (portfolio.quantity + excluded.quantity), 2),
+        kind = COALESCE(excluded.kind, portfolio.kind)
+    '''
+
+
+def upsert_position(cursor, user_id, stock_symbol, quantity, purchase_price, kind=None):
+    cursor.execute(UPSERT_POSITION, (user_id, stock_symbol, quantity, purchase_price, kind))
+
+
+# Пачка позиций одним executemany: повторы символа усредняются так же,
+# как при добавлении по одной. positions - (символ, количество, цена, вид)
+def upsert_positions(cursor, user_id, positions):
+    cursor.executemany(UPSERT_POSITION, (
+        (user_id, stock_symbol, quantity, purchase_price, kind)
+        for stock_symbol, quantity, purchase_price, kind in positions
+    ))
+
+    return len(positions)
+
+
+def update_position_kind(cursor, user_id, stock_symbol, kind):
+    cursor.execute('''
+    UPDATE portfolio SET kind = ? WHERE user_id = ? AND stock_symbol = ?
+    ''', (kind, user_id, stock_symbol))
+
+    return cursor.rowcount
+
+
+def select_portfolio(cursor, user_id):
+    cursor.execute('''
+    SELECT * FROM portfolio WHERE user_id = ?
+    ''', (user_id,))
+
+    return cursor.fetchall()
+
+
+def delete_position(cursor, user_id, stock_symbol):
+    cursor.execute('''
+    DELETE FROM portfolio WHERE user_id = ? AND stock_symbol = ?
+    ''', (user_id, stock_symbol))
+
+    return cursor.rowcount
+
+
+# Отметка в кэше для telegram_id, который не зарегистрирован
+NOT_REGISTERED = object()
+
+
+# Асинхронный репозиторий пользователей и позиций портфеля для обработчиков.
+# Перед таблицей users стоит кэш telegram_id -> строка пользователя:
+# он заполняется при регистрации и первом чтении и помнит незарегистрированных
+class Repository:
+    def __init__(self, async_db, user_cache=None, negative_ttl=60):
+        self.async_db = async_db
+        self.user_cache = user_cache if user_cache is not None else LRUCache(maxsize=10000)
+        # Отрицательные записи живут недолго: пользователя может
+        # зарегистрировать другой процесс
+        self.negative_ttl = negative_ttl
+
+    async def add_user(self, telegram_id, username):
+        user = await self.async_db.write(insert_user, telegram_id, username)
+        self.user_cache.set(telegram_id, user)
+        return user
+
+    async def get_user(self, telegram_id):
+        user = self.user_cache.get(telegram_id)
+        if user is NOT_REGISTERED:
+            return None
+        if user is not None:
+            return user
+
+        user = await self.async_db.read(select_user, telegram_id)
+        if user is None:
+            self.user_cache.set(telegram_id, NOT_REGISTERED, ttl=self.negative_ttl)
+        else:
+            self.user_cache.set(telegram_id, user)
+        return user
+
+    async def add_stock_to_portfolio(self, user_id, stock_symbol, quantity, purchase_price, kind=None):
+        await self.async_db.write(upsert_position, user_id, stock_symbol, quantity, purchase_price, kind)
+
+    # Возвращает True, если позиция есть в портфеле
+    async def set_asset_kind(self, user_id, stock_symbol, kind):
+        return await self.async_db.write(update_position_kind, user_id, stock_symbol, kind) > 0
+
+    # Импорт файла: все позиции записываются в одной транзакции
+    async def import_positions(self, user_id, positions):
+        return await self.async_db.write(upsert_positions, user_id, positions)
+
+    async def export_portfolio(self, user_id, fmt=CSV):
+        return await self.async_db.read(export_portfolio, user_id, fmt)
+
+    async def get_portfolio(self, user_id):
+        return await self.async_db.read(select_portfolio, user_id)
+
+    # Возвращает True, если актив был в портфеле и удален
+    async def remove_stock_from_portfolio(self, user_id, stock_symbol):
+        return await self.async_db.write(delete_position, user_id, stock_symbol) > 0
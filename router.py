@@ -0,0 +1,58 @@
+import json
+
+from aiogram import types
+
+
+# Клавиатура, сериализованная один раз. Bot API принимает reply_markup
+# строкой JSON, и aiogram передает готовую строку без повторной сборки
+def render_keyboard(markup):
+    return json.dumps(markup.to_python(), ensure_ascii=False)
+
+
+# Маршрутизатор точных текстов кнопок и команд. Вместо цепочки фильтров,
+# которую aiogram проверяет по одному на каждое сообщение, в диспетчере
+# регистрируется один обработчик, а нужный выбирается по словарю
+class TextRouter:
+    def __init__(self):
+        self._routes = {}
+
+    @staticmethod
+    def _key(message):
+        text = message.text
+        if text and text.startswith('/'):
+            # /start, /start@bot и /start payload ведут к одной команде
+            return '/' + message.get_command(pure=True).lower()
+        return text
+
+    # Обработчик для текстов кнопок, включая переводы одной кнопки
+    def text(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                if text in self._routes:
+                    raise ValueError(f"Текст уже занят другим обработчиком: {text}")
+                self._routes[text] = handler
+            return handler
+        return decorator
+
+    def command(self, *commands):
+        return self.text(*('/' + command.lower() for command in commands))
+
+    def match(self, message):
+        return self._key(message) in self._routes
+
+    async def dispatch(self, message: types.Message):
+        return await self._routes[self._key(message)](message)
+
+    # Заменяет каждый обработчик на wrapper(обработчик), например для замеров
+    def wrap_handlers(self, wrapper):
+        wrapped = {}
+        for text, handler in self._routes.items():
+            if handler not in wrapped:
+                wrapped[handler] = wrapper(handler)
+            self._routes[text] = wrapped[handler]
+
+    def register(self, dp, **kwargs):
+        dp.register_message_handler(self.dispatch, self.match, content_types=types.ContentTypes.TEXT, **kwargs)
+
+    def __len__(self):
+        return len(self._routes)
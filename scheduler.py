@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from collections import Counter
+
+from ratelimit import BACKGROUND, RateLimitExceeded, request_priority
+
+logger = logging.getLogger(__name__)
+
+
+# Счетчик популярности запросов с затуханием: старые всплески со временем
+# перестают считаться горячими. Ключ - (вид актива из assets, символ)
+class RequestTracker:
+    def __init__(self, maxsize=1000, decay=0.5):
+        self.maxsize = maxsize
+        self.decay = decay
+        self._counts = Counter()
+
+    def record(self, kind, symbol):
+        self._counts[(kind, symbol)] += 1
+        if len(self._counts) > self.maxsize * 2:
+            # Оставляем только maxsize самых популярных ключей
+            self._counts = Counter(dict(self._counts.most_common(self.maxsize)))
+
+    def hot(self, n):
+        return [key for key, _ in self._counts.most_common(n)]
+
+    def apply_decay(self):
+        self._counts = Counter({
+            key: count * self.decay
+            for key, count in self._counts.items()
+            if count * self.decay >= 1
+        })
+
+    def __len__(self):
+        return len(self._counts)
+
+
+# Фоновое обновление горячих котировок до истечения их срока в кэше.
+# refreshers: вид запроса -> async функция(symbol, lead), обновляющая кэш
+class PrefetchScheduler:
+    def __init__(self, tracker, refreshers, interval=30, concurrency=5, hot_size=20):
+        self.tracker = tracker
+        self.refreshers = refreshers
+        self.interval = interval
+        self.concurrency = concurrency
+        self.hot_size = hot_size
+        self.refreshed = 0
+        self.errors = 0
+        self._task = None
+
+    async def _refresh(self, semaphore, kind, symbol):
+        refresher = self.refreshers.get(kind)
+        if refresher is None:
+            return
+        # Запросы планировщика пропускают вперед запросы пользователей
+        request_priority.set(BACKGROUND)
+        async with semaphore:
+            try:
+                # Обновляем то, что истечет до следующего прохода планировщика;
+                # свежие записи доживут до него и обновятся позже
+                await refresher(symbol, self.interval)
+                self.refreshed += 1
+            except RateLimitExceeded as e:
+                # Квота поставщика исчерпана - обычная ситуация, повторим на следующем проходе
+                self.errors += 1
+                logger.debug("Обновление %s %s отложено: %s", kind, symbol, e)
+            except Exception:
+                self.errors += 1
+                logger.exception("Не удалось обновить %s %s", kind, symbol)
+
+    async def run_once(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(
+            self._refresh(semaphore, kind, symbol)
+            for kind, symbol in self.tracker.hot(self.hot_size)
+        ))
+        self.tracker.apply_decay()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
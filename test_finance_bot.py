@@ -1,11 +1,25 @@
+import asyncio
+import contextlib
+import json
+import math
+import random
+import statistics
+import subprocess
+import sys
 from datetime import datetime
 import unittest
 import sqlite3
 import shutil
 import os
-from unittest.mock import patch, MagicMock
+import queue
+import tempfile
+import threading
+import time
+from unittest.mock import patch, MagicMock, AsyncMock
 
 import requests
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from main import (
     create_db,
     add_user,
@@ -16,9 +30,35 @@ from main import (
     get_exchange_rates,
     parse_exchange_rate,
     calculate_percentage_change,
+    format_previous_close,
     get_crypto_price,
     get_stock_price
 )
+from providers import HttpClient, MarketDataProvider, CoalescingProvider, CachingProvider, is_upstream_failure
+from breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from cache import LRUCache, SingleFlight
+from rates import DailyRatesCache, parse_rate_snapshot
+from database import Database, AsyncDatabase
+from repository import Repository, upsert_position
+from portfolio import PortfolioValuator, format_portfolio
+from history import PriceHistory, ALPHA_VANTAGE, YAHOO
+from ratelimit import TokenBucket, PriorityLimiter, RateLimitExceeded, INTERACTIVE, BACKGROUND
+from fsm_storage import BatchingStorage, SqliteStorage, RedisStorage, RedisClient
+from scheduler import RequestTracker, PrefetchScheduler
+from assets import CURRENCY, CRYPTO, STOCK
+from migrations import MIGRATIONS, SCHEMA_VERSION, apply_migrations, convert_total_prices, get_schema_version
+from webhook import BotWebhookHandler, create_webhook_app, start_webhook, reply, in_request_reply, SECRET_TOKEN_HEADER
+from router import TextRouter, render_keyboard
+from outbox import SendQueue, broadcast
+from aiogram.utils.exceptions import RetryAfter
+from alerts import Alert, AlertIndex, AlertEngine, parse_alert
+from metrics import Metrics, Registry
+from analytics import PortfolioAnalyzer, analyze_portfolios, format_analytics
+from portfolio_io import PortfolioFileError, parse_portfolio_file
+from conversion import CrossRates, parse_conversion, parse_codes, format_conversion, format_rub_prices
+from workers import OrderedUpdateProcessor, WorkerPool, partition_key, worker_for
+from aiogram import Bot, Dispatcher, types
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 DATABASE_NAME = os.path.join('app_data', 'finance_bot.db')
 TEST_DATABASE_NAME = os.path.join('app_data', 'test_finance_bot.db')
@@ -87,6 +127,12 @@ class TestFinanceBot(unittest.TestCase):
         change = calculate_percentage_change(100, 0)
         self.assertIsNone(change)
 
+    def test_format_previous_close(self):
+        # В понедельник последнее закрытие - пятничное, поэтому показываем дату
+        text = format_previous_close(110.0, (datetime(2024, 10, 11).date(), 100.0), None)
+        self.assertEqual(text, "\nЦена закрытия 11.10.2024: 100.00 USD\nИзменение к этому закрытию: 10.00%")
+        self.assertEqual(format_previous_close(110.0, None, None), "\nИстории цен пока нет, сравнение с прошлыми днями недоступно")
+
     def test_parse_exchange_rate(self):
         xml_data = '''<ValCurs Date="16.10.2024" name="Foreign Currency Market">
                         <Valute>
@@ -97,7 +143,7 @@ class TestFinanceBot(unittest.TestCase):
         rate = parse_exchange_rate(xml_data, 'USD')
         self.assertEqual(rate, 75.00)
 
-    @patch('main.requests.get')
+    @patch('requests.get')
     def test_get_exchange_rates(self, mock_get):
         mock_response = MagicMock()
         mock_response.text = '<ValCurs><Valute><CharCode>USD</CharCode><Value>75.00</Value></Valute></ValCurs>'
@@ -107,14 +153,14 @@ class TestFinanceBot(unittest.TestCase):
         
         self.assertIn('<ValCurs>', result)
 
-    @patch('main.si.get_live_price')
+    @patch('yahoo_fin.stock_info.get_live_price')
     def test_get_stock_price(self, mock_get_live_price):
         mock_get_live_price.return_value = 150.0
         price = get_stock_price('AAPL')
         
         self.assertEqual(price, 150.0)
 
-    @patch('main.requests.get')
+    @patch('requests.get')
     def test_get_crypto_price(self, mock_get):
         mock_response = {
             "Realtime Currency Exchange Rate": {
@@ -122,7 +168,7 @@ class TestFinanceBot(unittest.TestCase):
             }
         }
         
-        with patch('main.requests.get') as mock_requests:
+        with patch('requests.get') as mock_requests:
             mock_requests.return_value.json.return_value = mock_response
             price = get_crypto_price('BTC')
             self.assertEqual(price, 40000.00)
@@ -195,14 +241,14 @@ class TestFinanceBot(unittest.TestCase):
         rate = parse_exchange_rate(xml_data, 'EUR')  # Неверный код валюты
         self.assertIsNone(rate)
 
-    @patch('main.requests.get')
+    @patch('requests.get')
     def test_get_exchange_rates_invalid_response(self, mock_get):
         mock_get.side_effect = requests.exceptions.RequestException("Network error")
         
         with self.assertRaises(requests.exceptions.RequestException):
             get_exchange_rates(datetime.now())
 
-    @patch('main.si.get_live_price')
+    @patch('yahoo_fin.stock_info.get_live_price')
     def test_get_stock_price_invalid_symbol(self, mock_get_live_price):
         mock_get_live_price.side_effect = Exception("Invalid stock symbol")
         
@@ -215,6 +261,1763 @@ class TestFinanceBot(unittest.TestCase):
         change = calculate_percentage_change(1000000, 500000)
         self.assertEqual(change, 100.0)  # Проверка на большие числа
 
+
+class TestMarketDataProvider(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        # Локальный сервер вместо Банка России, Alpha Vantage и Yahoo
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/cbr', self.cbr_handler)
+        app.router.add_get('/av', self.alpha_vantage_handler)
+        app.router.add_get('/yahoo/{symbol}', self.yahoo_handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+        self.http = HttpClient(timeout=5)
+        self.provider = MarketDataProvider(
+            self.http, 'demo',
+            cbr_url=str(self.server.make_url('/cbr')),
+            alpha_vantage_url=str(self.server.make_url('/av')),
+            yahoo_url=str(self.server.make_url('/yahoo/')) + '{symbol}',
+        )
+
+    async def asyncTearDown(self):
+        await self.http.close()
+        await self.server.close()
+
+    async def cbr_handler(self, request):
+        self.requests.append(request.query.get('date_req'))
+        return web.Response(text='<ValCurs><Valute><CharCode>USD</CharCode><Value>75,00</Value></Valute></ValCurs>')
+
+    async def alpha_vantage_handler(self, request):
+        if request.query['function'] == 'DIGITAL_CURRENCY_DAILY':
+            return web.json_response({"Time Series (Digital Currency Daily)": {
+                "2024-10-15": {"4. close": "66000.00"},
+                "2024-10-14": {"4a. close (USD)": "65000.00"},
+                "2024-10-01": {"4. close": "60000.00"},
+            }})
+        if request.query['from_currency'] == 'LIMIT':
+            return web.json_response({"Note": "Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute."})
+        if request.query['from_currency'] == 'BTC':
+            return web.json_response({"Realtime Currency Exchange Rate": {"5. Exchange Rate": "40000.00"}})
+        return web.json_response({"Error Message": "Invalid API call"})
+
+    async def yahoo_handler(self, request):
+        if 'period1' in request.query:
+            return web.json_response({"chart": {"result": [{
+                "meta": {"gmtoffset": -14400},
+                "timestamp": [1728912600, 1728999000],
+                "indicators": {"quote": [{"close": [231.3, None]}]},
+            }]}})
+        if request.match_info['symbol'] == 'AAPL':
+            return web.json_response({"chart": {"result": [{"meta": {"regularMarketPrice": 150.5}}]}})
+        if request.match_info['symbol'] == 'DOWN':
+            return web.json_response({}, status=503)
+        return web.json_response({"chart": {"result": None}}, status=404)
+
+    async def test_get_exchange_rates(self):
+        xml_data = await self.provider.get_exchange_rates(datetime(2024, 10, 16))
+        self.assertEqual(parse_exchange_rate(xml_data, 'USD'), 75.00)
+        self.assertEqual(self.requests, ['16/10/2024'])
+
+    async def test_get_crypto_price(self):
+        self.assertEqual(await self.provider.get_crypto_price('BTC'), 40000.00)
+        self.assertIsNone(await self.provider.get_crypto_price('UNKNOWN'))
+
+    async def test_alpha_vantage_quota_note_is_an_error(self):
+        with self.assertRaises(RateLimitExceeded):
+            await self.provider.get_crypto_price('LIMIT')
+
+    async def test_get_stock_price(self):
+        self.assertEqual(await self.provider.get_stock_price('AAPL'), 150.5)
+        self.assertIsNone(await self.provider.get_stock_price('UNKNOWN'))
+
+    async def test_get_crypto_history(self):
+        closes = await self.provider.get_crypto_history('BTC', datetime(2024, 10, 10).date())
+        self.assertEqual(closes, [(datetime(2024, 10, 14).date(), 65000.0), (datetime(2024, 10, 15).date(), 66000.0)])
+
+    async def test_get_stock_history(self):
+        closes = await self.provider.get_stock_history('AAPL', datetime(2024, 10, 10).date())
+        self.assertEqual(closes, [(datetime(2024, 10, 14).date(), 231.3)])
+
+    async def test_breaker_counts_server_errors_not_unknown_symbols(self):
+        breaker = CircuitBreaker('yahoo', window=2, min_calls=2, is_failure=is_upstream_failure)
+        self.provider.breakers = {'yahoo': breaker}
+        for _ in range(3):
+            self.assertIsNone(await self.provider.get_stock_price('UNKNOWN'))
+        self.assertEqual(breaker.state, CLOSED)
+
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                await self.provider.get_stock_price('DOWN')
+        self.assertEqual(breaker.state, OPEN)
+        # Разомкнутый предохранитель не пускает запросы к поставщику
+        with self.assertRaises(CircuitOpenError):
+            await self.provider.get_stock_price('AAPL')
+        # ЦБ работает через свой предохранитель
+        self.assertEqual(parse_exchange_rate(await self.provider.get_exchange_rates(datetime(2024, 10, 16)), 'USD'), 75.00)
+
+    async def test_session_is_shared(self):
+        await self.provider.get_crypto_price('BTC')
+        session = self.http.session()
+        await self.provider.get_stock_price('AAPL')
+        self.assertIs(self.http.session(), session)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl_expiry_and_counters(self):
+        clock = FakeClock()
+        cache = LRUCache(maxsize=10, clock=clock)
+        cache.set('a', 1, ttl=10)
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+class CountingRatesProvider:
+    def __init__(self):
+        self.calls = []
+
+    async def get_exchange_rates(self, date):
+        self.calls.append(date)
+        return '<ValCurs><Valute><CharCode>USD</CharCode><Value>75,50</Value></Valute></ValCurs>'
+
+
+class TestDailyRatesCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.provider = CountingRatesProvider()
+        self.cache = DailyRatesCache(self.provider, maxsize=2, today_ttl=60,
+                                     clock=self.clock, today=lambda: datetime(2024, 10, 16).date())
+
+    def test_parse_rate_snapshot(self):
+        snapshot = parse_rate_snapshot(
+            '<?xml version="1.0" encoding="windows-1251"?>'
+            '<ValCurs Date="16.10.2024" name="Foreign Currency Market">'
+            '<Valute><NumCode>840</NumCode><CharCode>USD</CharCode><Nominal>1</Nominal><Value>75,50</Value></Valute>'
+            '<Valute><NumCode>392</NumCode><CharCode>JPY</CharCode><Nominal>100</Nominal><Value>64,80</Value></Valute>'
+            '<Valute><CharCode>KZT</CharCode><Nominal>100</Nominal><Value>19,90</Value><VunitRate>0,199</VunitRate></Valute>'
+            '</ValCurs>'.encode('cp1251'))
+        self.assertEqual(snapshot.date, datetime(2024, 10, 16).date())
+        self.assertEqual(snapshot.get('USD'), 75.50)
+        self.assertAlmostEqual(snapshot.get('JPY'), 0.648)
+        self.assertAlmostEqual(snapshot.get('KZT'), 0.199)
+        self.assertNotIn('EUR', snapshot)
+
+    async def test_repeated_lookups_hit_cache(self):
+        for _ in range(1000):
+            rates = await self.cache.get_rates(datetime(2024, 10, 16, 12, 0))
+        self.assertEqual(rates.get('USD'), 75.50)
+        self.assertEqual(len(self.provider.calls), 1)
+
+    async def test_today_refreshes_past_days_do_not(self):
+        await self.cache.get_rates(datetime(2024, 10, 16))
+        await self.cache.get_rates(datetime(2024, 10, 15))
+        self.clock.now = 3600
+        await self.cache.get_rates(datetime(2024, 10, 16))
+        await self.cache.get_rates(datetime(2024, 10, 15))
+        self.assertEqual(len(self.provider.calls), 3)
+
+    async def test_size_bound(self):
+        for day in (13, 14, 15):
+            await self.cache.get_rates(datetime(2024, 10, day))
+        await self.cache.get_rates(datetime(2024, 10, 13))
+        self.assertEqual(len(self.provider.calls), 4)
+
+
+class TestCrossRates(unittest.TestCase):
+
+    def setUp(self):
+        self.today = parse_rate_snapshot(
+            '<ValCurs><Valute><CharCode>USD</CharCode><Value>90,00</Value></Valute>'
+            '<Valute><CharCode>EUR</CharCode><Value>99,00</Value></Valute>'
+            '<Valute><CharCode>CNY</CharCode><Nominal>10</Nominal><Value>125,00</Value></Valute></ValCurs>')
+        self.yesterday = parse_rate_snapshot(
+            '<ValCurs><Valute><CharCode>USD</CharCode><Value>88,00</Value></Valute>'
+            '<Valute><CharCode>EUR</CharCode><Value>99,00</Value></Valute></ValCurs>')
+
+    def test_parse_queries(self):
+        self.assertEqual(parse_conversion('100 eur в usd'), (100.0, 'EUR', 'USD'))
+        self.assertEqual(parse_conversion('BTC/RUB'), (1.0, 'BTC', 'RUB'))
+        self.assertEqual(parse_conversion('2,5 BTC->USD'), (2.5, 'BTC', 'USD'))
+        self.assertIsNone(parse_conversion('USD EUR CNY'))
+        self.assertEqual(parse_codes('usd EUR, cny USD'), ['USD', 'EUR', 'CNY'])
+
+    def test_only_codes_accepted(self):
+        # Кнопки меню, числа и опечатки не превращаются в запросы к поставщикам
+        for text in ['Возврат в главное меню', 'USD 100', 'X', 'usd еur', 'TOOLONGCODE1']:
+            self.assertIsNone(parse_codes(text), text)
+        self.assertEqual(parse_codes(' '), [])
+        self.assertEqual(parse_codes('brk.b eurusd=x'), ['BRK.B', 'EURUSD=X'])
+        self.assertIsNone(parse_conversion('100 в USD'))
+        self.assertIsNone(parse_conversion('10 евро в USD'))
+
+    def test_pairs_from_one_snapshot(self):
+        cross = CrossRates(self.today, {'BTC': 50000.0, 'AAPL': 200.0, 'UNKNOWN': None})
+        self.assertAlmostEqual(cross.convert(1, 'EUR', 'USD'), 1.1)
+        self.assertAlmostEqual(cross.convert(1, 'BTC', 'RUB'), 4500000.0)
+        self.assertAlmostEqual(cross.convert(10, 'AAPL', 'RUB'), 180000.0)
+        self.assertAlmostEqual(cross.convert(1, 'BTC', 'CNY'), 360000.0)
+        self.assertAlmostEqual(cross.convert(1, 'RUB', 'USD'), 1 / 90)
+        self.assertIsNone(cross.convert(1, 'UNKNOWN', 'RUB'))
+        self.assertEqual(cross.quote_codes(['USD', 'RUB', 'BTC', 'AAPL']), ['BTC', 'AAPL'])
+
+    def test_format(self):
+        cross = CrossRates(self.today, {'BTC': 50000.0})
+        self.assertEqual(format_conversion(cross, 100, 'EUR', 'USD'), "100.00 EUR = 110.00 USD (1 EUR = 1.10 USD)")
+        self.assertEqual(format_conversion(cross, 1, 'XXX', 'RUB'), "Не удалось получить курс для: XXX")
+        self.assertEqual(
+            format_rub_prices(['USD', 'EUR', 'CNY', 'BTC', 'XXX'], cross, CrossRates(self.yesterday)),
+            "USD: 90.00 руб., за день +2.27%\n"
+            "EUR: 99.00 руб., за день +0.00%\n"
+            "CNY: 12.50 руб.\n"
+            "BTC: 4500000.00 руб. (50000.00 USD)\n"
+            "Не удалось получить курс для: XXX")
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmpdir, 'db', 'test.db'))
+        with self.db.write() as cursor:
+            cursor.execute('CREATE TABLE items (name TEXT)')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_wal_mode(self):
+        with self.db.read() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+
+    def test_reader_not_blocked_by_open_write(self):
+        with self.db.write() as cursor:
+            cursor.execute("INSERT INTO items VALUES ('a')")
+            # Читатель видит последнее зафиксированное состояние и не ждет писателя
+            with self.db.read() as reader:
+                reader.execute('SELECT COUNT(*) FROM items')
+                self.assertEqual(reader.fetchone()[0], 0)
+        with self.db.read() as reader:
+            reader.execute('SELECT COUNT(*) FROM items')
+            self.assertEqual(reader.fetchone()[0], 1)
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.db.write() as cursor:
+                cursor.execute("INSERT INTO items VALUES ('a')")
+                raise ValueError
+        with self.db.read() as reader:
+            reader.execute('SELECT COUNT(*) FROM items')
+            self.assertEqual(reader.fetchone()[0], 0)
+
+
+class TestAsyncRepository(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmpdir, 'test.db'))
+        with self.db.write() as cursor:
+            apply_migrations(cursor)
+        self.async_db = AsyncDatabase(self.db, read_workers=2)
+        self.repository = Repository(self.async_db)
+
+    async def asyncTearDown(self):
+        self.async_db.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    async def test_user_and_portfolio_roundtrip(self):
+        await self.repository.add_user(42, 'alice')
+        user = await self.repository.get_user(42)
+        self.assertEqual(user[2], 'alice')
+
+        await self.repository.add_stock_to_portfolio(user[0], 'AAPL', 10, 150.0)
+        await self.repository.add_stock_to_portfolio(user[0], 'AAPL', 10, 170.0)
+        portfolio = await self.repository.get_portfolio(user[0])
+        self.assertEqual([(row[2], row[3], row[4]) for row in portfolio], [('AAPL', 20, 160.0)])
+
+        self.assertTrue(await self.repository.remove_stock_from_portfolio(user[0], 'AAPL'))
+        self.assertFalse(await self.repository.remove_stock_from_portfolio(user[0], 'AAPL'))
+
+    async def test_concurrent_writes_share_transactions(self):
+        await asyncio.gather(*(self.repository.add_user(i, f'user{i}') for i in range(200)))
+        self.assertLess(self.async_db.transactions, 200)
+        with self.db.read() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM users')
+            self.assertEqual(cursor.fetchone()[0], 200)
+
+    async def test_failed_write_does_not_roll_back_others(self):
+        def failing(cursor):
+            cursor.execute("INSERT INTO users (telegram_id, username) VALUES (1, 'lost')")
+            raise ValueError('boom')
+
+        results = await asyncio.gather(
+            self.repository.add_user(2, 'kept'),
+            self.async_db.write(failing),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsNotNone(await self.repository.get_user(2))
+        self.assertIsNone(await self.repository.get_user(1))
+
+    async def test_user_cache_remembers_registered_and_unknown_ids(self):
+        reads = []
+        original_read = self.async_db.read
+
+        async def counting_read(fn, *args):
+            reads.append(fn.__name__)
+            return await original_read(fn, *args)
+
+        self.async_db.read = counting_read
+
+        for _ in range(3):
+            self.assertIsNone(await self.repository.get_user(7))
+        self.assertEqual(reads, ['select_user'])
+
+        user = await self.repository.add_user(7, 'bob')
+        for _ in range(3):
+            self.assertEqual(await self.repository.get_user(7), user)
+        self.assertEqual(reads, ['select_user'])
+        self.assertEqual(self.repository.user_cache.hits, 5)
+        self.assertEqual(self.repository.user_cache.misses, 1)
+
+    async def test_import_in_one_transaction_and_export(self):
+        user = await self.repository.add_user(42, 'alice')
+        await self.repository.add_stock_to_portfolio(user[0], 'AAPL', 10, 150.0, 'stock')
+        rows = ['symbol,quantity,purchase_price'] + [f'S{i:03d},{i + 1},{i}.5' for i in range(500)] + ['AAPL,10,170']
+        result = parse_portfolio_file('\n'.join(rows).encode(), 'portfolio.csv')
+
+        transactions = self.async_db.transactions
+        self.assertEqual(await self.repository.import_positions(user[0], result.positions), 501)
+        self.assertEqual(self.async_db.transactions, transactions + 1)
+
+        exported = await self.repository.export_portfolio(user[0])
+        lines = exported.decode().splitlines()
+        self.assertEqual(lines[:2], ['symbol,quantity,purchase_price,kind', 'AAPL,20,160.0,stock'])
+        self.assertEqual(len(lines), 502)
+        # Выгрузка читается импортом без изменений
+        self.assertEqual(parse_portfolio_file(exported).positions[1:], [(f'S{i:03d}', i + 1, i + 0.5, None) for i in range(500)])
+
+        # Вид актива задается для позиции без вида и не стирается при докупке
+        self.assertTrue(await self.repository.set_asset_kind(user[0], 'S001', 'crypto'))
+        self.assertFalse(await self.repository.set_asset_kind(user[0], 'NONE', 'crypto'))
+        await self.repository.add_stock_to_portfolio(user[0], 'S001', 1, 1.5)
+        portfolio = {row[2]: row[5] for row in await self.repository.get_portfolio(user[0])}
+        self.assertEqual((portfolio['S001'], portfolio['S002']), ('crypto', None))
+
+
+class TestPortfolioFile(unittest.TestCase):
+
+    def test_csv_variants_and_errors(self):
+        result = parse_portfolio_file('aapl;10;150,5\n\nMSFT;x;300\nTSLA;1\nBTC;2;-1\n'.encode())
+        self.assertEqual(result.positions, [('AAPL', 10, 150.5, None)])
+        self.assertEqual([line for line, _ in result.errors], [3, 4, 5])
+
+        result = parse_portfolio_file('\ufeffprice,Symbol,quantity,Kind\n1.5,eth,2,crypto\n1,X,1,bond\n'.encode())
+        self.assertEqual(result.positions, [('ETH', 2, 1.5, 'crypto')])
+        self.assertEqual(result.errors, [(3, 'неизвестный вид актива: bond')])
+        self.assertEqual(parse_portfolio_file(b'AAPL,1,1,stock\n').positions, [('AAPL', 1, 1.0, 'stock')])
+        with self.assertRaises(PortfolioFileError):
+            parse_portfolio_file(b'symbol,price\nAAPL,1\n')
+
+    def test_json_array_and_lines(self):
+        data = json.dumps([{'symbol': 'aapl', 'quantity': 3, 'price': 10}, {'symbol': 'MSFT'}, 5]).encode()
+        result = parse_portfolio_file(data, 'positions.json')
+        self.assertEqual(result.positions, [('AAPL', 3, 10.0, None)])
+        self.assertEqual([line for line, _ in result.errors], [2, 3])
+
+        data = b'{"symbol": "BTC", "quantity": "2", "purchase_price": "30000", "kind": "crypto"}\nnot json\n'
+        result = parse_portfolio_file(data)
+        self.assertEqual(result.positions, [('BTC', 2, 30000.0, 'crypto')])
+        self.assertEqual(result.errors, [(2, 'некорректный JSON')])
+
+    def test_limits(self):
+        with self.assertRaises(PortfolioFileError):
+            parse_portfolio_file(b'A,1,1\nB,1,1\nC,1,1\n', max_rows=2)
+        with self.assertRaises(PortfolioFileError):
+            parse_portfolio_file('AAPL,1,1'.encode('utf-16'))
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmpdir, 'test.db'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upgrade_merges_duplicates_and_adds_index(self):
+        # База в старой схеме, где одна позиция записана дважды
+        with self.db.write() as cursor:
+            apply_migrations(cursor, MIGRATIONS[:1])
+            cursor.executemany('INSERT INTO portfolio (user_id, stock_symbol, quantity, purchase_price) VALUES (?, ?, ?, ?)',
+                               [(1, 'AAPL', 10, 150.0), (1, 'AAPL', 30, 170.0), (1, 'MSFT', 1, 300.0)])
+
+        with self.db.write() as cursor:
+            self.assertEqual(apply_migrations(cursor, MIGRATIONS[:5]), 5)
+
+        with self.db.read() as cursor:
+            self.assertEqual(get_schema_version(cursor), 5)
+            cursor.execute('SELECT stock_symbol, quantity, purchase_price FROM portfolio ORDER BY stock_symbol')
+            self.assertEqual(cursor.fetchall(), [('AAPL', 40, 165.0), ('MSFT', 1, 300.0)])
+            cursor.execute("EXPLAIN QUERY PLAN SELECT 1 FROM portfolio WHERE user_id = 1 AND stock_symbol = 'AAPL'")
+            self.assertIn('idx_portfolio_user_symbol', ' '.join(row[-1] for row in cursor.fetchall()))
+
+    def test_symbols_uppercased_and_merged(self):
+        # До версии 8 символ мог быть сохранен в том регистре, в каком его ввели
+        with self.db.write() as cursor:
+            apply_migrations(cursor, MIGRATIONS[:7])
+            cursor.executemany('INSERT INTO portfolio (user_id, stock_symbol, quantity, purchase_price, kind) VALUES (?, ?, ?, ?, ?)',
+                               [(1, 'aapl', 10, 150.0, None), (1, 'AAPL', 30, 170.0, 'stock'),
+                                (1, 'Btc', 2, 30000.0, 'crypto'), (2, 'aapl', 1, 100.0, None)])
+
+        with self.db.write() as cursor:
+            self.assertEqual(apply_migrations(cursor), SCHEMA_VERSION)
+
+        with self.db.read() as cursor:
+            cursor.execute('SELECT user_id, stock_symbol, quantity, purchase_price, kind FROM portfolio ORDER BY user_id, stock_symbol')
+            self.assertEqual(cursor.fetchall(), [(1, 'AAPL', 40, 165.0, 'stock'), (1, 'BTC', 2, 30000.0, 'crypto'),
+                                                 (2, 'AAPL', 1, 100.0, None)])
+
+    def test_total_prices_converted_once(self):
+        # До версии 3 в purchase_price хранилась стоимость всей покупки
+        with self.db.write() as cursor:
+            apply_migrations(cursor, MIGRATIONS[:2])
+            cursor.executemany('INSERT INTO portfolio (user_id, stock_symbol, quantity, purchase_price) VALUES (?, ?, ?, ?)',
+                               [(1, 'AAPL', 10, 1500.0), (1, 'MSFT', 4, 1000.0)])
+        with self.db.write() as cursor:
+            apply_migrations(cursor)
+            upsert_position(cursor, 1, 'AAPL', 10, 170.0)
+        with self.db.write() as cursor:
+            self.assertEqual(apply_migrations(cursor), SCHEMA_VERSION)
+
+        with self.db.read() as cursor:
+            cursor.execute('SELECT stock_symbol, quantity, purchase_price FROM portfolio ORDER BY stock_symbol')
+            self.assertEqual(cursor.fetchall(), [('AAPL', 20, 160.0), ('MSFT', 4, 250.0)])
+
+        # В базах версии 3 и выше цены уже за единицу
+        with self.db.write() as cursor:
+            convert_total_prices(cursor, 5)
+        with self.db.read() as cursor:
+            cursor.execute("SELECT purchase_price FROM portfolio WHERE stock_symbol = 'MSFT'")
+            self.assertEqual(cursor.fetchone(), (250.0,))
+
+    def test_migrations_are_idempotent(self):
+        with self.db.write() as cursor:
+            apply_migrations(cursor)
+        with self.db.write() as cursor:
+            self.assertEqual(apply_migrations(cursor), SCHEMA_VERSION)
+
+    def test_concurrent_processes_apply_once(self):
+        # Рабочие процессы открывают одну базу своими соединениями
+        databases = [Database(self.db.path) for _ in range(4)]
+        versions, errors = [], []
+
+        def migrate(database):
+            try:
+                with database.write() as cursor:
+                    versions.append(apply_migrations(cursor))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=migrate, args=(database,)) for database in databases]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for database in databases:
+            database.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(versions, [SCHEMA_VERSION] * 4)
+
+
+class FakeQuoteProvider:
+    def __init__(self, stocks=None, crypto=None, delays=None):
+        self.stocks = stocks or {}
+        self.crypto = crypto or {}
+        self.delays = delays or {}
+        self.calls = []
+
+    async def get_stock_price(self, symbol):
+        self.calls.append(('stock', symbol))
+        await asyncio.sleep(self.delays.get(symbol, 0))
+        return self.stocks.get(symbol)
+
+    async def get_crypto_price(self, symbol):
+        self.calls.append(('crypto', symbol))
+        return self.crypto.get(symbol)
+
+
+class TestPortfolioValuator(unittest.IsolatedAsyncioTestCase):
+
+    async def test_value_portfolio(self):
+        # BTC есть и на бирже (фонд), но позиция - криптовалюта
+        provider = FakeQuoteProvider(stocks={'AAPL': 170.0, 'BTC': 45.0}, crypto={'BTC': 50000.0})
+        valuator = PortfolioValuator(provider, deadline=1)
+        valuation = await valuator.value([
+            (1, 1, 'AAPL', 10, 150.0, 'stock'),
+            (2, 1, 'BTC', 1, 40000.0, 'crypto'),
+            (3, 1, 'OLD', 1, 1.0, None),
+        ])
+
+        self.assertEqual([position.pnl for position in valuation.positions], [200.0, 10000.0, None])
+        self.assertEqual(valuation.total_value, 51700.0)
+        self.assertEqual(valuation.total_pnl, 10200.0)
+        self.assertEqual(sorted(provider.calls), [('crypto', 'BTC'), ('stock', 'AAPL')])
+        text = format_portfolio(valuation)
+        self.assertIn('AAPL: 10 шт.', text)
+        self.assertIn('P&L +10200.00', text)
+        self.assertIn('OLD: 1 шт., цена покупки 1.00, вид актива не указан', text)
+        self.assertIn('Укажите вид актива для: OLD', text)
+        self.assertNotIn('Нет текущей котировки', text)
+
+    async def test_duplicate_symbols_fetched_once(self):
+        provider = FakeQuoteProvider(stocks={'AAPL': 170.0})
+        valuator = PortfolioValuator(provider, deadline=1)
+        quotes = await valuator.fetch_quotes([('AAPL', 'stock')] * 3)
+        self.assertEqual(quotes, {('AAPL', 'stock'): 170.0})
+        self.assertEqual(provider.calls, [('stock', 'AAPL')])
+
+    async def test_slow_symbols_reported_unknown(self):
+        symbols = [f'S{i}' for i in range(30)]
+        provider = FakeQuoteProvider(stocks={symbol: 1.0 for symbol in symbols},
+                                     delays={symbol: 0.05 for symbol in symbols} | {'SLOW': 10})
+        valuator = PortfolioValuator(provider, deadline=0.3)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        valuation = await valuator.value([(i, 1, symbol, 1, 1.0, 'stock') for i, symbol in enumerate(symbols + ['SLOW'])])
+        # 30 запросов по 50 мс идут параллельно, а не подряд
+        self.assertLess(loop.time() - started, 0.5)
+        self.assertEqual([position.symbol for position in valuation.unknown], ['SLOW'])
+        self.assertIn('Нет текущей котировки для: SLOW', format_portfolio(valuation))
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_identical_requests_share_one_call(self):
+        provider = FakeQuoteProvider(stocks={'AAPL': 170.0}, delays={'AAPL': 0.05})
+        coalescing = CoalescingProvider(provider)
+        prices = await asyncio.gather(*(coalescing.get_stock_price('AAPL') for _ in range(100)))
+        self.assertEqual(set(prices), {170.0})
+        self.assertEqual(provider.calls, [('stock', 'AAPL')])
+        self.assertEqual(coalescing.flight.shared, 99)
+        self.assertEqual(len(coalescing.flight), 0)
+
+        # После завершения запроса следующий вызов снова идет к поставщику
+        await coalescing.get_stock_price('AAPL')
+        self.assertEqual(len(provider.calls), 2)
+
+    async def test_error_is_shared(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError('upstream down')
+
+        results = await asyncio.gather(*(flight.do('key', failing) for _ in range(5)), return_exceptions=True)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_cancelled_waiter_does_not_cancel_shared_call(self):
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+            return 42
+
+        first = asyncio.ensure_future(flight.do('key', slow))
+        second = asyncio.ensure_future(flight.do('key', slow))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.assertEqual(await second, 42)
+
+
+class FakeHistoryProvider:
+    def __init__(self, closes):
+        self.closes = closes
+        self.requests = []
+
+    async def get_stock_history(self, symbol, since):
+        self.requests.append((symbol, since))
+        return [(day, close) for day, close in self.closes if day >= since]
+
+
+class TestPriceHistory(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmpdir, 'test.db'))
+        with self.db.write() as cursor:
+            apply_migrations(cursor)
+        self.async_db = AsyncDatabase(self.db)
+        self.day = datetime(2024, 10, 16).date()
+        self.provider = FakeHistoryProvider([
+            (datetime(2024, 10, day).date(), float(day)) for day in range(1, 17)
+        ])
+        self.history = PriceHistory(self.async_db, self.provider, backfill_days=10, today=lambda: self.day)
+
+    async def asyncTearDown(self):
+        self.async_db.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    async def test_previous_and_n_day_close_from_local_store(self):
+        self.assertEqual(await self.history.previous_close(YAHOO, 'AAPL'), (datetime(2024, 10, 15).date(), 15.0))
+        self.assertEqual(await self.history.close_days_ago(YAHOO, 'AAPL', 7), 9.0)
+        # Второй запрос за день в сеть не ходит
+        self.assertEqual(self.provider.requests, [('AAPL', datetime(2024, 10, 6).date())])
+
+    async def test_incremental_backfill(self):
+        await self.history.previous_close(YAHOO, 'AAPL')
+        self.day = datetime(2024, 10, 18).date()
+        self.provider.closes.append((datetime(2024, 10, 17).date(), 17.0))
+        self.assertEqual(await self.history.previous_close(YAHOO, 'AAPL'), (datetime(2024, 10, 17).date(), 17.0))
+        # Догружаются только дни после последнего сохраненного (15 октября)
+        self.assertEqual(self.provider.requests[-1], ('AAPL', datetime(2024, 10, 16).date()))
+
+
+class TestPortfolioAnalytics(unittest.IsolatedAsyncioTestCase):
+
+    def expected(self, positions, history, user_id):
+        held = {symbol: (quantity, price) for owner, symbol, quantity, price, _ in positions if owner == user_id}
+        history = [row for row in history if row[0] == YAHOO]
+        days = sorted({day for _, _, day, _ in history})
+        closes, series = {}, []
+        for day in days:
+            for provider, symbol, row_day, close in history:
+                if row_day == day:
+                    closes[symbol] = close
+            series.append(sum(q * closes[symbol] for symbol, (q, _) in held.items())
+                          if all(symbol in closes for symbol in held) else None)
+        returns = [b / a - 1 for a, b in zip(series, series[1:]) if a is not None and b is not None]
+        peak, drawdown = None, 0.0
+        for value in series:
+            if value is not None:
+                peak = value if peak is None else max(peak, value)
+                drawdown = max(drawdown, 1 - value / peak)
+        value = sum(q * closes[symbol] for symbol, (q, _) in held.items())
+        cost = sum(q * p for q, p in held.values())
+        return value, cost, statistics.stdev(returns), drawdown
+
+    def test_matches_scalar_computation(self):
+        rng = random.Random(7)
+        symbols = ['AAPL', 'MSFT', 'BTC', 'ETH', 'TSLA']
+        positions = [(user_id, symbol, rng.randint(1, 50), round(rng.uniform(10, 500), 2), STOCK)
+                     for user_id in range(1, 6) for symbol in rng.sample(symbols, 3)]
+        history = []
+        for symbol in symbols:
+            for day in range(1, 21):
+                # Пропуски заполняются предыдущим закрытием, первый день известен у всех
+                if day == 1 or rng.random() > 0.2:
+                    history.append((YAHOO, symbol, f'2024-10-{day:02d}', round(rng.uniform(10, 500), 2)))
+        # История поставщика другого вида актива не смешивается с историей позиции
+        history.append((ALPHA_VANTAGE, 'BTC', '2024-10-21', 1.0))
+
+        results = analyze_portfolios(positions, history)
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        for user_id, analytics in results.items():
+            value, cost, volatility, drawdown = self.expected(positions, history, user_id)
+            self.assertAlmostEqual(analytics.total_value, value)
+            self.assertAlmostEqual(analytics.total_pnl, value - cost)
+            self.assertAlmostEqual(analytics.volatility, volatility)
+            self.assertAlmostEqual(analytics.max_drawdown, drawdown)
+            self.assertAlmostEqual(sum(analytics.weights), 1.0)
+            self.assertEqual(len(analytics.days), 20)
+
+    def test_history_by_asset_kind(self):
+        # У одного пользователя BTC - криптовалюта, у другого - фонд на бирже
+        positions = [(1, 'BTC', 1, 40000.0, CRYPTO), (2, 'BTC', 10, 30.0, STOCK), (3, 'ETH', 1, 1.0, None)]
+        history = [
+            (ALPHA_VANTAGE, 'BTC', '2024-10-01', 50000.0), (YAHOO, 'BTC', '2024-10-01', 45.0),
+            (YAHOO, 'ETH', '2024-10-01', 25.0),
+        ]
+        results = analyze_portfolios(positions, history)
+        self.assertEqual((results[1].total_value, results[2].total_value), (50000.0, 450.0))
+        self.assertEqual(results[1].kinds, [CRYPTO])
+        self.assertEqual(results[3].total_value, 0.0)
+        self.assertIn("ETH: вид актива не указан", format_analytics(results[3]))
+
+    def test_current_prices_and_unknown_symbols(self):
+        positions = [(1, 'AAPL', 10, 100.0, STOCK), (1, 'NEW', 5, 20.0, STOCK)]
+        history = [(YAHOO, 'AAPL', '2024-10-01', 100.0), (YAHOO, 'AAPL', '2024-10-02', 90.0)]
+        analytics = analyze_portfolios(positions, history, prices={('AAPL', STOCK): 120.0})[1]
+        self.assertEqual(analytics.symbols, ['AAPL', 'NEW'])
+        self.assertEqual(analytics.total_value, 1200.0)
+        self.assertEqual(analytics.total_pnl_percent, 20.0)
+        self.assertTrue(math.isnan(analytics.pnl[1]))
+        # NEW без истории не мешает считать просадку по AAPL
+        self.assertAlmostEqual(analytics.max_drawdown, 0.1)
+        self.assertEqual(analytics.excluded, ['NEW'])
+        text = format_analytics(analytics)
+        self.assertIn("NEW: цена неизвестна", text)
+        self.assertIn("не учтены в волатильности и просадке: NEW", text)
+
+    def test_position_without_kind_does_not_hide_volatility(self):
+        history = [(YAHOO, 'AAPL', f'2024-10-{day:02d}', close) for day, close in [(1, 100.0), (2, 110.0), (3, 99.0)]]
+        with_unknown = analyze_portfolios([(1, 'AAPL', 10, 100.0, STOCK), (1, 'OLD', 1, 5.0, None)], history)[1]
+        alone = analyze_portfolios([(1, 'AAPL', 10, 100.0, STOCK)], history)[1]
+        self.assertAlmostEqual(with_unknown.volatility, alone.volatility)
+        self.assertAlmostEqual(with_unknown.max_drawdown, 0.1)
+        self.assertEqual((with_unknown.excluded, alone.excluded), (['OLD'], []))
+        # Без единой позиции с историей показателей нет
+        self.assertTrue(math.isnan(analyze_portfolios([(1, 'OLD', 1, 5.0, None)], history)[1].volatility))
+
+    async def test_analyze_user_loads_missing_history(self):
+        tmpdir = tempfile.mkdtemp()
+        db = Database(os.path.join(tmpdir, 'test.db'))
+        with db.write() as cursor:
+            apply_migrations(cursor)
+            cursor.executemany('INSERT INTO portfolio (user_id, stock_symbol, quantity, purchase_price, kind) VALUES (?, ?, ?, ?, ?)',
+                               [(1, 'AAPL', 2, 10.0, STOCK), (1, 'BTC', 1, 100.0, CRYPTO), (1, 'OLD', 1, 1.0, None)])
+        async_db = AsyncDatabase(db)
+        today = datetime(2024, 10, 16).date()
+        calls = []
+
+        class Provider:
+            async def get_stock_history(self, symbol, since):
+                calls.append((STOCK, symbol))
+                return [(datetime(2024, 10, day).date(), 10.0 + day) for day in range(1, 16)]
+
+            async def get_crypto_history(self, symbol, since):
+                calls.append((CRYPTO, symbol))
+                return [(datetime(2024, 10, day).date(), 100.0 - day) for day in range(1, 16)]
+
+        analyzer = PortfolioAnalyzer(async_db, PriceHistory(async_db, Provider(), backfill_days=10, today=lambda: today), window_days=10)
+        try:
+            analytics = await analyzer.analyze_user(1)
+            self.assertEqual(analytics.symbols, ['AAPL', 'BTC', 'OLD'])
+            self.assertEqual(sorted(calls), [(CRYPTO, 'BTC'), (STOCK, 'AAPL')])
+            self.assertEqual(len(analytics.days), 10)
+            self.assertEqual(analytics.total_value, 2 * 25.0 + 85.0)
+            self.assertIsNone(await analyzer.analyze_user(2))
+        finally:
+            async_db.close()
+            db.close()
+            shutil.rmtree(tmpdir)
+
+
+class TestPrefetch(unittest.IsolatedAsyncioTestCase):
+
+    def test_tracker_hot_set_and_decay(self):
+        tracker = RequestTracker(decay=0.5)
+        for _ in range(5):
+            tracker.record(CRYPTO, 'BTC')
+        tracker.record(STOCK, 'AAPL')
+        self.assertEqual(tracker.hot(1), [(CRYPTO, 'BTC')])
+        tracker.apply_decay()
+        # Единичный запрос после затухания забывается
+        self.assertEqual(tracker.hot(5), [(CRYPTO, 'BTC')])
+
+    async def test_caching_provider_prefetch_ahead_of_expiry(self):
+        clock = FakeClock()
+        provider = FakeQuoteProvider(stocks={'AAPL': 170.0})
+        caching = CachingProvider(provider, ttl=60, clock=clock)
+
+        await caching.get_stock_price('AAPL')
+        await caching.get_stock_price('AAPL')
+        self.assertEqual(len(provider.calls), 1)
+
+        await caching.prefetch('stock', 'AAPL', lead=30)
+        self.assertEqual(len(provider.calls), 1)
+        clock.now = 40
+        await caching.prefetch('stock', 'AAPL', lead=30)
+        self.assertEqual(len(provider.calls), 2)
+        # Запись обновлена заранее, пользователь после старого срока попадает в кэш
+        clock.now = 61
+        await caching.get_stock_price('AAPL')
+        self.assertEqual(len(provider.calls), 2)
+
+    async def test_scheduler_refreshes_hot_set_with_concurrency_cap(self):
+        tracker = RequestTracker()
+        for i in range(10):
+            tracker.record(STOCK, f'S{i}')
+        active = []
+        peak = []
+
+        async def refresh(symbol, lead):
+            active.append(symbol)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(symbol)
+
+        scheduler = PrefetchScheduler(tracker, {STOCK: refresh}, interval=30, concurrency=3, hot_size=10)
+        await scheduler.run_once()
+        self.assertEqual(scheduler.refreshed, 10)
+        self.assertEqual(max(peak), 3)
+
+    async def test_scheduler_skips_fresh_entries(self):
+        clock = FakeClock()
+        provider = FakeQuoteProvider(stocks={'AAPL': 170.0, 'MSFT': 400.0})
+        caching = CachingProvider(provider, ttl=60, clock=clock)
+        tracker = RequestTracker(decay=1)
+        tracker.record(STOCK, 'AAPL')
+        tracker.record(STOCK, 'MSFT')
+
+        async def prefetch_stock(symbol, lead):
+            await caching.prefetch('stock', symbol, lead)
+
+        scheduler = PrefetchScheduler(tracker, {STOCK: prefetch_stock}, interval=30)
+        await caching.get_stock_price('AAPL')
+        clock.now = 20
+        await caching.get_stock_price('MSFT')
+        # AAPL истекает до следующего прохода, MSFT еще свежая
+        clock.now = 35
+        await scheduler.run_once()
+        self.assertEqual(provider.calls, [('stock', 'AAPL'), ('stock', 'MSFT'), ('stock', 'AAPL')])
+
+    async def test_scheduler_rate_limit_is_not_an_exception(self):
+        tracker = RequestTracker()
+        tracker.record(STOCK, 'AAPL')
+
+        async def refresh(symbol, lead):
+            raise RateLimitExceeded("quota")
+
+        scheduler = PrefetchScheduler(tracker, {STOCK: refresh})
+        with self.assertNoLogs('scheduler', level='WARNING'):
+            await scheduler.run_once()
+        self.assertEqual(scheduler.errors, 1)
+
+
+class TestPriorityLimiter(unittest.IsolatedAsyncioTestCase):
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, capacity=2, clock=clock)
+        bucket.take()
+        bucket.take()
+        self.assertEqual(bucket.time_until_token(), 1.0)
+        clock.now = 0.5
+        self.assertEqual(bucket.time_until_token(), 0.5)
+
+    async def test_interactive_requests_go_first(self):
+        limiter = PriorityLimiter([TokenBucket(rate=50, capacity=1)])
+        await limiter.acquire()
+        order = []
+
+        async def request(name, priority):
+            await limiter.acquire(priority=priority)
+            order.append(name)
+
+        tasks = [asyncio.ensure_future(request(f'bg{i}', BACKGROUND)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(request('user', INTERACTIVE)))
+        await asyncio.gather(*tasks)
+        self.assertEqual(order[0], 'user')
+
+    async def test_background_cannot_spend_reserve(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=5 / 60, capacity=5, clock=clock)
+        limiter = PriorityLimiter([bucket], max_wait={INTERACTIVE: 0.05, BACKGROUND: 0.05}, background_reserve=0.4)
+        for _ in range(3):
+            await limiter.acquire(priority=BACKGROUND)
+        # Два последних токена остаются пользователям
+        with self.assertRaises(RateLimitExceeded):
+            await limiter.acquire(priority=BACKGROUND)
+        await limiter.acquire(priority=INTERACTIVE)
+        await limiter.acquire(priority=INTERACTIVE)
+        self.assertEqual(bucket.available(), 0)
+
+    async def test_interactive_skips_waiting_background(self):
+        bucket = TokenBucket(rate=1, capacity=5)
+        limiter = PriorityLimiter([bucket], background_reserve=0.4)
+        bucket.tokens = 2.5
+        background = asyncio.ensure_future(limiter.acquire(priority=BACKGROUND))
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.waiting, 1)
+        # Фоновый запрос ждет три токена, пользователь берет запасной сразу
+        await asyncio.wait_for(limiter.acquire(priority=INTERACTIVE), 0.1)
+        background.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await background
+
+    async def test_bounded_wait(self):
+        limiter = PriorityLimiter([TokenBucket(rate=0.1, capacity=1)], max_wait={INTERACTIVE: 0.05})
+        await limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            await limiter.acquire()
+        self.assertEqual(limiter.rejected, 1)
+
+    async def test_stale_quote_when_quota_exhausted(self):
+        clock = FakeClock()
+
+        class LimitedProvider(FakeQuoteProvider):
+            async def get_crypto_price(self, symbol):
+                if self.calls:
+                    raise RateLimitExceeded('quota')
+                return await super().get_crypto_price(symbol)
+
+        caching = CachingProvider(LimitedProvider(crypto={'BTC': 50000.0}), ttl=60, clock=clock)
+        await caching.get_crypto_price('BTC')
+        clock.now = 120
+        self.assertEqual(await caching.get_crypto_price('BTC'), 50000.0)
+        with self.assertRaises(RateLimitExceeded):
+            await caching.get_crypto_price('ETH')
+
+
+class TestCircuitBreaker(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('yahoo', deadline=0.05, failure_rate=0.5, window=4, min_calls=4,
+                                      open_seconds=30, clock=self.clock)
+
+    @staticmethod
+    async def ok():
+        return 1
+
+    @staticmethod
+    async def fail():
+        raise ConnectionError('down')
+
+    async def test_opens_on_failure_rate_and_probes(self):
+        for fn in (self.ok, self.fail, self.ok):
+            with contextlib.suppress(ConnectionError):
+                await self.breaker.call(fn)
+        self.assertEqual(self.breaker.state, CLOSED)
+        with self.assertRaises(ConnectionError):
+            await self.breaker.call(self.fail)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        calls = []
+
+        async def tracked():
+            calls.append(1)
+            return 1
+
+        with self.assertRaises(CircuitOpenError):
+            await self.breaker.call(tracked)
+        self.assertEqual((calls, self.breaker.rejected), ([], 1))
+
+        # После open_seconds проходит один пробный запрос, остальные ждут его итога
+        self.clock.now = 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+
+        self.clock.now = 60
+        self.assertEqual(await self.breaker.call(tracked), 1)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.opened, 2)
+
+    async def test_deadline_bounds_slow_calls(self):
+        async def slow():
+            await asyncio.sleep(10)
+
+        started = time.perf_counter()
+        for _ in range(4):
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.breaker.call(slow)
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    async def test_stale_quote_with_age_while_open(self):
+        breaker = CircuitBreaker('yahoo', min_calls=1, open_seconds=30, clock=self.clock)
+        provider = FakeQuoteProvider(stocks={'AAPL': 170.0})
+
+        class GuardedProvider:
+            async def get_stock_price(self, symbol):
+                return await breaker.call(provider.get_stock_price, symbol)
+
+        caching = CachingProvider(GuardedProvider(), ttl=60, clock=self.clock)
+        self.assertEqual(await caching.get_stock_price('AAPL'), 170.0)
+        self.assertIsNone(caching.stale_age('stock', 'AAPL'))
+
+        self.clock.now = 290
+        breaker.record_failure()
+        self.clock.now = 300
+        self.assertEqual(await caching.get_stock_price('AAPL'), 170.0)
+        self.assertEqual(caching.stale_age('stock', 'AAPL'), 300)
+        self.assertEqual(len(provider.calls), 1)
+        with self.assertRaises(CircuitOpenError):
+            await caching.get_stock_price('MSFT')
+
+    async def test_stale_rates_when_cbr_unavailable(self):
+        provider = CountingRatesProvider()
+        cache = DailyRatesCache(provider, today_ttl=60, clock=self.clock, today=lambda: datetime(2024, 10, 16).date())
+        await cache.get_rates(datetime(2024, 10, 16))
+
+        async def unavailable(date):
+            raise asyncio.TimeoutError('cbr')
+
+        provider.get_exchange_rates = unavailable
+        self.clock.now = 600
+        rates = await cache.get_rates(datetime(2024, 10, 16))
+        self.assertEqual(rates.get('USD'), 75.50)
+        self.assertEqual(cache.stale_age(datetime(2024, 10, 16)), 600)
+        with self.assertRaises(asyncio.TimeoutError):
+            await cache.get_rates(datetime(2024, 10, 15))
+
+
+class FakeRedisServer:
+    # Локальная замена Redis: GET, SET с EX, DEL и PING по протоколу RESP
+    def __init__(self):
+        self.data = {}
+        self.commands = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                self.commands += 1
+                writer.write(self.reply(args))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def reply(self, args):
+        command = args[0].upper()
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command == b'GET':
+            value = self.data.get(args[1])
+            return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+        if command == b'SET':
+            self.data[args[1]] = args[2]
+            return b'+OK\r\n'
+        if command == b'DEL':
+            return b':%d\r\n' % int(self.data.pop(args[1], None) is not None)
+        return b'-ERR unknown command\r\n'
+
+
+class TestFsmStorage(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmpdir, 'test.db'))
+        with self.db.write() as cursor:
+            apply_migrations(cursor)
+        self.async_db = AsyncDatabase(self.db)
+
+    async def asyncTearDown(self):
+        self.async_db.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_backend_must_implement_read_and_write(self):
+        class ReadOnlyStorage(BatchingStorage):
+            async def _read(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            ReadOnlyStorage()
+
+    async def run_add_asset_flow(self, storage):
+        await storage.set_state(user=1, chat=1, state='waiting_for_stock_name')
+        await storage.update_data(user=1, chat=1, stock_name='AAPL')
+        await storage.set_state(user=1, chat=1, state='waiting_for_quantity')
+        await storage.update_data(user=1, chat=1, data={'quantity': 10})
+        await storage.set_state(user=1, chat=1, state='waiting_for_price')
+
+    async def test_sqlite_state_survives_restart_and_batches_writes(self):
+        storage = SqliteStorage(self.async_db, flush_interval=0.05)
+        await self.run_add_asset_flow(storage)
+        self.assertEqual(await storage.get_state(user=1, chat=1), 'waiting_for_price')
+        await storage.close()
+        self.assertEqual(storage.flushes, 1)
+
+        restarted = SqliteStorage(self.async_db)
+        self.assertEqual(await restarted.get_state(user=1, chat=1), 'waiting_for_price')
+        self.assertEqual(await restarted.get_data(user=1, chat=1), {'stock_name': 'AAPL', 'quantity': 10})
+
+        await restarted.finish(user=1, chat=1)
+        await restarted.close()
+        self.assertIsNone(await SqliteStorage(self.async_db).get_state(user=1, chat=1))
+
+    async def test_sqlite_abandoned_conversations_expire(self):
+        clock = FakeClock()
+        clock.now = 1000
+        storage = SqliteStorage(self.async_db, ttl=60, flush_interval=0, clock=clock)
+        await storage.set_state(user=1, chat=1, state='waiting_for_quantity')
+        clock.now = 1061
+        self.assertIsNone(await storage.get_state(user=1, chat=1))
+
+    async def test_redis_storage_shared_between_workers(self):
+        redis = FakeRedisServer()
+        port = await redis.start()
+        first = RedisStorage(RedisClient('127.0.0.1', port), flush_interval=0.01)
+        second = RedisStorage(RedisClient('127.0.0.1', port), flush_interval=0.01)
+        try:
+            await self.run_add_asset_flow(first)
+            await first.flush()
+            # Пять изменений ушли в Redis одной командой SET
+            self.assertEqual(redis.commands, 2)
+            self.assertEqual(await second.get_state(user=1, chat=1), 'waiting_for_price')
+            self.assertEqual(await second.get_data(user=1, chat=1), {'stock_name': 'AAPL', 'quantity': 10})
+
+            await second.finish(user=1, chat=1)
+            await second.flush()
+            self.assertEqual(redis.data, {})
+        finally:
+            await first.close()
+            await second.close()
+            await redis.stop()
+
+def text_message(text, message_id=10):
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return {
+        'message_id': message_id, 'date': 0, 'text': text,
+        'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Test'},
+        'entities': entities,
+    }
+
+
+class TestQuoteHandlers(unittest.IsolatedAsyncioTestCase):
+
+    async def ask(self, handler, text, market_data):
+        import main
+        router = TextRouter()
+        router.text("Возврат в главное меню")(AsyncMock(return_value='menu'))
+        message = types.Message.to_object(text_message(text))
+        message.reply = AsyncMock()
+        history = MagicMock(previous_close=AsyncMock(return_value=None), close_days_ago=AsyncMock(return_value=None))
+        tracker = RequestTracker()
+        state = AsyncMock()
+        with patch.object(main, 'text_router', router), patch.object(main, 'market_data', market_data), \
+                patch.object(main, 'price_history', history), patch.object(main, 'request_tracker', tracker), \
+                patch.object(main, 'format_rub_value', AsyncMock(return_value='')):
+            result = await handler(message, state)
+        return result, message.reply, tracker
+
+    async def test_menu_and_invalid_symbols_do_not_reach_providers(self):
+        import main
+        market_data = FakeQuoteProvider(stocks={'AAPL': 170.0}, crypto={'BTC': 50000.0})
+        market_data.stale_age = MagicMock(return_value=None)
+        for handler in (main.process_crypto_code, main.process_stock_symbol):
+            result, _, tracker = await self.ask(handler, "Возврат в главное меню", market_data)
+            self.assertEqual(result, 'menu')
+            for text in ("привет", "100", "BTC ETH"):
+                _, reply_mock, tracker = await self.ask(handler, text, market_data)
+                self.assertIn("латиницей", reply_mock.call_args.args[0])
+            self.assertEqual(len(tracker), 0)
+        self.assertEqual(market_data.calls, [])
+
+        # Несуществующий символ не становится горячим
+        _, _, tracker = await self.ask(main.process_crypto_code, "NOPE", market_data)
+        self.assertEqual(len(tracker), 0)
+        _, reply_mock, tracker = await self.ask(main.process_crypto_code, "btc", market_data)
+        self.assertEqual(tracker.hot(5), [(CRYPTO, 'BTC')])
+        # Без истории цена все равно показывается
+        self.assertIn("Текущая стоимость BTC: 50000.00 USD", reply_mock.call_args.args[0])
+
+    async def test_answer_returned_in_webhook_response(self):
+        import main
+        market_data = FakeQuoteProvider(stocks={'AAPL': 170.0})
+        market_data.stale_age = MagicMock(return_value=None)
+        token = in_request_reply.set(True)
+        try:
+            result, reply_mock, _ = await self.ask(main.process_stock_symbol, "AAPL", market_data)
+        finally:
+            in_request_reply.reset(token)
+        reply_mock.assert_not_called()
+        self.assertIn("Текущая стоимость акции AAPL: 170.00 USD", result.text)
+
+
+class TestColdStart(unittest.TestCase):
+    # Бюджет на импорт main в секундах: с большим запасом для медленных машин
+    # CI (локально импорт занимает около 0.3 с), строже - через IMPORT_TIME_BUDGET
+    IMPORT_TIME_BUDGET = float(os.getenv('IMPORT_TIME_BUDGET', '5'))
+
+    def test_import_is_lazy_and_within_budget(self):
+        tmpdir = tempfile.mkdtemp()
+        database_name = os.path.join(tmpdir, 'finance_bot.db')
+        code = (
+            "import sys, time\n"
+            "started = time.perf_counter()\n"
+            "import main\n"
+            "print(time.perf_counter() - started)\n"
+            "print(','.join(name for name in ('yahoo_fin', 'pandas', 'requests', 'numpy') if name in sys.modules))\n"
+        )
+        try:
+            result = subprocess.run(
+                [sys.executable, '-c', code], capture_output=True, text=True, timeout=60,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=dict(os.environ, API_TOKEN='123456:ABCdef', DATABASE_NAME=database_name),
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            elapsed, heavy_modules = result.stdout.splitlines()[-2:]
+            self.assertEqual(heavy_modules, '')
+            self.assertLess(float(elapsed), self.IMPORT_TIME_BUDGET)
+            # База создается в on_startup, а не при импорте
+            self.assertFalse(os.path.exists(database_name))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestTextRouter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.router = TextRouter()
+
+        @self.router.text("Мой портфель", "My portfolio")
+        async def portfolio(message):
+            return 'portfolio'
+
+        @self.router.command('start')
+        async def start(message):
+            return 'start'
+
+    async def test_routes_texts_and_commands(self):
+        for text, expected in [("Мой портфель", 'portfolio'), ("My portfolio", 'portfolio'),
+                               ('/start', 'start'), ('/start@finance_bot payload', 'start')]:
+            message = types.Message.to_object(text_message(text))
+            self.assertTrue(self.router.match(message))
+            self.assertEqual(await self.router.dispatch(message), expected)
+
+        self.assertFalse(self.router.match(types.Message.to_object(text_message("Мой портфель!"))))
+        self.assertFalse(self.router.match(types.Message.to_object(text_message('/help'))))
+
+    async def test_single_dispatcher_handler(self):
+        dp = Dispatcher(Bot(token='123456:ABCdef'))
+        self.router.register(dp)
+        self.assertEqual(len(dp.message_handlers.handlers), 1)
+
+        results = await dp.process_update(types.Update.to_object({'update_id': 1, 'message': text_message("My portfolio")}))
+        self.assertEqual(results, ['portfolio'])
+
+    def test_duplicate_text_rejected(self):
+        with self.assertRaises(ValueError):
+            self.router.text("Мой портфель")(None)
+
+    def test_render_keyboard(self):
+        markup = ReplyKeyboardMarkup(resize_keyboard=True)
+        markup.add(KeyboardButton("Назад"))
+        self.assertEqual(json.loads(render_keyboard(markup)),
+                         {'keyboard': [[{'text': "Назад"}]], 'resize_keyboard': True})
+
+
+class TestSendQueue(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    async def deliver(self, chat_id, text):
+        self.sent.append((chat_id, text))
+        return text
+
+    async def test_chat_limit_does_not_block_other_chats(self):
+        queue = SendQueue(TokenBucket(1000, 1000), chat_rate=20, chat_capacity=1)
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(
+            *(queue.send(1, self.deliver, 1, f'msg {i}') for i in range(3)),
+            queue.send(2, self.deliver, 2, 'other'),
+        )
+        elapsed = asyncio.get_running_loop().time() - started
+
+        # Сообщения одного чата идут по порядку с интервалом 1/20 секунды
+        self.assertEqual([text for chat_id, text in self.sent if chat_id == 1], ['msg 0', 'msg 1', 'msg 2'])
+        self.assertLess(self.sent.index((2, 'other')), 2)
+        self.assertGreaterEqual(elapsed, 0.09)
+        self.assertEqual(queue.stats()['sent'], 4)
+        self.assertEqual(queue.pending, 0)
+
+    async def test_interactive_replies_overtake_bulk_sends(self):
+        queue = SendQueue(TokenBucket(50, 1), chat_rate=100, chat_capacity=1)
+        bulk = [queue.send(chat_id, self.deliver, chat_id, 'bulk', priority=BACKGROUND) for chat_id in range(1, 6)]
+        tasks = [asyncio.ensure_future(job) for job in bulk]
+        await asyncio.sleep(0)
+        await queue.send(100, self.deliver, 100, 'reply', priority=INTERACTIVE)
+        await asyncio.gather(*tasks)
+
+        # Первая рассылка успела взять единственный токен, ответ идет сразу за ней
+        self.assertEqual(self.sent[1], (100, 'reply'))
+        self.assertEqual(queue.sent_by_priority, {BACKGROUND: 5, INTERACTIVE: 1})
+
+    async def test_retry_after_pauses_chat_and_retries(self):
+        queue = SendQueue(TokenBucket(1000, 1000), chat_rate=1000, chat_capacity=1)
+        attempts = []
+
+        async def flaky(text):
+            attempts.append(asyncio.get_running_loop().time())
+            if len(attempts) == 1:
+                raise RetryAfter(0.1)
+            return text
+
+        self.assertEqual(await queue.send(1, flaky, 'hello'), 'hello')
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.09)
+        self.assertEqual((queue.sent, queue.retried, queue.failed), (1, 1, 0))
+
+    async def test_retry_after_pauses_other_chats(self):
+        queue = SendQueue(TokenBucket(1000, 1000), chat_rate=1000, chat_capacity=1)
+        times = {}
+
+        async def flaky(chat_id):
+            if chat_id == 1 and chat_id not in times:
+                times[chat_id] = None
+                raise RetryAfter(0.1)
+            times[chat_id] = asyncio.get_running_loop().time()
+
+        started = asyncio.get_running_loop().time()
+        first = asyncio.ensure_future(queue.send(1, flaky, 1))
+        await asyncio.sleep(0)
+        # Ответ 429 касается всего бота: другой чат тоже ждет retry_after
+        await queue.send(2, flaky, 2)
+        await first
+        self.assertGreaterEqual(times[2] - started, 0.09)
+
+    async def test_broadcast_counts_delivered(self):
+        bot = MagicMock()
+
+        async def send_message(chat_id, text):
+            if chat_id == 3:
+                raise RuntimeError("chat not found")
+
+        bot.send_message = send_message
+        with self.assertLogs('outbox', level='ERROR'):
+            self.assertEqual(await broadcast(bot, [1, 2, 3], 'Новость'), 2)
+
+
+class TestAlertIndex(unittest.TestCase):
+
+    def test_parse_alert(self):
+        self.assertEqual(parse_alert('usd > 100'), (None, 'USD', '>', 100.0))
+        self.assertEqual(parse_alert(' AAPL<150,5 '), (None, 'AAPL', '<', 150.5))
+        self.assertEqual(parse_alert('crypto btc > 100000'), (CRYPTO, 'BTC', '>', 100000.0))
+        self.assertEqual(parse_alert('акция BTC < 50'), (STOCK, 'BTC', '<', 50.0))
+        self.assertIsNone(parse_alert('bond BTC < 50'))
+        self.assertIsNone(parse_alert('USD >= 100'))
+        self.assertIsNone(parse_alert(''))
+
+    def test_triggered_alerts_match_full_scan(self):
+        rng = random.Random(1)
+        index = AlertIndex()
+        alerts = {}
+        for alert_id in range(1, 2001):
+            alert = Alert(alert_id, 1, 1, STOCK, rng.choice(['AAPL', 'MSFT']), rng.choice('<>'), float(rng.randint(50, 150)))
+            alerts[alert_id] = alert
+            index.add(alert)
+
+        for price in [100.0, 120.0, 60.0, 149.5, 100.0]:
+            for symbol in ['AAPL', 'MSFT']:
+                expected = {
+                    alert_id for alert_id, alert in alerts.items()
+                    if alert.symbol == symbol and (
+                        (alert.direction == '>' and price > alert.threshold) or
+                        (alert.direction == '<' and price < alert.threshold))
+                }
+                triggered = {alert.id for alert in index.pop_triggered(STOCK, symbol, price)}
+                self.assertEqual(triggered, expected)
+                for alert_id in triggered:
+                    del alerts[alert_id]
+        self.assertEqual(len(index), len(alerts))
+
+    def test_equal_price_does_not_trigger_and_remove(self):
+        index = AlertIndex()
+        index.add(Alert(1, 1, 1, CURRENCY, 'USD', '>', 100.0))
+        index.add(Alert(2, 1, 1, CURRENCY, 'USD', '<', 100.0))
+        self.assertEqual(index.pop_triggered(CURRENCY, 'USD', 100.0), [])
+        self.assertEqual(index.remove(1).id, 1)
+        self.assertIsNone(index.remove(1))
+        self.assertEqual([alert.id for alert in index.pop_triggered(CURRENCY, 'USD', 99.0)], [2])
+        self.assertEqual(index.symbols(), set())
+
+
+class TestAlertEngine(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmpdir, 'test.db'))
+        with self.db.write() as cursor:
+            apply_migrations(cursor)
+            cursor.execute("INSERT INTO users (telegram_id, username) VALUES (555, 'user')")
+            self.user_id = cursor.lastrowid
+        self.async_db = AsyncDatabase(self.db)
+        self.prices = {'USD': 90.0, 'AAPL': 160.0}
+        self.notified = []
+
+    async def asyncTearDown(self):
+        self.async_db.close()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    async def fetch(self, symbol):
+        return self.prices.get(symbol)
+
+    async def notify(self, alert, price):
+        self.notified.append((alert.telegram_id, alert.symbol, price))
+
+    def engine(self):
+        return AlertEngine(self.async_db, {CURRENCY: self.fetch, STOCK: self.fetch}, self.notify)
+
+    async def test_alerts_persist_and_trigger_once(self):
+        engine = self.engine()
+        await engine.add(self.user_id, 555, CURRENCY, 'USD', '>', 100.0)
+        aapl = await engine.add(self.user_id, 555, STOCK, 'AAPL', '<', 150.0)
+
+        restarted = self.engine()
+        self.assertEqual(await restarted.load(), 2)
+        await restarted.run_once()
+        self.assertEqual(self.notified, [])
+
+        self.prices['USD'] = 101.5
+        await restarted.run_once()
+        self.assertEqual(self.notified, [(555, 'USD', 101.5)])
+        self.assertEqual(restarted.index.symbols(), {(STOCK, 'AAPL')})
+
+        # Сработавшее уведомление не загружается снова
+        self.assertEqual(await self.engine().load(), 1)
+        self.assertEqual(await restarted.user_alerts(self.user_id), [(aapl.id, STOCK, 'AAPL', '<', 150.0)])
+
+        self.assertFalse(await restarted.remove(self.user_id + 1, aapl.id))
+        self.assertTrue(await restarted.remove(self.user_id, aapl.id))
+        self.assertEqual(len(restarted.index), 0)
+        self.assertEqual(await self.engine().load(), 0)
+
+    async def test_alerts_from_other_processes(self):
+        supervisor = self.engine()
+        worker = self.engine()
+        await supervisor.load()
+
+        await worker.add(self.user_id, 555, CURRENCY, 'USD', '>', 100.0)
+        aapl = await worker.add(self.user_id, 555, STOCK, 'AAPL', '<', 170.0)
+        self.assertTrue(await worker.remove(self.user_id, aapl.id))
+        self.prices['USD'] = 101.0
+        await supervisor.run_once()
+        self.assertEqual(self.notified, [(555, 'USD', 101.0)])
+
+        # Удаленное в другом процессе уведомление не приходит, а сработавшее
+        # не приходит второй раз из другого индекса
+        supervisor.index.add(Alert(aapl.id, self.user_id, 555, STOCK, 'AAPL', '<', 170.0))
+        self.assertEqual(await supervisor.check(STOCK, 'AAPL', 160.0), [])
+        self.assertEqual(await worker.check(CURRENCY, 'USD', 102.0), [])
+        self.assertEqual(len(self.notified), 1)
+
+    async def test_failed_mark_keeps_alerts(self):
+        engine = self.engine()
+        await engine.load()
+        await engine.add(self.user_id, 555, CURRENCY, 'USD', '>', 100.0)
+        write = self.async_db.write
+
+        async def failing_write(fn, *args):
+            raise sqlite3.OperationalError("database is locked")
+
+        self.async_db.write = failing_write
+        with self.assertRaises(sqlite3.OperationalError):
+            await engine.check(CURRENCY, 'USD', 101.0)
+        self.assertEqual(len(engine.index), 1)
+
+        self.async_db.write = write
+        self.assertEqual(len(await engine.check(CURRENCY, 'USD', 101.0)), 1)
+        self.assertEqual(self.notified, [(555, 'USD', 101.0)])
+
+    async def test_worker_does_not_keep_index(self):
+        worker = self.engine()
+        await worker.add(self.user_id, 555, CURRENCY, 'USD', '>', 100.0)
+        self.assertEqual(len(worker.index), 0)
+        # Уведомление рабочего процесса проверяет супервизор
+        supervisor = self.engine()
+        self.assertEqual(await supervisor.load(), 1)
+
+    async def test_detect_alert_kind(self):
+        import main
+        market_data = FakeQuoteProvider(stocks={'AAPL': 170.0, 'BTC': 45.0}, crypto={'BTC': 100000.0})
+        with patch.object(main, 'market_data', market_data), \
+                patch.object(main, 'alert_currency_rate', AsyncMock(side_effect={'USD': 90.0}.get)):
+            self.assertEqual(await main.detect_alert_kind('USD'), CURRENCY)
+            self.assertEqual(await main.detect_alert_kind('AAPL'), STOCK)
+            # BTC без вида - криптовалюта, биржевой фонд - только по явному виду
+            self.assertEqual(await main.detect_alert_kind('BTC'), CRYPTO)
+            self.assertEqual(await main.detect_alert_kind('BTC', STOCK), STOCK)
+            self.assertIsNone(await main.detect_alert_kind('AAPL', CRYPTO))
+        self.assertEqual(market_data.calls, [('stock', 'AAPL'), ('crypto', 'BTC'), ('stock', 'BTC'), ('crypto', 'AAPL')])
+
+
+class TestWorkers(unittest.IsolatedAsyncioTestCase):
+
+    def process_settings(self, **env):
+        tmpdir = tempfile.mkdtemp()
+        code = (
+            "import main\n"
+            "print(main.IS_SUPERVISOR, main.send_queue.global_bucket.rate, main.alpha_vantage_per_minute)\n"
+        )
+        try:
+            result = subprocess.run(
+                [sys.executable, '-c', code], capture_output=True, text=True, timeout=60,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=dict(os.environ, API_TOKEN='123456:ABCdef', DATABASE_NAME=os.path.join(tmpdir, 'test.db'),
+                         SEND_GLOBAL_RATE='30', ALPHA_VANTAGE_CALLS_PER_MINUTE='5', **env),
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            supervisor, send_rate, alpha_vantage_rate = result.stdout.split()
+            return supervisor == 'True', float(send_rate), float(alpha_vantage_rate)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_quotas_shared_with_supervisor(self):
+        env = os.environ.copy()
+        env.pop('BOT_WORKER_INDEX', None)
+        with patch.dict(os.environ, env, clear=True):
+            self.assertEqual(self.process_settings(BOT_WORKERS='1'), (False, 30.0, 5.0))
+            supervisor = self.process_settings(BOT_WORKERS='2')
+            worker = self.process_settings(BOT_WORKERS='2', BOT_WORKER_INDEX='1')
+        # Супервизор и два рабочих процесса вместе не превышают квоты
+        self.assertEqual(supervisor, (True, 10.0, 5 / 3))
+        self.assertEqual(worker, (False, 10.0, 5 / 3))
+
+    def test_partition_by_user(self):
+        message = {'update_id': 1, 'message': text_message('/start')}
+        callback = {'update_id': 2, 'callback_query': {'id': '1', 'from': {'id': 43}, 'chat_instance': '1'}}
+        channel_post = {'update_id': 3, 'channel_post': {'message_id': 1, 'date': 0, 'chat': {'id': -100}}}
+        self.assertEqual([partition_key(data) for data in (message, callback, channel_post)], [42, 43, -100])
+        self.assertEqual(partition_key({'update_id': 7}), 7)
+        self.assertEqual([worker_for(key, 4) for key in (42, 43, -100)], [2, 3, 0])
+
+    async def test_pool_routes_user_to_one_queue(self):
+        pool = WorkerPool(None, 3)
+        for update_id in range(6):
+            data = {'update_id': update_id, 'message': text_message(str(update_id))}
+            data['message']['from']['id'] = update_id % 2
+            await pool.dispatch(data)
+        received = []
+        for update_queue in pool.queues:
+            items = []
+            while True:
+                try:
+                    items.append(update_queue.get(timeout=0.2)['update_id'])
+                except queue.Empty:
+                    break
+            received.append(items)
+        self.assertEqual(received, [[0, 2, 4], [1, 3, 5], []])
+
+    async def test_ordered_per_user(self):
+        events = []
+
+        async def process(update):
+            user_id = update.message.from_user.id
+            events.append(('start', user_id, update.update_id))
+            # Первое сообщение пользователя 1 обрабатывается дольше остальных
+            await asyncio.sleep(0.05 if update.update_id == 1 else 0)
+            events.append(('end', user_id, update.update_id))
+            if update.update_id == 3:
+                raise ValueError
+
+        processor = OrderedUpdateProcessor(process)
+        for update_id, user_id in [(1, 1), (2, 2), (3, 1), (4, 1)]:
+            data = {'update_id': update_id, 'message': text_message(str(update_id))}
+            data['message']['from']['id'] = user_id
+            processor.submit(user_id, types.Update.to_object(data))
+        await processor.join()
+
+        user_events = [event[2] for event in events if event[1] == 1]
+        self.assertEqual(user_events, [1, 1, 3, 3, 4, 4])
+        # Другой пользователь не ждет медленное сообщение
+        self.assertLess(events.index(('end', 2, 2)), events.index(('end', 1, 1)))
+        self.assertEqual(processor.errors, 1)
+        self.assertEqual(len(processor), 0)
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    def test_render_prometheus_text(self):
+        registry = Registry()
+        counter = registry.counter('requests_total', "Запросы", ('path',))
+        counter.inc('/a')
+        counter.inc('/a', amount=2)
+        histogram = registry.histogram('latency_seconds', "Задержка", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(3)
+
+        text = registry.render()
+        self.assertIn('# TYPE requests_total counter\nrequests_total{path="/a"} 3\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('latency_seconds_count 3\n', text)
+
+    async def test_handlers_database_and_providers_are_measured(self):
+        metrics = Metrics()
+        router = TextRouter()
+        dp = Dispatcher(Bot(token='123456:ABCdef'))
+        router.register(dp)
+
+        @router.text("Мой портфель")
+        async def portfolio(message):
+            raise RuntimeError("boom")
+
+        @dp.message_handler(state='*')
+        async def fallback(message):
+            return 'ok'
+
+        metrics.instrument_dispatcher(dp, router)
+        with self.assertRaises(RuntimeError):
+            await router.dispatch(types.Message.to_object(text_message("Мой портфель")))
+        self.assertEqual(await dp.message_handlers.handlers[1].handler(None), 'ok')
+
+        tmpdir = tempfile.mkdtemp()
+        db = Database(os.path.join(tmpdir, 'test.db'))
+        async_db = metrics.instrument_database(AsyncDatabase(db))
+        try:
+            def create_table(cursor):
+                cursor.execute('CREATE TABLE quotes (symbol TEXT)')
+
+            await async_db.write(create_table)
+            self.assertEqual(async_db.transactions, 1)
+        finally:
+            async_db.close()
+            db.close()
+            shutil.rmtree(tmpdir)
+
+        provider = metrics.instrument_provider(FakeQuoteProvider(stocks={'AAPL': 150.0}))
+        self.assertEqual(await provider.get_stock_price('AAPL'), 150.0)
+        metrics.track_cache('quotes', LRUCache(maxsize=1))
+
+        text = metrics.registry.render()
+        self.assertIn('finance_bot_handler_errors_total{handler="portfolio"} 1', text)
+        self.assertIn('finance_bot_handler_duration_seconds_count{handler="fallback"} 1', text)
+        self.assertIn('finance_bot_handler_in_flight{handler="portfolio"} 0', text)
+        self.assertIn('finance_bot_db_duration_seconds_count{operation="write",query="create_table"} 1', text)
+        self.assertIn('finance_bot_provider_duration_seconds_count{provider="yahoo",method="get_stock_price"} 1', text)
+        self.assertIn('finance_bot_cache_hits_total{cache="quotes"} 0', text)
+        # Без обращений доля попаданий не определена и не выводится
+        self.assertNotIn('finance_bot_cache_hit_ratio{', text)
+
+    async def test_metrics_endpoint_and_loop_lag(self):
+        metrics = Metrics()
+        app = web.Application()
+        app.router.add_get('/metrics', metrics.handle_metrics)
+        server = TestServer(app)
+        await server.start_server()
+        lag_task = asyncio.ensure_future(metrics._measure_loop_lag(0.01))
+        http = HttpClient(timeout=5)
+        try:
+            await asyncio.sleep(0.05)
+            body = await http.get_text(str(server.make_url('/metrics')))
+        finally:
+            lag_task.cancel()
+            await http.close()
+            await server.close()
+        self.assertIn('# TYPE finance_bot_event_loop_lag_seconds gauge', body)
+        self.assertRegex(body, r'finance_bot_event_loop_lag_seconds \d')
+
+
+class TestWebhook(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.release = asyncio.Event()
+        bot = Bot(token='123456:ABCdef')
+        dp = Dispatcher(bot)
+
+        @dp.message_handler(commands=['start'])
+        async def start(message):
+            return await reply(message, 'Привет')
+
+        @dp.message_handler(commands=['slow'])
+        async def slow(message):
+            await self.release.wait()
+            return await reply(message, 'Готово')
+
+        app = create_webhook_app(secret_token='secret', max_in_flight=1)
+        app['BOT_DISPATCHER'] = dp
+        app.router.add_route('*', '/webhook', BotWebhookHandler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.http = HttpClient(timeout=5)
+
+    async def asyncTearDown(self):
+        await self.http.close()
+        await self.server.close()
+
+    async def post(self, text, secret='secret'):
+        update = {'update_id': 1, 'message': text_message(text)}
+        async with self.http.session().post(self.server.make_url('/webhook'), json=update,
+                                            headers={SECRET_TOKEN_HEADER: secret}) as response:
+            return response.status, response.headers, await response.text()
+
+    async def test_reply_returned_in_webhook_response(self):
+        status, _, body = await self.post('/start')
+        self.assertEqual(status, 200)
+        payload = json.loads(body)
+        self.assertEqual(payload['method'], 'sendMessage')
+        self.assertEqual(payload['chat_id'], 42)
+        self.assertEqual(payload['reply_to_message_id'], 10)
+        self.assertEqual(payload['text'], 'Привет')
+
+    async def test_wrong_secret_rejected(self):
+        status, _, _ = await self.post('/start', secret='wrong')
+        self.assertEqual(status, 401)
+
+    async def test_overload_answers_retry_after(self):
+        slow = asyncio.ensure_future(self.post('/slow'))
+        await asyncio.sleep(0.1)
+        status, headers, _ = await self.post('/start')
+        self.assertEqual(status, 429)
+        self.assertEqual(headers['Retry-After'], '1')
+
+        self.release.set()
+        status, _, body = await slow
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['text'], 'Готово')
+
+    async def test_secret_required(self):
+        with self.assertRaises(ValueError):
+            create_webhook_app(None)
+
+        dp = MagicMock()
+        dp.bot.set_webhook = AsyncMock()
+        with patch('webhook.Executor') as executor, self.assertLogs('webhook', level='WARNING'):
+            start_webhook(dp, 'https://example.com/webhook', '/webhook', '127.0.0.1', 8000)
+        # Без WEBHOOK_SECRET токен создается и передается и в setWebhook, и серверу
+        app = executor.return_value.set_webhook.call_args.kwargs['web_app']
+        register_webhook = executor.return_value.on_startup.call_args_list[0].args[0]
+        await register_webhook(dp)
+        secret = dp.bot.set_webhook.call_args.kwargs['secret_token']
+        self.assertGreaterEqual(len(secret), 32)
+        self.assertEqual(app['WEBHOOK_SECRET_TOKEN'], secret)
+
+    async def test_reply_outside_webhook_sends_message(self):
+        message = MagicMock()
+        message.reply = AsyncMock()
+        self.assertIsNone(await reply(message, 'Привет'))
+        message.reply.assert_awaited_once_with('Привет', reply_markup=None)
+
 # Запуск тестов
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,109 @@
+import hmac
+import logging
+import secrets
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram.dispatcher.webhook import WebhookRequestHandler, SendMessage
+from aiogram.utils.executor import Executor
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает secret_token из setWebhook
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+APP_SECRET_TOKEN_KEY = 'WEBHOOK_SECRET_TOKEN'
+APP_IN_FLIGHT_KEY = 'WEBHOOK_IN_FLIGHT'
+
+# True, пока обновление обрабатывается внутри HTTP-запроса вебхука
+# и ответ можно вернуть прямо в теле ответа Telegram
+in_request_reply = ContextVar('in_request_reply', default=False)
+
+
+# Ответ на сообщение: в режиме вебхука - в теле HTTP-ответа без отдельного
+# запроса к Bot API, иначе обычным message.reply. Результат нужно вернуть
+# из обработчика, и использовать так можно только один ответ на обновление
+async def reply(message, text, reply_markup=None):
+    if in_request_reply.get():
+        return SendMessage(message.chat.id, text,
+                           reply_to_message_id=message.message_id,
+                           reply_markup=reply_markup)
+    await message.reply(text, reply_markup=reply_markup)
+
+
+# Счетчик обрабатываемых обновлений с верхней границей
+class InFlightLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.rejected = 0
+
+    def try_enter(self):
+        if self.limit and self.in_flight >= self.limit:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def leave(self):
+        self.in_flight -= 1
+
+
+# Обработчик вебхука: проверяет секретный токен и при перегрузке отвечает
+# 429 с Retry-After, чтобы Telegram повторил доставку позже. Без токена
+# обновления не принимаются: иначе их мог бы прислать кто угодно
+class BotWebhookHandler(WebhookRequestHandler):
+    def validate_secret_token(self):
+        secret_token = self.request.app.get(APP_SECRET_TOKEN_KEY)
+        if not secret_token:
+            raise web.HTTPUnauthorized()
+        received = self.request.headers.get(SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(received.encode(), secret_token.encode()):
+            raise web.HTTPUnauthorized()
+
+    async def post(self):
+        self.validate_secret_token()
+
+        limiter = self.request.app[APP_IN_FLIGHT_KEY]
+        if not limiter.try_enter():
+            return web.Response(status=429, text='busy', headers={'Retry-After': '1'})
+        token = in_request_reply.set(True)
+        try:
+            return await super().post()
+        finally:
+            in_request_reply.reset(token)
+            limiter.leave()
+
+
+def create_webhook_app(secret_token, max_in_flight=100):
+    if not secret_token:
+        raise ValueError("Для вебхука нужен секретный токен")
+    app = web.Application()
+    app[APP_SECRET_TOKEN_KEY] = secret_token
+    app[APP_IN_FLIGHT_KEY] = InFlightLimiter(max_in_flight)
+    return app
+
+
+# Запуск бота в режиме вебхука на встроенном HTTP-сервере aiohttp. Если
+# секретный токен не задан, он создается при запуске и передается в
+# setWebhook: вебхук регистрируется заново при каждом запуске
+def start_webhook(dispatcher, webhook_url, webhook_path, host, port,
+                  secret_token=None, max_in_flight=100, on_startup=None, on_shutdown=None):
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан, используется случайный токен до перезапуска")
+
+    async def register_webhook(dp):
+        await dp.bot.set_webhook(webhook_url, secret_token=secret_token,
+                                 max_connections=min(max_in_flight, 100) if max_in_flight else None)
+
+    executor = Executor(dispatcher, skip_updates=True)
+    executor.on_startup(register_webhook, polling=False)
+    if on_startup is not None:
+        executor.on_startup(on_startup, polling=False)
+    if on_shutdown is not None:
+        executor.on_shutdown(on_shutdown, polling=False)
+
+    app = create_webhook_app(secret_token, max_in_flight)
+    executor.set_webhook(webhook_path, request_handler=BotWebhookHandler, web_app=app)
+    executor.run_app(host=host, port=port)
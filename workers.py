@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+
+from aiogram import Bot, Dispatcher, types
+
+logger = logging.getLogger(__name__)
+
+# Переменная окружения с номером рабочего процесса: main.py читает
+# настройки при импорте, поэтому номер задается до запуска процесса
+WORKER_INDEX_ENV = 'BOT_WORKER_INDEX'
+
+
+# Ключ разбиения обновления: пользователь, от которого оно пришло, иначе чат.
+# data - обновление в виде словаря Bot API
+def partition_key(data):
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+        chat = value.get('chat')
+        if chat:
+            return chat['id']
+    return data.get('update_id', 0)
+
+
+def worker_for(key, workers):
+    return key % workers
+
+
+async def _close_session(bot):
+    await (await bot.get_session()).close()
+
+
+# Обработка обновлений с сохранением порядка внутри ключа: следующее
+# обновление пользователя ждет предыдущее, разные пользователи обрабатываются
+# параллельно. Каждое обновление - отдельная задача, как при polling в aiogram:
+# фильтры кэшируют состояние FSM в контексте задачи
+class OrderedUpdateProcessor:
+    def __init__(self, process):
+        self.process = process
+        self.errors = 0
+        self._tails = {}
+
+    def submit(self, key, update):
+        previous = self._tails.get(key)
+        task = asyncio.ensure_future(self._run(previous, update))
+        self._tails[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+        return task
+
+    def _forget(self, key, task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, previous, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.process(update)
+        except Exception:
+            self.errors += 1
+            logger.exception("Ошибка при обработке обновления %s", update.update_id)
+
+    # Дожидается всех принятых обновлений
+    async def join(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+    def __len__(self):
+        return len(self._tails)
+
+
+async def consume_updates(update_queue, processor):
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, update_queue.get)
+        # None - сигнал супервизора на остановку
+        if data is None:
+            break
+        processor.submit(partition_key(data), types.Update.to_object(data))
+
+
+async def _serve_worker(dispatcher, update_queue, on_startup, on_shutdown):
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    processor = OrderedUpdateProcessor(dispatcher.process_update)
+    await on_startup(dispatcher)
+    try:
+        await consume_updates(update_queue, processor)
+        await processor.join()
+    finally:
+        await on_shutdown(dispatcher)
+        await _close_session(dispatcher.bot)
+
+
+# Цикл рабочего процесса: обновления приходят от супервизора через очередь
+def run_worker(dispatcher, update_queue, on_startup, on_shutdown):
+    # Ctrl+C получает вся группа процессов; рабочий останавливает супервизор,
+    # дождавшись обработки уже принятых обновлений
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_serve_worker(dispatcher, update_queue, on_startup, on_shutdown))
+
+
+# Рабочие процессы с очередью обновлений у каждого. Процессы запускаются
+# через spawn: каждый заново импортирует main.py и создает свои соединения
+# с базой, HTTP-клиент и диспетчер. target(index, queue) - функция модуля
+class WorkerPool:
+    def __init__(self, target, workers, queue_size=1000):
+        self.target = target
+        self.workers = workers
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.restarts = 0
+
+    def _spawn(self, index):
+        os.environ[WORKER_INDEX_ENV] = str(index)
+        try:
+            process = self.context.Process(
+                target=self.target, args=(index, self.queues[index]), name=f'bot-worker-{index}')
+            process.start()
+        finally:
+            del os.environ[WORKER_INDEX_ENV]
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+    # Перезапускает упавшие процессы; их очереди с необработанными
+    # обновлениями переходят к новым процессам
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error("Рабочий процесс %s завершился с кодом %s, перезапуск", index, process.exitcode)
+                self.restarts += 1
+                self._spawn(index)
+
+    async def dispatch(self, data):
+        update_queue = self.queues[worker_for(partition_key(data), self.workers)]
+        try:
+            update_queue.put_nowait(data)
+        except queue.Full:
+            # Рабочий не успевает: супервизор ждет и не забирает новые обновления
+            await asyncio.get_running_loop().run_in_executor(None, update_queue.put, data)
+
+    def stop(self, timeout=30):
+        for update_queue in self.queues:
+            update_queue.put(None)
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Рабочий процесс %s не остановился за %s с", process.name, timeout)
+                process.terminate()
+                process.join()
+
+
+# Единственный в супервизоре цикл getUpdates: обновления раздаются рабочим
+async def poll_updates(bot, pool, timeout=20, health_interval=5):
+    loop = asyncio.get_running_loop()
+    offset = None
+    next_check = loop.time() + health_interval
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout)
+        except Exception:
+            logger.exception("Не удалось получить обновления")
+            await asyncio.sleep(1)
+            updates = []
+        for update in updates:
+            await pool.dispatch(update.to_python())
+            offset = update.update_id + 1
+        if loop.time() >= next_check:
+            pool.check()
+            next_check = loop.time() + health_interval
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit
+
+
+# Супервизор: получает обновления и распределяет их по рабочим процессам
+# по номеру пользователя, поэтому диалог FSM каждого пользователя идет по
+# порядку в одном процессе. Сам супервизор обработчики не вызывает; в нем
+# работают on_startup/on_shutdown, например проверка ценовых уведомлений
+def start_supervisor(dispatcher, pool, on_startup=None, on_shutdown=None, skip_updates=True):
+    # SIGTERM от docker stop завершает супервизор так же, как Ctrl+C
+    signal.signal(signal.SIGTERM, _raise_system_exit)
+    loop = asyncio.get_event_loop()
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    pool.start()
+    try:
+        if skip_updates:
+            loop.run_until_complete(dispatcher.skip_updates())
+        if on_startup is not None:
+            loop.run_until_complete(on_startup(dispatcher))
+        logger.info("Запущено рабочих процессов: %s", pool.workers)
+        loop.run_until_complete(poll_updates(dispatcher.bot, pool))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        pool.stop()
+        if on_shutdown is not None:
+            loop.run_until_complete(on_shutdown(dispatcher))
+        loop.run_until_complete(_close_session(dispatcher.bot))